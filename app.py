@@ -2,24 +2,102 @@ import os
 import uuid
 import time
 import io
-from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, request, jsonify
+import json
+import shutil
+import zipfile
+import tempfile
+import itertools
+import gzip
+import threading
+from flask import Flask, request, jsonify, Response, stream_with_context, url_for
 from flask_cors import CORS
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from dotenv import load_dotenv
 
 # Load local .env if present
 load_dotenv()
 
-from chalk_processor import process_image
-from style_processor import make_ugly, make_slop, make_pretty
-from supabase_client import upload_image_to_supabase, insert_scan_record, update_scan_record, get_scan_record, get_scan_by_room_id
-from good_sounds import generate_doorbell_wav_from_image
+from pipeline import background_processing_pipeline
+from job_queue import get_job_queue, enqueue_scan
+from content_cache import content_cache
+from scan_cache import scan_cache, semester_cache
+from events import event_bus, stage_events
+from scan_writer import scan_writer
+from derivatives import srcset_map
+from image_io import spool_upload, discard_spooled, read_source, UploadTooLarge
+from batch import run_batch, iter_zip, iter_directory, read_file
+from supabase_client import upload_image_to_supabase, insert_scan_record, get_semester_scans, get_pool_stats, get_public_url
+from uploads import upload_with_retry
+from good_sounds import generate_doorbell_wav_from_image, get_note_bank
+from chalk_processor import segmentation_backend
+from room_store import room_store
+from model_gateway import gateway
+from metrics import registry, register_stats, Gauge, InstrumentedExecutor, CONTENT_TYPE
 
 app = Flask(__name__)
 CORS(app)
 
-# Global Thread Pool
-executor = ThreadPoolExecutor(max_workers=4)
+# Uploads above these sizes are rejected before the body is read (413)
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", "25")) * 1024 * 1024)
+BATCH_MAX_UPLOAD_BYTES = int(float(os.environ.get("BATCH_MAX_UPLOAD_MB", "2048")) * 1024 * 1024)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+# Global Thread Pool (used when no durable job queue is configured)
+executor = InstrumentedExecutor(max_workers=4, name="request")
+job_queue = get_job_queue()
+
+def _job_queue_depth():
+    if job_queue is None:
+        return {}
+    return {(status,): count for status, count in job_queue.depth().items()}
+
+# /metrics: queue depth and the component stats the health check shows
+registry.register(Gauge("chalk_job_queue_depth", "Jobs in the durable queue by status.", ["status"], collect=_job_queue_depth))
+register_stats("chalk_supabase_pool", "Supabase client and connection pool counters.", get_pool_stats)
+register_stats("chalk_content_cache", "Content-hash cache stats.", content_cache.stats)
+register_stats("chalk_scan_cache", "Scan record cache stats.", scan_cache.stats)
+register_stats("chalk_semester_cache", "Semester listing cache stats.", semester_cache.stats)
+register_stats("chalk_event_bus", "Scan event subscribers and published events.", event_bus.stats)
+register_stats("chalk_scan_writer", "Coalesced scan write counters.", scan_writer.stats)
+register_stats("chalk_segmentation", "Segmentation backend counters.", segmentation_backend.stats)
+if room_store is not None:
+    register_stats("chalk_room_store", "Room alignment counters: re-scans aligned, rejected, rooms saved.", room_store.stats)
+
+# Server-Sent Events: idle heartbeat (also re-checks the DB) and max stream length
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT_SECONDS", "15"))
+SSE_MAX_SECONDS = float(os.environ.get("SSE_MAX_SECONDS", "900"))
+# Each open stream holds a gunicorn thread, so cap them below --threads and
+# send everyone else back to polling
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "4"))
+SSE_RETRY_AFTER = int(os.environ.get("SSE_RETRY_AFTER_SECONDS", "5"))
+sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+# Render the doorbell note bank off the request path
+executor.submit(get_note_bank)
+
+# Return 202 before the original is stored; the pipeline uploads it alongside extraction
+DEFER_ORIGINAL_UPLOAD = os.environ.get("DEFER_ORIGINAL_UPLOAD", "false").lower() in ("1", "true", "yes")
+
+# Semester listing: largest page size, and smallest body worth compressing
+SEMESTER_PAGE_MAX = int(os.environ.get("SEMESTER_PAGE_MAX", "500"))
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+
+# Response key -> chalk_scans column(s), matching format_scan_record
+SCAN_FIELD_COLUMNS = {
+    "scan_id": "id",
+    "roomId": "room_id",
+    "status": "status",
+    "chalkImage": "processed_url",
+    "uglifyImage": "ugly_url",
+    "prettifyImage": "pretty_url",
+    "sloppifyText": "slop_text",
+    "original_url": "original_url",
+    "semester": "semester",
+    "srcset": "id,derivatives,processed_url,ugly_url,pretty_url",
+}
 
 def format_scan_record(record):
     """
@@ -34,48 +112,191 @@ def format_scan_record(record):
         "prettifyImage": record.get("pretty_url"),   # Maps to pretty_url
         "sloppifyText": record.get("slop_text"),     # Maps to slop_text
         "original_url": record.get("original_url"),
-        "semester": record.get("semester")
+        "semester": record.get("semester"),
+        "srcset": srcset_map(record)                 # Thumbnail/medium/full per format
     }
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit = request.max_content_length or MAX_UPLOAD_BYTES
+    return jsonify({"error": f"Upload too large (max {limit // (1024 * 1024)} MB)"}), 413
+
 @app.route("/", methods=["GET"])
 def health_check():
-    return jsonify({"status": "ok", "message": "Chalk Processor API is running"}), 200
+    return jsonify({
+        "status": "ok",
+        "message": "Chalk Processor API is running",
+        "supabase_pool": get_pool_stats(),
+        "content_cache": content_cache.stats(),
+        "scan_cache": scan_cache.stats(),
+        "event_bus": event_bus.stats(),
+        "semester_cache": semester_cache.stats(),
+        "scan_writer": scan_writer.stats(),
+        "segmentation": segmentation_backend.stats(),
+        "room_store": room_store.stats() if room_store is not None else None,
+        "models": gateway.stats()
+    }), 200
 
-@app.route("/scans/<scan_id>", methods=["GET"])
-def get_scan_status(scan_id):
+@app.route("/metrics", methods=["GET"])
+def metrics():
     """
-    Poll this endpoint to check if background processing is done.
+    Prometheus metrics for this process: stage and external call latency,
+    errors, executor utilization, queue depth and cache/pool stats.
+    """
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+def scan_response(record):
+    """
+    JSON response for one scan, with an ETag so unchanged polls get a 304.
     """
-    record = get_scan_record(scan_id)
-    if not record:
-        return jsonify({"error": "Scan not found"}), 404
-    
     response = jsonify(format_scan_record(record))
     # Cache completed scans for 1 hour, processing scans for 5 seconds
     if record.get("status") == "completed":
         response.headers['Cache-Control'] = 'public, max-age=3600'
     else:
         response.headers['Cache-Control'] = 'public, max-age=5'
-    return response, 200
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route("/scans/<scan_id>", methods=["GET"])
+def get_scan_status(scan_id):
+    """
+    Poll this endpoint to check if background processing is done.
+    """
+    record = scan_cache.get(scan_id)
+    if not record:
+        return jsonify({"error": "Scan not found"}), 404
+    return scan_response(record)
+
+def sse_event(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+@app.route("/scans/<scan_id>/events", methods=["GET"])
+def stream_scan_events(scan_id):
+    """
+    Server-Sent Events instead of polling: a `snapshot` of the scan, then one
+    event per stage (extracted, ugly, slop, pretty, completed/failed) with the
+    full record, closing once the scan is finished. When all stream slots are
+    taken it answers 503 with Retry-After and the client should poll instead.
+    """
+    if not scan_cache.get(scan_id):
+        return jsonify({"error": "Scan not found"}), 404
+    if not sse_slots.acquire(blocking=False):
+        response = jsonify({"error": "Too many event streams, poll /scans/<scan_id> instead"})
+        response.headers["Retry-After"] = str(SSE_RETRY_AFTER)
+        return response, 503
+
+    def generate():
+        event_id = 0
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        # Subscribe before reading the snapshot so nothing lands in between
+        with event_bus.subscribe(scan_id) as subscription:
+            current = scan_cache.get(scan_id)
+            if current is None:
+                # Gone (or the DB read failed) since the 404 check
+                yield sse_event("error", {"error": "Scan not found"})
+                return
+            yield "retry: 2000\n\n"
+            yield sse_event("snapshot", format_scan_record(current), event_id)
+            while current.get("status") not in ("completed", "failed") and time.monotonic() < deadline:
+                event = subscription.get(timeout=SSE_HEARTBEAT)
+                if event is None:
+                    # Quiet: re-check the row (a worker in another process may
+                    # have moved it on), else just keep the connection alive
+                    latest = scan_cache.get(scan_id) or current
+                    if format_scan_record(latest) == format_scan_record(current):
+                        yield ": keepalive\n\n"
+                        continue
+                    events = stage_events({k: v for k, v in latest.items() if current.get(k) != v})
+                else:
+                    events = [(event["stage"], event["fields"])]
+                for stage, fields in events:
+                    current = {**current, **fields}
+                    event_id += 1
+                    yield sse_event(stage, format_scan_record(current), event_id)
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    # Runs when the server closes the response, even if the client left
+    # before the first chunk (a generator's finally would not)
+    response.call_on_close(sse_slots.release)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+def encode_body(body, encodings):
+    """
+    Compresses `body` with the best encoding the client accepts (br, then gzip).
+    `encodings` caches the results per page. Returns (encoding or None, bytes).
+    """
+    if len(body) < COMPRESS_MIN_BYTES:
+        return None, body
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted[encoding]:
+            if encoding not in encodings:
+                encodings[encoding] = brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, 6)
+            return encoding, encodings[encoding]
+    return None, body
 
 @app.route("/api/scans/<semester>", methods=["GET"])
 def get_scans_by_semester(semester):
     """
-    Get all scans for a specific semester.
+    Get scans for a specific semester.
     Frontend can call this to fetch all doors for display.
+
+    Query params (all optional):
+      fields: comma-separated response keys, e.g. roomId,chalkImage (only those columns are read)
+      limit:  page size; the next page's cursor comes back in X-Next-Cursor and Link
+      cursor: value of X-Next-Cursor from the previous page
+    Without limit the whole semester is returned, as before.
     """
+    fields = [f.strip() for f in request.args.get("fields", "").split(",") if f.strip()] or None
+    unknown = [f for f in fields or () if f not in SCAN_FIELD_COLUMNS]
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+    cursor = request.args.get("cursor") or None
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(1, min(limit, SEMESTER_PAGE_MAX))
+
+    # id is always read: it's the pagination key
+    columns = "*" if not fields else ",".join(sorted(
+        {"id"} | {column for f in fields for column in SCAN_FIELD_COLUMNS[f].split(",")}
+    ))
+
     try:
-        from supabase_client import get_supabase_client
-        supabase = get_supabase_client()
-        
-        response = supabase.table("chalk_scans").select("*").eq("semester", semester).execute()
-        
-        if not response.data:
-            return jsonify([]), 200
-        
-        # Map to frontend format
-        scans = [format_scan_record(record) for record in response.data]
-        return jsonify(scans), 200
+        cache_key, page = semester_cache.lookup(semester, (columns, tuple(fields or ()), cursor, limit))
+        if page is None:
+            # One extra row tells us whether there is a next page
+            rows = get_semester_scans(semester, columns, after=cursor, limit=limit + 1 if limit else None)
+            next_cursor = None
+            if limit and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = rows[-1]["id"]
+
+            # Map to frontend format
+            scans = [format_scan_record(record) for record in rows]
+            if fields:
+                scans = [{f: scan[f] for f in fields} for scan in scans]
+            page = {"body": json.dumps(scans).encode(), "next_cursor": next_cursor, "encoded": {}}
+            semester_cache.store(cache_key, page, scan_ids=[record["id"] for record in rows])
+
+        encoding, body = encode_body(page["body"], page["encoded"])
+        response = Response(body, mimetype="application/json")
+        response.vary.add("Accept-Encoding")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if page["next_cursor"]:
+            args = {**request.args.to_dict(), "cursor": page["next_cursor"]}
+            response.headers["X-Next-Cursor"] = page["next_cursor"]
+            response.headers["Link"] = f'<{url_for("get_scans_by_semester", semester=semester, **args)}>; rel="next"'
+        return response
         
     except Exception as e:
         print(f"Error fetching scans for semester {semester}: {e}")
@@ -87,97 +308,10 @@ def get_scan_by_room(room_id):
     Get a specific scan by room_id.
     Frontend can poll this during processing.
     """
-    record = get_scan_by_room_id(room_id)
+    record = scan_cache.get_by_room(room_id)
     if not record:
         return jsonify({"error": "Scan not found"}), 404
-    
-    response = jsonify(format_scan_record(record))
-    # Cache completed scans for 1 hour, processing scans for 5 seconds
-    if record.get("status") == "completed":
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-    else:
-        response.headers['Cache-Control'] = 'public, max-age=5'
-    return response, 200
-
-def background_processing_pipeline(scan_id, image_bytes, filename, bucket_name, gemini_key):
-    """
-    The main async pipeline:
-    1. Extract Chalk (Gemini Vision + OpenCV)
-    2. Parallel Fan-out:
-       - Save Extracted
-       - Create Ugly (Deep Fry)
-       - Create Slop (Gemini Text)
-    """
-    print(f"[{scan_id}] Starting background pipeline...")
-    
-    try:
-        # --- Step 1: Extraction ---
-        print(f"[{scan_id}] Extracting chalk...")
-        extracted_bytes = process_image(image_bytes, gemini_key)
-        
-        # Upload Extracted
-        processed_url = upload_image_to_supabase(
-            extracted_bytes, 
-            filename, 
-            folder="processed", 
-            bucket_name=bucket_name
-        )
-        
-        # Update DB: Extraction Done
-        update_scan_record(scan_id, processed_url=processed_url, status="extracted")
-        print(f"[{scan_id}] Extraction complete. URL: {processed_url}")
-
-        # --- Step 2: Fan-Out (Ugly & Slop) ---
-        # We can run these sequentially here or parallelize further. 
-        # Sequential is safer for rate limits on Gemini/DB for now.
-        
-        # A. Ugly (Deep Fry)
-        print(f"[{scan_id}] Frying image (Ugly)...")
-        try:
-            ugly_bytes = make_ugly(extracted_bytes)
-            ugly_filename = f"{scan_id}_ugly.jpg"
-            ugly_url = upload_image_to_supabase(
-                ugly_bytes,
-                ugly_filename,
-                folder="processed",
-                bucket_name=bucket_name
-            )
-            update_scan_record(scan_id, ugly_url=ugly_url)
-        except Exception as e:
-            print(f"[{scan_id}] Ugly generation failed: {e}")
-
-        # B. Slop (Text Generation)
-        print(f"[{scan_id}] Generating Slop...")
-        try:
-            slop_text = make_slop(extracted_bytes, gemini_key)
-            # Assuming DB has a 'slop_text' column or similar. 
-            # If not, this might need schema adjustment.
-            update_scan_record(scan_id, slop_text=slop_text)
-        except Exception as e:
-             print(f"[{scan_id}] Slop generation failed: {e}")
-
-        # C. Pretty (AI Reimagining)
-        print(f"[{scan_id}] Beautifying (Imagen)...")
-        try:
-            pretty_bytes = make_pretty(extracted_bytes, gemini_key)
-            pretty_filename = f"{scan_id}_pretty.jpg"
-            pretty_url = upload_image_to_supabase(
-                pretty_bytes,
-                pretty_filename,
-                folder="processed",
-                bucket_name=bucket_name
-            )
-            update_scan_record(scan_id, pretty_url=pretty_url)
-        except Exception as e:
-            print(f"[{scan_id}] Prettify generation failed: {e}")
-
-        # --- Finalize ---
-        update_scan_record(scan_id, status="completed")
-        print(f"[{scan_id}] Pipeline Finished.")
-
-    except Exception as e:
-        print(f"[{scan_id}] Pipeline FAILED: {e}")
-        update_scan_record(scan_id, status="failed", error_message=str(e))
+    return scan_response(record)
 
 @app.route("/extract", methods=["POST"])
 @app.route("/process", methods=["POST"])
@@ -188,10 +322,12 @@ def process_chalk():
     print(f"Files: {request.files}")
     print("=" * 50)
     
-    # 1. Check if 'roomId' is provided and already exists (Idempotency)
+    # 1. Check if 'roomId' is provided and already exists (Idempotency),
+    # unless this is a deliberate re-scan of the room
     room_id = request.form.get("roomId")
-    if room_id:
-        existing_record = get_scan_by_room_id(room_id)
+    rescan = request.form.get("rescan", "").lower() in ("1", "true", "yes")
+    if room_id and not rescan:
+        existing_record = scan_cache.get_by_room(room_id)
         if existing_record:
             print(f"[{room_id}] Found existing scan: {existing_record.get('id')}")
             # If it exists, return it immediately (200 OK)
@@ -215,17 +351,46 @@ def process_chalk():
     if not gemini_key:
         return jsonify({"error": "Server misconfiguration: GEMINI_API_KEY missing"}), 500
 
+    image_path = None
+    handed_off = False
     try:
-        # 1. Read Bytes immediately
-        image_bytes = file.read()
+        # 1. Stream the upload to disk (hashing as we go) instead of holding it in memory
+        try:
+            image_path, content_hash, size = spool_upload(file, MAX_UPLOAD_BYTES)
+        except UploadTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+        print(f"[{scan_id}] Spooled upload ({size / 2**20:.1f} MB) to {image_path}")
+
+        # 1b. Same photo already processed? Link its artifacts to this scan and skip the pipeline.
+        cached = content_cache.lookup(content_hash)
+        if cached:
+            print(f"[{scan_id}] Content cache hit ({content_hash[:12]}), reusing artifacts.")
+            insert_scan_record(
+                scan_id,
+                cached["original_url"],
+                processed_url=cached["processed_url"],
+                status="completed",
+                semester=semester,
+                room_id=room_id,
+                content_hash=content_hash,
+                ugly_url=cached["ugly_url"],
+                pretty_url=cached["pretty_url"],
+                slop_text=cached["slop_text"],
+                derivatives=cached["derivatives"]
+            )
+            record = {**cached, "id": scan_id, "room_id": room_id, "semester": semester, "status": "completed"}
+            return jsonify(format_scan_record(record)), 200
         
-        # 2. Upload Original (Blocking - for safety)
-        original_url = upload_image_to_supabase(
-            image_bytes, 
-            filename, 
-            folder="originals", 
-            bucket_name=bucket_name
-        )
+        # 2. Upload Original (Blocking - for safety), unless the worker is told to do it
+        if DEFER_ORIGINAL_UPLOAD:
+            original_url = get_public_url(filename, folder="originals", bucket_name=bucket_name)
+        else:
+            original_url = upload_with_retry(
+                image_path, 
+                filename, 
+                folder="originals", 
+                bucket_name=bucket_name
+            )
 
         # 3. Create Initial Record
         result = insert_scan_record(
@@ -233,7 +398,8 @@ def process_chalk():
             original_url, 
             status="queued",
             semester=semester,
-            room_id=room_id  # Pass room_id to DB
+            room_id=room_id,  # Pass room_id to DB
+            content_hash=content_hash
         )
 
         if not result or not result.data:
@@ -242,15 +408,34 @@ def process_chalk():
             # but generally we should warn or fail. 
             # For now, let's allow it but log strictly, as the thread will likely fail updates.
 
-        # 4. Offload to Background Worker
-        executor.submit(
-            background_processing_pipeline,
-            scan_id,
-            image_bytes,
-            filename,
-            bucket_name,
-            gemini_key
-        )
+        # 4. Offload to Background Worker (durable queue if configured).
+        # From here on the pipeline owns the spooled file and deletes it when done.
+        if job_queue is not None and DEFER_ORIGINAL_UPLOAD:
+            # The original isn't stored anywhere yet: keep the bytes in the
+            # job itself, which survives restarts, rather than in a spool
+            # file that a reboot or tmp cleanup can remove
+            enqueue_scan(
+                job_queue, scan_id, filename, bucket_name,
+                image_bytes=read_source(image_path), upload_original=True, room_id=room_id
+            )
+            discard_spooled(image_path)
+        elif job_queue is not None:
+            enqueue_scan(
+                job_queue, scan_id, filename, bucket_name,
+                image_path=image_path, room_id=room_id
+            )
+        else:
+            executor.submit(
+                background_processing_pipeline,
+                scan_id,
+                image_path,
+                filename,
+                bucket_name,
+                gemini_key,
+                upload_original=DEFER_ORIGINAL_UPLOAD,
+                room_id=room_id
+            )
+        handed_off = True
 
         # 5. Return immediately (202 Accepted)
         # We return the initial record structure so frontend knows the scan_id
@@ -265,6 +450,101 @@ def process_chalk():
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        if not handed_off:
+            discard_spooled(image_path)
+
+@app.route("/extract/batch", methods=["POST"])
+def process_batch():
+    """
+    Batch extraction for many door photos at once.
+    Accepts multiple `images` files, a zip `archive`, or a `directory`
+    (relative to BATCH_ROOT, only when that is configured).
+    Streams NDJSON progress events; the last one carries the manifest.
+    """
+    # Batches are much larger than single photos; raise the limit before the form is parsed
+    request.max_content_length = BATCH_MAX_UPLOAD_BYTES
+
+    gemini_key = os.environ.get("GEMINI_API_KEY")
+    if not gemini_key:
+        return jsonify({"error": "Server misconfiguration: GEMINI_API_KEY missing"}), 500
+
+    directory = None
+    if request.form.get("directory"):
+        batch_root = os.environ.get("BATCH_ROOT")
+        if not batch_root:
+            return jsonify({"error": "Directory batches are disabled (BATCH_ROOT not set)"}), 400
+        root = os.path.realpath(batch_root)
+        directory = os.path.realpath(os.path.join(root, request.form["directory"]))
+        if os.path.commonpath([root, directory]) != root or not os.path.isdir(directory):
+            return jsonify({"error": "Directory not found"}), 400
+
+    files = [f for f in request.files.getlist("images") if f.filename]
+    archive = request.files.get("archive")
+    if archive and not archive.filename:
+        archive = None
+
+    if not files and not archive and not directory:
+        return jsonify({"error": "No images, archive or directory provided"}), 400
+
+    # Uploaded files are closed when the request ends, but the response keeps
+    # streaming long after that, so spool them to our own temp directory first.
+    spool_dir = tempfile.mkdtemp(prefix="batch-")
+    sources = []
+    try:
+        uploaded = []
+        for i, f in enumerate(files):
+            path = os.path.join(spool_dir, f"{i:05d}")
+            f.save(path)
+            uploaded.append((f.filename, path))
+        sources.append((name, (lambda path=path: read_file(path))) for name, path in uploaded)
+
+        if archive:
+            archive_path = os.path.join(spool_dir, "archive.zip")
+            archive.save(archive_path)
+            if not zipfile.is_zipfile(archive_path):
+                raise ValueError("Invalid zip archive")
+            sources.append(iter_zip(archive_path))
+
+        if directory:
+            sources.append(iter_directory(directory))
+    except Exception as e:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        return jsonify({"error": str(e)}), 400
+
+    semester = request.form.get("semester")
+    workers = request.form.get("workers", type=int)
+    full = request.form.get("full", "").lower() in ("1", "true", "yes")
+    room_from_filename = request.form.get("roomFromFilename", "").lower() in ("1", "true", "yes")
+    bucket_name = os.environ.get("SUPABASE_BUCKET", "chalk-images")
+
+    def generate():
+        try:
+            for event in run_batch(
+                itertools.chain(*sources),
+                semester=semester,
+                workers=workers,
+                full=full,
+                room_from_filename=room_from_filename,
+                bucket_name=bucket_name
+            ):
+                if event["event"] == "finished":
+                    manifest = event["manifest"]
+                    try:
+                        event["manifest_url"] = upload_image_to_supabase(
+                            json.dumps(manifest, indent=2).encode("utf-8"),
+                            f"{manifest['batch_id']}.json",
+                            folder="manifests",
+                            bucket_name=bucket_name,
+                            content_type="application/json"
+                        )
+                    except Exception as e:
+                        print(f"Manifest upload failed: {e}")
+                yield json.dumps(event) + "\n"
+        finally:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 @app.route("/doorbell", methods=["POST"])
 def generate_doorbell_sound():
@@ -0,0 +1,243 @@
+"""
+Batch extraction for a whole semester of door photos.
+
+Usage: python batch.py PATH [PATH ...] --semester "Spring 2026" [--workers 4]
+       [--room-from-filename] [--full] [--manifest batch_manifest.json]
+
+PATH may be a directory, a .zip archive or individual image files.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import zipfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+
+# Load local .env if present
+load_dotenv()
+
+from chalk_processor import process_image
+from style_processor import make_ugly
+from content_cache import hash_image
+from model_gateway import get_gemini_client
+from pipeline import run_pipeline, upload_derivatives
+from derivatives import derivative_spec
+from supabase_client import get_supabase_client, insert_scan_record
+from scan_writer import scan_writer
+from uploads import upload_service, upload_with_retry
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".bmp", ".tif", ".tiff"}
+
+DEFAULT_WORKERS = int(os.environ.get("BATCH_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+
+def _is_image_name(name):
+    base = os.path.basename(name)
+    return not base.startswith(".") and os.path.splitext(base)[1].lower() in IMAGE_EXTENSIONS
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def iter_directory(path):
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if _is_image_name(name):
+                full = os.path.join(root, name)
+                yield os.path.relpath(full, path), (lambda full=full: read_file(full))
+
+def iter_zip(fileobj):
+    """
+    Yields (name, load) for the images in a zip archive. `load` reads from
+    the open archive, which is closed when the generator finishes or is
+    abandoned, so call it while iterating (run_batch does).
+    """
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if not info.is_dir() and _is_image_name(info.filename) and not info.filename.startswith("__MACOSX/"):
+                yield info.filename, (lambda info=info: archive.read(info))
+
+def iter_sources(paths):
+    """
+    Yields (name, load) pairs for every image in the given directories,
+    zip archives and files. `load()` reads the bytes only when needed.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_directory(path)
+        elif zipfile.is_zipfile(path):
+            yield from iter_zip(path)
+        elif _is_image_name(path):
+            yield os.path.basename(path), (lambda path=path: read_file(path))
+
+def _init_worker():
+    # Build the shared clients once per worker process, not once per photo
+    load_dotenv()
+    get_supabase_client()
+    gemini_key = os.environ.get("GEMINI_API_KEY")
+    if gemini_key:
+        get_gemini_client(gemini_key)
+
+def process_batch_item(name, image_bytes, options):
+    """
+    Runs one photo through upload, extraction and ugly (or the full pipeline
+    with options["full"]). Returns a result dict; never raises.
+    """
+    scan_id = str(uuid.uuid4())
+    filename = f"{scan_id}.jpg"
+    bucket_name = options["bucket_name"]
+    gemini_key = os.environ.get("GEMINI_API_KEY")
+    room_id = os.path.splitext(os.path.basename(name))[0] if options.get("room_from_filename") else None
+    start = time.perf_counter()
+    result = {"name": name, "scan_id": scan_id, "room_id": room_id}
+
+    try:
+        original_url = upload_with_retry(image_bytes, filename, folder="originals", bucket_name=bucket_name)
+        insert_scan_record(
+            scan_id,
+            original_url,
+            status="queued",
+            semester=options.get("semester"),
+            room_id=room_id,
+            content_hash=hash_image(image_bytes)
+        )
+        result["original_url"] = original_url
+
+        if options.get("full"):
+            run_pipeline(scan_id, image_bytes, filename, bucket_name, gemini_key, room_id=room_id)
+        else:
+            extracted_bytes = process_image(image_bytes, gemini_key, room_id=room_id)
+            processed = upload_service.submit(
+                extracted_bytes, filename, folder="processed", bucket_name=bucket_name, upsert=True
+            )
+            ugly_bytes = make_ugly(extracted_bytes)
+            ugly = upload_service.submit(
+                ugly_bytes, f"{scan_id}_ugly.jpg", folder="processed",
+                bucket_name=bucket_name, upsert=True
+            )
+            widths = {
+                "chalk": upload_derivatives(scan_id, "chalk", extracted_bytes, bucket_name),
+                "ugly": upload_derivatives(scan_id, "ugly", ugly_bytes, bucket_name),
+            }
+            processed_url = processed.result()
+            # Not flushed on its own: goes out with other scans' writes or with "completed"
+            scan_writer.write(
+                scan_id, processed_url=processed_url, derivatives=derivative_spec(widths),
+                status="extracted", flush=False
+            )
+            ugly_url = ugly.result()
+            scan_writer.write(scan_id, ugly_url=ugly_url, status="completed")
+            result.update(processed_url=processed_url, ugly_url=ugly_url)
+
+        result["status"] = "completed"
+    except Exception as e:
+        print(f"[{scan_id}] Batch item {name} FAILED: {e}")
+        scan_writer.write(scan_id, status="failed", error_message=str(e))
+        result.update(status="failed", error=str(e))
+
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+def run_batch(sources, semester=None, workers=None, full=False, room_from_filename=False, bucket_name=None):
+    """
+    Processes (name, load) sources on a process pool, keeping at most
+    2 x workers photos in flight. Yields progress events as dicts:
+    "started", one "item" per photo (in completion order) and "finished"
+    with the summary manifest.
+    """
+    workers = workers or DEFAULT_WORKERS
+    options = {
+        "semester": semester,
+        "full": full,
+        "room_from_filename": room_from_filename,
+        "bucket_name": bucket_name or os.environ.get("SUPABASE_BUCKET", "chalk-images"),
+    }
+    batch_id = str(uuid.uuid4())
+    started_at = time.time()
+    results = []
+
+    yield {"event": "started", "batch_id": batch_id, "workers": workers, "semester": semester}
+
+    # spawn, not fork: the parent may be a threaded web server
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+        pending = {}
+        sources = iter(sources)
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < workers * 2:
+                try:
+                    name, load = next(sources)
+                except StopIteration:
+                    exhausted = True
+                    break
+                try:
+                    pending[pool.submit(process_batch_item, name, load(), options)] = name
+                except Exception as e:
+                    result = {"name": name, "status": "failed", "error": f"Could not read image: {e}"}
+                    results.append(result)
+                    yield {"event": "item", "index": len(results), **result}
+
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Only reachable if the worker process itself died
+                    result = {"name": name, "status": "failed", "error": f"Worker crashed: {e}"}
+                results.append(result)
+                yield {"event": "item", "index": len(results), **result}
+
+    completed = sum(1 for r in results if r.get("status") == "completed")
+    manifest = {
+        "batch_id": batch_id,
+        "semester": semester,
+        "started_at": started_at,
+        "seconds": round(time.time() - started_at, 3),
+        "total": len(results),
+        "completed": completed,
+        "failed": len(results) - completed,
+        "items": results,
+    }
+    yield {"event": "finished", "manifest": manifest}
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch chalk extraction")
+    parser.add_argument("paths", nargs="+", help="directories, .zip archives or image files")
+    parser.add_argument("--semester")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--full", action="store_true", help="also run slop and pretty for every photo")
+    parser.add_argument("--room-from-filename", action="store_true",
+                        help="use each file name (without extension) as its roomId")
+    parser.add_argument("--manifest", default=f"batch_manifest_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    args = parser.parse_args()
+
+    if not os.environ.get("GEMINI_API_KEY"):
+        sys.exit("GEMINI_API_KEY missing")
+
+    for event in run_batch(
+        iter_sources(args.paths),
+        semester=args.semester,
+        workers=args.workers,
+        full=args.full,
+        room_from_filename=args.room_from_filename,
+    ):
+        if event["event"] == "item":
+            status = event["status"].upper()
+            detail = event.get("error") or event.get("scan_id")
+            print(f"[{event['index']}] {status:9} {event['name']} ({detail})", flush=True)
+        elif event["event"] == "finished":
+            manifest = event["manifest"]
+            with open(args.manifest, "w") as f:
+                json.dump(manifest, f, indent=2)
+            print(f"Done: {manifest['completed']}/{manifest['total']} completed in {manifest['seconds']}s. "
+                  f"Manifest: {args.manifest}")
+
+if __name__ == "__main__":
+    main()
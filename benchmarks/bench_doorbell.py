@@ -0,0 +1,85 @@
+"""
+Benchmark doorbell synthesis from the note bank against the original
+per-note render + np.concatenate loop.
+
+Usage: python -m benchmarks.bench_doorbell [--repeat N] [--notes N]
+"""
+import io
+import argparse
+import time
+import cv2
+import numpy as np
+from scipy.io import wavfile
+
+from good_sounds import (
+    create_bell_sound, get_note_bank, synthesize_notes,
+    generate_doorbell_wav_from_image, E_PENTATONIC_FREQUENCIES,
+)
+from benchmarks.fixtures import synthetic_chalk_canvas
+
+SAMPLE_RATE = 44100
+NOTE_DURATION = 0.7
+
+def synthesize_loop(note_indices):
+    """
+    The original synthesis: render every note from scratch and grow the
+    signal with np.concatenate.
+    """
+    full_signal = np.array([])
+    for note_index in note_indices:
+        bell_sound = create_bell_sound(E_PENTATONIC_FREQUENCIES[note_index], NOTE_DURATION, SAMPLE_RATE)
+        full_signal = np.concatenate([full_signal, bell_sound])
+    full_signal = full_signal / np.max(np.abs(full_signal))
+    return np.int16(full_signal * 32767)
+
+def encode_wav(audio_data):
+    buf = io.BytesIO()
+    wavfile.write(buf, SAMPLE_RATE, audio_data)
+    return buf.getvalue()
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--notes", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    note_indices = list(np.random.randint(len(E_PENTATONIC_FREQUENCIES), size=args.notes))
+
+    start = time.perf_counter()
+    get_note_bank(NOTE_DURATION, SAMPLE_RATE)
+    bank_s = time.perf_counter() - start
+
+    loop_audio = synthesize_loop(note_indices)
+    bank_audio = synthesize_notes(note_indices, NOTE_DURATION, SAMPLE_RATE)
+    # Detuning is random per note, so compare shape and level rather than samples
+    same_shape = loop_audio.shape == bank_audio.shape and loop_audio.dtype == bank_audio.dtype
+    peak_loop, peak_bank = np.abs(loop_audio.astype(np.int32)).max(), np.abs(bank_audio.astype(np.int32)).max()
+
+    loop_s = best_of(lambda: synthesize_loop(note_indices), args.repeat)
+    bank_s_synth = best_of(lambda: synthesize_notes(note_indices, NOTE_DURATION, SAMPLE_RATE), args.repeat)
+    encode_s = best_of(lambda: encode_wav(bank_audio), args.repeat)
+
+    ok, buf = cv2.imencode(".jpg", synthetic_chalk_canvas(seed=args.seed))
+    image_bytes = buf.tobytes()
+    doorbell_s = best_of(lambda: generate_doorbell_wav_from_image(image_bytes), args.repeat)
+
+    print(f"Notes: {args.notes} x {NOTE_DURATION}s at {SAMPLE_RATE} Hz")
+    print(f"Same length/dtype: {same_shape}, peaks {peak_loop} vs {peak_bank}")
+    print(f"Note bank build (once per process): {bank_s * 1000:8.1f} ms")
+    print(f"Per-note render + concatenate:      {loop_s * 1000:8.1f} ms")
+    print(f"Note bank synthesis:                {bank_s_synth * 1000:8.1f} ms  ({loop_s / bank_s_synth:.0f}x faster)")
+    print(f"WAV encode:                         {encode_s * 1000:8.1f} ms")
+    print(f"generate_doorbell_wav_from_image:   {doorbell_s * 1000:8.1f} ms (1200x2800 JPEG)")
+
+if __name__ == "__main__":
+    main()
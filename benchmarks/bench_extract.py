@@ -0,0 +1,149 @@
+"""
+Benchmark the fused chalk extraction engine (boost lookup table, merged
+morphology, per-thread scratch buffers), whole-frame and in strips, against
+the original float-math version, and check that all produce the same pixels.
+
+Allocations are measured with tracemalloc while tracing lines: every
+interval between two traced lines that raised the allocation peak by at
+least 64 KiB counts as one large allocation (a lower bound, since several
+arrays made on one line count once).
+
+Usage: python -m benchmarks.bench_extract [--repeat N] [--width W] [--height H] [--seeds N]
+       [--strip-rows N]
+"""
+import sys
+import argparse
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+import chalk_processor
+from chalk_processor import extract_chalk, extract_chalk_strips, warp_door
+from benchmarks.fixtures import synthetic_chalk_canvas, synthetic_door_photo
+
+LARGE_ALLOCATION = 64 * 1024
+
+def extract_chalk_float(warped_img):
+    """
+    The original extraction: morphology step by step and the S/V boost in float32.
+    """
+    gray = cv2.cvtColor(warped_img, cv2.COLOR_BGR2GRAY)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
+    tophat_gray = cv2.morphologyEx(gray, cv2.MORPH_TOPHAT, kernel)
+    _, binary_mask = cv2.threshold(tophat_gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    clean_kernel = np.ones((2, 2), np.uint8)
+    binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_OPEN, clean_kernel)
+    dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2, 2))
+    enhanced_mask = cv2.dilate(binary_mask, dilate_kernel, iterations=2)
+    close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2, 2))
+    enhanced_mask = cv2.morphologyEx(enhanced_mask, cv2.MORPH_CLOSE, close_kernel)
+
+    enhanced_chalk = cv2.bitwise_and(warped_img, warped_img, mask=enhanced_mask)
+    hsv = cv2.cvtColor(enhanced_chalk, cv2.COLOR_BGR2HSV).astype(np.float32)
+    h, s, v = cv2.split(hsv)
+    s = np.clip(s * 1.25, 0, 255)
+    v = np.clip(v * 1.2, 0, 255)
+    hsv_boosted = cv2.merge([h, s, v]).astype(np.uint8)
+    return cv2.cvtColor(hsv_boosted, cv2.COLOR_HSV2BGR)
+
+def best_of(fn, repeat):
+    fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def measure_allocations(fn):
+    """
+    (large allocations, MB allocated, peak MB above the starting point) for one call.
+    """
+    files = {extract_chalk_float.__code__.co_filename, chalk_processor.__file__}
+    state = {"last": 0, "peak": 0, "count": 0, "bytes": 0}
+
+    def on_line(frame, event, arg):
+        current, peak = tracemalloc.get_traced_memory()
+        state["peak"] = max(state["peak"], peak)
+        if peak - state["last"] >= LARGE_ALLOCATION:
+            state["count"] += 1
+            state["bytes"] += peak - state["last"]
+        tracemalloc.reset_peak()
+        state["last"] = current
+        return on_line
+
+    fn()  # warm up lazy init and the scratch buffers
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    state["last"] = state["peak"] = start
+    sys.settrace(lambda frame, event, arg: on_line if frame.f_code.co_filename in files else None)
+    try:
+        result = fn()
+    finally:
+        sys.settrace(None)
+        state["peak"] = max(state["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    del result
+    return state["count"], state["bytes"] / 1e6, (state["peak"] - start) / 1e6
+
+def warped_doors(width, height, seeds):
+    """
+    Warps of synthetic door photos, as extract_chalk sees them in the pipeline.
+    """
+    doors = []
+    for seed in range(seeds):
+        image, corners = synthetic_door_photo(seed=seed, strokes=120)
+        img_cv = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+        doors.append(warp_door(img_cv, corners, out_size=(width, height)))
+    return doors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--width", type=int, default=1200)
+    parser.add_argument("--height", type=int, default=2800)
+    parser.add_argument("--seeds", type=int, default=5, help="images of each kind checked for identical output")
+    parser.add_argument("--strip-rows", type=int, default=256, help="strip height for the tiled engine")
+    args = parser.parse_args()
+
+    samples = [synthetic_chalk_canvas(args.width, args.height, seed=seed) for seed in range(args.seeds)]
+    samples += warped_doors(args.width, args.height, args.seeds)
+    mismatched = 0
+    for img in samples:
+        expected = extract_chalk_float(img)
+        for actual in (extract_chalk(img, strip_rows=0), extract_chalk_strips(img, args.strip_rows)):
+            if not np.array_equal(expected, actual):
+                mismatched += 1
+                diff = np.abs(expected.astype(np.int16) - actual.astype(np.int16))
+                print(f"  mismatch: {np.count_nonzero(diff.max(axis=2))} pixels, max difference {diff.max()}")
+
+    img = samples[0]
+    float_s = best_of(lambda: extract_chalk_float(img), args.repeat)
+    fused_s = best_of(lambda: extract_chalk(img, strip_rows=0), args.repeat)
+    strips_s = best_of(lambda: extract_chalk_strips(img, args.strip_rows), args.repeat)
+    float_allocs = measure_allocations(lambda: extract_chalk_float(img))
+    misses_before = chalk_processor.scratch_stats()["allocations"]
+    fused_allocs = measure_allocations(lambda: extract_chalk(img, strip_rows=0))
+    strips_allocs = measure_allocations(lambda: extract_chalk_strips(img, args.strip_rows))
+    misses = chalk_processor.scratch_stats()["allocations"] - misses_before
+
+    print(f"Image: {img.shape[1]}x{img.shape[0]}, {len(samples)} samples checked")
+    print(f"Outputs pixel-identical: {mismatched == 0}" + (f" ({mismatched} differ)" if mismatched else ""))
+    print(f"Strip threads: {chalk_processor.EXTRACT_THREADS}, CPUs: {cv2.getNumberOfCPUs()}")
+    print(f"{'':18} {'time':>9} {'large allocs':>13} {'allocated':>10} {'peak':>9}")
+    for name, seconds, (count, allocated, peak) in (
+        ("Float32 boost", float_s, float_allocs),
+        ("Fused LUT engine", fused_s, fused_allocs),
+        (f"Strips of {args.strip_rows}", strips_s, strips_allocs),
+    ):
+        print(f"{name:18} {seconds * 1000:6.1f} ms {count:13d} {allocated:7.1f} MB {peak:6.1f} MB")
+    print("Scratch buffers are reused between calls and not counted above: whole-frame extraction keeps")
+    print("9 bytes per pixel of them per thread, strips about 10 bytes per pixel of one strip plus halo.")
+    print(f"Speedup: {float_s / fused_s:.1f}x; scratch buffers allocated after warm-up: {misses}")
+    if mismatched:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark the vectorized drip engine against the original per-column loop.
+
+Usage: python -m benchmarks.bench_make_ugly [--repeat N] [--width W] [--height H]
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+
+from style_processor import drip_columns, make_ugly
+from benchmarks.fixtures import synthetic_chalk_canvas
+
+def drip_columns_loop(small, small_gray, rng, threshold=80):
+    """
+    The original make_ugly loop, drawing lengths from `rng` in the same order.
+    """
+    h, small_w = small_gray.shape[:2]
+    output = small.copy()
+    for x in range(small_w):
+        bright_indices = np.where(small_gray[:, x] > threshold)[0]
+        if len(bright_indices) > 0:
+            last_y = bright_indices[0]
+            for y in bright_indices:
+                if y > last_y + 1:
+                    length = rng.integers(10, 100)
+                    end = min(h, last_y + length)
+                    output[last_y:end, x] = small[last_y, x]
+                last_y = y
+            length = rng.integers(20, 150)
+            end = min(h, last_y + length)
+            output[last_y:end, x] = small[last_y, x]
+    return output
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--width", type=int, default=1200)
+    parser.add_argument("--height", type=int, default=2800)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    img = synthetic_chalk_canvas(args.width, args.height, seed=args.seed)
+    small = cv2.resize(img, (args.width // 2, args.height))
+    small_gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    loop_out = drip_columns_loop(small, small_gray, np.random.default_rng(args.seed))
+    vec_out = drip_columns(small, small_gray, np.random.default_rng(args.seed))
+    identical = np.array_equal(loop_out, vec_out)
+
+    loop_s = best_of(lambda: drip_columns_loop(small, small_gray, np.random.default_rng(args.seed)), args.repeat)
+    vec_s = best_of(lambda: drip_columns(small, small_gray, np.random.default_rng(args.seed)), args.repeat)
+
+    ok, buf = cv2.imencode(".jpg", img)
+    image_bytes = buf.tobytes()
+    ugly_s = best_of(lambda: make_ugly(image_bytes, rng=args.seed), args.repeat)
+
+    print(f"Image: {args.width}x{args.height} (drip canvas {args.width // 2}x{args.height})")
+    print(f"Outputs identical with same seed: {identical}")
+    print(f"Per-column loop:   {loop_s * 1000:8.1f} ms")
+    print(f"Vectorized drips:  {vec_s * 1000:8.1f} ms  ({loop_s / vec_s:.1f}x faster)")
+    print(f"make_ugly end-to-end: {ugly_s * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
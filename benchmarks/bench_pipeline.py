@@ -0,0 +1,200 @@
+"""
+Per-stage timings of the image pipeline on synthetic door photos, with
+Gemini replaced by recorded segmentation responses, so chalk_processor and
+style_processor changes can be measured offline.
+
+Writes JSON (to stdout, or --output with a summary table). With --compare
+the run is checked against a saved baseline: stages slower by more than
+--threshold (and --min-delta-ms) are reported and the exit status is 1.
+--current compares two saved files without running anything.
+
+Usage: python -m benchmarks.bench_pipeline [--sizes 1200x1600,3000x4000] [--repeat N]
+       [--mode reduced|full] [--output FILE] [--compare BASELINE [--current FILE]]
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import contextlib
+import cv2
+import numpy as np
+from PIL import ImageOps
+
+import chalk_processor
+from chalk_processor import (
+    GeminiSegmentation, load_door_region, item_box, decode_native_mask, mask_corners,
+    warp_door, chalk_mask, boost_chalk, process_image,
+)
+from image_io import open_image
+from style_processor import make_ugly
+from good_sounds import generate_doorbell_wav_from_image
+from benchmarks.fixtures import synthetic_door_photo, recorded_segmentation
+
+STAGES = (
+    "segment", "decode", "mask", "corners", "warp", "tophat_otsu", "hsv_boost",
+    "encode", "make_ugly", "doorbell", "process_image",
+)
+
+@contextlib.contextmanager
+def recorded_gemini(items):
+    """
+    Answers every segmentation request with `items` and bypasses the disk
+    cache, so get_segmentation_items runs its cache-miss path offline.
+    """
+    request, cache = chalk_processor.request_segmentation, chalk_processor.segmentation_cache
+    chalk_processor.request_segmentation = lambda im, api_key: items
+    chalk_processor.segmentation_cache = None
+    try:
+        yield
+    finally:
+        chalk_processor.request_segmentation, chalk_processor.segmentation_cache = request, cache
+
+def time_stage(fn, repeat):
+    fn()  # warm up (lazy init, note bank, allocator)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {
+        "min_ms": round(min(timings) * 1000, 3),
+        "median_ms": round(float(np.median(timings)) * 1000, 3),
+    }
+
+def bench_size(width, height, repeat, mode, seed):
+    image, corners = synthetic_door_photo(width, height, strokes=max(60, width * height // 40000), seed=seed)
+    items = recorded_segmentation(corners, width, height)
+    backend = GeminiSegmentation()
+    results = {}
+
+    with recorded_gemini(items):
+        results["segment"] = time_stage(lambda: backend.segment(image, "bench"), repeat)
+        item = items[0]
+
+        if mode == "full":
+            def decode():
+                pil_img = ImageOps.exif_transpose(open_image(image))
+                return cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR), None, pil_img.size
+            img_cv, region, (w, h) = decode()
+        else:
+            def decode():
+                img_cv, region, size, scale = load_door_region(image, item)
+                return img_cv, region, size
+            img_cv, region, (w, h) = decode()
+        results["decode"] = time_stage(decode, repeat)
+
+        mask = decode_native_mask(item)
+        results["mask"] = time_stage(lambda: decode_native_mask(item), repeat)
+        box = item_box(item, w, h)
+        origin = np.float32(region[:2]) if region else np.float32([0, 0])
+        src_pts = mask_corners(mask, box) - origin
+        results["corners"] = time_stage(lambda: mask_corners(mask, box) - origin, repeat)
+        warped = warp_door(img_cv, src_pts)
+        results["warp"] = time_stage(lambda: warp_door(img_cv, src_pts), repeat)
+
+        enhanced_mask = chalk_mask(warped)
+        results["tophat_otsu"] = time_stage(lambda: chalk_mask(warped), repeat)
+        final_img = boost_chalk(warped, enhanced_mask)
+        results["hsv_boost"] = time_stage(lambda: boost_chalk(warped, enhanced_mask), repeat)
+        extracted = cv2.imencode(".jpg", final_img)[1].tobytes()
+        results["encode"] = time_stage(lambda: cv2.imencode(".jpg", final_img), repeat)
+
+        results["make_ugly"] = time_stage(lambda: make_ugly(extracted, rng=seed), repeat)
+        results["doorbell"] = time_stage(lambda: generate_doorbell_wav_from_image(extracted), repeat)
+        results["process_image"] = time_stage(lambda: process_image(image, "bench", mode=mode, backend=backend), repeat)
+    return results
+
+def run(sizes, repeat, mode, seed):
+    results = {}
+    for width, height in sizes:
+        print(f"Benchmarking {width}x{height}...", file=sys.stderr)
+        # Keep the pipeline's own logging out of the JSON on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            results[f"{width}x{height}"] = bench_size(width, height, repeat, mode, seed)
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "cpus": cv2.getNumberOfCPUs(),
+            "mode": mode,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+def compare(baseline, current, threshold, min_delta_ms):
+    """
+    Returns rows (size, stage, baseline ms, current ms, change, regressed)
+    for every stage present in both runs, by median.
+    """
+    rows = []
+    for size, stages in current["results"].items():
+        for stage, timing in stages.items():
+            before = baseline["results"].get(size, {}).get(stage)
+            if before is None:
+                continue
+            old, new = before["median_ms"], timing["median_ms"]
+            change = new / old - 1 if old else 0.0
+            regressed = change > threshold and new - old > min_delta_ms
+            rows.append((size, stage, old, new, change, regressed))
+    return rows
+
+def print_table(report):
+    for size, stages in report["results"].items():
+        print(f"{size} ({report['meta']['mode']})")
+        for stage in STAGES:
+            if stage in stages:
+                print(f"  {stage:14} {stages[stage]['median_ms']:9.2f} ms  (min {stages[stage]['min_ms']:.2f})")
+
+def parse_sizes(value):
+    return [tuple(int(n) for n in size.lower().split("x")) for size in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1200x1600,2000x2600,3000x4000", help="photo sizes as WxH list")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mode", choices=("reduced", "full"), default="reduced")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON report to check for regressions against")
+    parser.add_argument("--current", help="with --compare: a saved report instead of a new run")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="ignore regressions smaller than this")
+    args = parser.parse_args()
+
+    if args.current:
+        with open(args.current) as f:
+            report = json.load(f)
+    else:
+        report = run(parse_sizes(args.sizes), args.repeat, args.mode, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print_table(report)
+    elif not args.compare:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for key in ("mode", "machine", "cpus"):
+            if baseline["meta"].get(key) != report["meta"].get(key):
+                print(f"Warning: baseline {key} {baseline['meta'].get(key)} != current {report['meta'].get(key)}")
+        rows = compare(baseline, report, args.threshold, args.min_delta_ms)
+        print(f"{'size':10} {'stage':14} {'baseline':>10} {'current':>10} {'change':>8}")
+        for size, stage, old, new, change, regressed in rows:
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{size:10} {stage:14} {old:8.2f}ms {new:8.2f}ms {change * 100:+7.1f}%{flag}")
+        regressions = sum(1 for row in rows if row[-1])
+        print(f"{regressions} regression(s) over {args.threshold * 100:.0f}%")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
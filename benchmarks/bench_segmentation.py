@@ -0,0 +1,135 @@
+"""
+Compare door segmentation backends on a labelled image set: corner error
+against the labelled corners, and latency.
+
+Labels are a JSON object mapping file names in --images to the door's
+corners as [[x, y], ...] ordered TL, TR, BR, BL, in pixels of the upright
+(EXIF-rotated) photo. Without --images a synthetic set is generated.
+The gemini and auto backends need GEMINI_API_KEY; the segmentation disk
+cache is bypassed unless --use-cache is given.
+
+Usage: python -m benchmarks.bench_segmentation [--images DIR --labels FILE] [--count N]
+       [--backends local,auto,gemini] [--json]
+"""
+import os
+import json
+import argparse
+import time
+import numpy as np
+from PIL import ImageOps
+
+import chalk_processor
+from chalk_processor import build_segmentation_backend, item_corners
+from image_io import open_image
+from benchmarks.fixtures import synthetic_door_photo
+
+# A detection whose corners are off by more than this share of the door
+# diagonal on average counts as a miss
+HIT_TOLERANCE = 0.02
+
+def load_labelled_set(images_dir, labels_path):
+    with open(labels_path) as f:
+        labels = json.load(f)
+    samples = []
+    for name, corners in sorted(labels.items()):
+        with open(os.path.join(images_dir, name), "rb") as f:
+            samples.append((name, f.read(), np.array(corners, dtype=np.float32)))
+    return samples
+
+def synthetic_set(count, seed):
+    return [(f"synthetic-{i}", *synthetic_door_photo(seed=seed + i)) for i in range(count)]
+
+def corner_error(item, image, corners):
+    """
+    Mean distance (pixels) between the labelled corners and the ones
+    the pipeline would warp from, via the same corner path as process_image.
+    """
+    width, height = ImageOps.exif_transpose(open_image(image)).size
+    found = item_corners(item, width, height)
+    return float(np.linalg.norm(found - corners, axis=1).mean())
+
+def evaluate(backend, samples, api_key):
+    errors, relative, latencies, failures = [], [], [], 0
+    for name, image, corners in samples:
+        start = time.perf_counter()
+        try:
+            item = backend.segment(image, api_key)[0]
+        except Exception as e:
+            print(f"  {backend.name} failed on {name}: {e}")
+            failures += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        error = corner_error(item, image, corners)
+        diagonal = np.linalg.norm(corners[2] - corners[0])
+        errors.append(error)
+        relative.append(error / diagonal)
+
+    relative = np.array(relative)
+    result = {
+        "backend": backend.name,
+        "images": len(samples),
+        "failures": failures,
+        "hit_rate": float((relative <= HIT_TOLERANCE).sum() / len(samples)),
+    }
+    if errors:
+        result.update({
+            "corner_error_px_mean": float(np.mean(errors)),
+            "corner_error_px_median": float(np.median(errors)),
+            "corner_error_px_p95": float(np.percentile(errors, 95)),
+            "corner_error_pct_diagonal_mean": float(relative.mean() * 100),
+            "latency_ms_median": float(np.median(latencies) * 1000),
+            "latency_ms_p95": float(np.percentile(latencies, 95) * 1000),
+        })
+    stats = backend.stats()
+    if "escalated" in stats:
+        result["escalation_rate"] = stats["escalated"] / max(1, stats["escalated"] + stats["local"])
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="directory of labelled photos")
+    parser.add_argument("--labels", help="JSON file of corners per photo")
+    parser.add_argument("--count", type=int, default=40, help="synthetic images when --images is not given")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backends", default="local,auto,gemini")
+    parser.add_argument("--use-cache", action="store_true", help="let Gemini results come from the disk cache")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    if args.images:
+        if not args.labels:
+            parser.error("--images needs --labels")
+        samples = load_labelled_set(args.images, args.labels)
+    else:
+        samples = synthetic_set(args.count, args.seed)
+    if not args.use_cache:
+        chalk_processor.segmentation_cache = None
+
+    api_key = os.environ.get("GEMINI_API_KEY")
+    results = []
+    for name in args.backends.split(","):
+        name = name.strip()
+        if name in ("gemini", "auto") and not api_key:
+            print(f"Skipping {name}: GEMINI_API_KEY is not set")
+            continue
+        results.append(evaluate(build_segmentation_backend(name), samples, api_key))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{len(samples)} images ({'labelled' if args.images else 'synthetic'})")
+    print(f"{'backend':8} {'hits':>6} {'fail':>5} {'err px':>8} {'p95 px':>8} {'err %':>6} {'p50 ms':>8} {'p95 ms':>8} {'escalated':>9}")
+    for r in results:
+        escalated = f"{r['escalation_rate'] * 100:8.0f}%" if "escalation_rate" in r else f"{'-':>9}"
+        if "latency_ms_median" not in r:
+            print(f"{r['backend']:8} {r['hit_rate'] * 100:5.0f}% {r['failures']:5d} {'-':>8} {'-':>8} {'-':>6} {'-':>8} {'-':>8} {escalated}")
+            continue
+        print(
+            f"{r['backend']:8} {r['hit_rate'] * 100:5.0f}% {r['failures']:5d} "
+            f"{r['corner_error_px_mean']:8.1f} {r['corner_error_px_p95']:8.1f} {r['corner_error_pct_diagonal_mean']:6.2f} "
+            f"{r['latency_ms_median']:8.1f} {r['latency_ms_p95']:8.1f} {escalated}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import base64
+import cv2
+import numpy as np
+
+def synthetic_chalk_canvas(width=1200, height=2800, strokes=400, seed=0):
+    """
+    Dark canvas with random coloured chalk strokes, shaped like the
+    1200x2800 output of the extraction warp.
+    """
+    rng = np.random.default_rng(seed)
+    canvas = np.zeros((height, width, 3), dtype=np.uint8)
+    for _ in range(strokes):
+        pts = rng.integers(0, [width, height], size=(rng.integers(2, 6), 2)).astype(np.int32)
+        color = tuple(int(c) for c in rng.integers(60, 256, size=3))
+        thickness = int(rng.integers(2, 12))
+        cv2.polylines(canvas, [pts], False, color, thickness, lineType=cv2.LINE_AA)
+    noise = rng.normal(0, 6, canvas.shape)
+    return np.clip(canvas + noise, 0, 255).astype(np.uint8)
+
+def synthetic_door_photo(width=1600, height=2000, strokes=60, seed=0, jitter=0.04):
+    """
+    JPEG photo of a dark chalk-covered door in a lighter frame on a noisy
+    wall, seen at a slight angle. Returns (jpeg bytes, corners) with the
+    door's corners as float32 (x, y) pixels ordered TL, TR, BR, BL.
+    """
+    rng = np.random.default_rng(seed)
+    wall = np.array(rng.integers(110, 180, size=3), dtype=np.float64)
+    img = np.clip(wall + rng.normal(0, 8, (height, width, 3)), 0, 255).astype(np.uint8)
+
+    cx = width * rng.uniform(0.4, 0.6)
+    door_w = width * rng.uniform(0.35, 0.5)
+    door_h = min(height * 0.85, door_w * rng.uniform(2.0, 2.5))
+    top = height * rng.uniform(0.05, 0.95 - door_h / height)
+    x1, x2, y1, y2 = cx - door_w / 2, cx + door_w / 2, top, top + door_h
+    corners = np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], dtype=np.float32)
+    corners += rng.uniform(-jitter, jitter, size=(4, 2)).astype(np.float32) * [door_w, door_h]
+
+    # Frame: the door's quad pushed out from its centre
+    centre = corners.mean(axis=0)
+    frame = centre + (corners - centre) * [1.08, 1.04]
+    cv2.fillPoly(img, [np.int32(np.round(frame))], tuple(int(c) for c in rng.integers(200, 240, size=3)))
+
+    door = np.zeros((height, width), dtype=np.uint8)
+    cv2.fillPoly(door, [np.int32(np.round(corners))], 255)
+    shade = np.array(rng.integers(30, 70, size=3), dtype=np.float64)
+    img[door > 0] = np.clip(shade + rng.normal(0, 4, (int((door > 0).sum()), 3)), 0, 255).astype(np.uint8)
+
+    # Chalk, kept inside the door
+    chalk = np.zeros_like(img)
+    lo, hi = corners.min(axis=0), corners.max(axis=0)
+    for _ in range(strokes):
+        pts = rng.uniform(lo, hi, size=(rng.integers(2, 6), 2)).astype(np.int32)
+        color = tuple(int(c) for c in rng.integers(120, 256, size=3))
+        cv2.polylines(chalk, [pts], False, color, int(rng.integers(2, 8)), lineType=cv2.LINE_AA)
+    inside = (door > 0) & chalk.any(axis=2)
+    img[inside] = chalk[inside]
+
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buf.tobytes(), corners
+
+def recorded_segmentation(corners, width, height, thumbnail=1024):
+    """
+    The items Gemini returns for a width x height photo whose door has
+    `corners`: box_2d normalized 0-1000 and a PNG mask of the box at the
+    size the model sees it (a `thumbnail`-pixel thumbnail).
+    """
+    corners = np.asarray(corners, dtype=np.float64)
+    x1, y1 = corners.min(axis=0)
+    x2, y2 = corners.max(axis=0)
+    scale = thumbnail / max(width, height)
+    mask = np.zeros((max(1, round((y2 - y1) * scale)), max(1, round((x2 - x1) * scale))), dtype=np.uint8)
+    cv2.fillPoly(mask, [np.int32(np.round((corners - [x1, y1]) * scale))], 255)
+    png = cv2.imencode(".png", mask)[1].tobytes()
+    return [{
+        "box_2d": [int(y1 / height * 1000), int(x1 / width * 1000),
+                   int(np.ceil(y2 / height * 1000)), int(np.ceil(x2 / width * 1000))],
+        "mask": "data:image/png;base64," + base64.b64encode(png).decode("ascii"),
+        "label": "door",
+    }]
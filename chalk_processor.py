@@ -2,12 +2,25 @@ import os
 import io
 import json
 import base64
+import hashlib
+import threading
+import contextlib
 import numpy as np
 import cv2
 from PIL import Image, ImageOps
-from google import genai
 from google.genai import types
 
+from cache import DiskCache
+from profiling import track_peak_memory
+from metrics import InstrumentedExecutor
+from model_gateway import generate_content, gemini_slots
+from image_io import open_image, hash_source
+from segmentation import (
+    SegmentationBackend, LocalSegmentation, CascadeSegmentation, order_corners, score_mask,
+    refine_corners, load_detection_image, quad_item,
+)
+from room_store import room_store
+
 def parse_json(json_output: str):
     """Clean markdown formatting from JSON string."""
     lines = json_output.splitlines()
@@ -18,107 +31,308 @@ def parse_json(json_output: str):
             return output.strip()
     return json_output.strip()
 
-def get_gemini_segmentation(image_bytes, api_key):
+# Every door is warped to this (width, height) before chalk extraction
+WARP_SIZE = (1200, 2800)
+
+# "reduced" decodes only what the warp needs; "full" decodes the whole photo
+EXTRACTION_MODE = os.environ.get("EXTRACTION_MODE", "reduced")
+
+# Longest side of the raster segmentation candidates are scored on
+SCORE_SIZE = 256
+# Two candidates overlapping by more than this share of the smaller one's
+# box are the same door (or a door and its frame)
+DOOR_OVERLAP = 0.5
+
+# Snap the door corners to the photo's edges before warping. The search
+# reaches this many pixels of a 1024px thumbnail (the mask's resolution)
+# either side of each coarse side.
+CORNER_REFINEMENT = os.environ.get("CORNER_REFINEMENT", "true").lower() in ("1", "true", "yes")
+CORNER_REFINE_RADIUS = float(os.environ.get("CORNER_REFINE_RADIUS", "4"))
+
+# Rows per strip for tiled chalk extraction (0 = whole frame at once), and
+# the threads strips are spread over
+EXTRACT_STRIP_ROWS = int(os.environ.get("EXTRACT_STRIP_ROWS", "0"))
+EXTRACT_THREADS = int(os.environ.get("EXTRACT_THREADS", "4"))
+
+# "gemini", "local" (classical CV only) or "auto" (local, Gemini when unsure)
+SEGMENTATION_BACKEND = os.environ.get("SEGMENTATION_BACKEND", "gemini")
+
+SEGMENTATION_MODEL = "gemini-2.5-flash"
+SEGMENTATION_PROMPT = """
+    Give the segmentation masks for the door excluding the doorframe.
+    Output a JSON list of segmentation masks where each entry contains the 2D
+    bounding box in the key "box_2d", the segmentation mask in key "mask", and
+    the text label in the key "label". Use descriptive labels.
     """
-    Sends image to Gemini to get the door segmentation mask.
-    Returns the bounding box coordinates and the mask as a numpy array.
+
+def _build_segmentation_cache():
+    path = os.environ.get("SEGMENTATION_CACHE_PATH", ".cache/segmentation.db")
+    if not path or path.lower() == "off":
+        return None
+    max_mb = float(os.environ.get("SEGMENTATION_CACHE_MAX_MB", "256"))
+    return DiskCache(path, max_bytes=int(max_mb * 1024 * 1024))
+
+# On-disk cache of Gemini segmentation results (box_2d + PNG mask per item)
+segmentation_cache = _build_segmentation_cache()
+
+def segmentation_cache_key(image, prompt=SEGMENTATION_PROMPT, model=SEGMENTATION_MODEL):
+    image_hash = hash_source(image)
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{model}:{prompt_hash[:16]}:{image_hash}"
+
+def request_segmentation(im, api_key):
+    """
+    Calls Gemini on a downscaled copy of `im` and returns the parsed items.
     """
-    client = genai.Client(api_key=api_key)
-    
-    # Load image from bytes
-    im = Image.open(io.BytesIO(image_bytes))
-    im = ImageOps.exif_transpose(im)
-    
     # Resize for API efficiency, keep original for final processing
     # We process on a copy to match the notebook's logic
     process_im = im.copy()
     process_im.thumbnail([1024, 1024], Image.Resampling.LANCZOS)
-    
-    prompt = """
-    Give the segmentation masks for the door excluding the doorframe.
-    Output a JSON list of segmentation masks where each entry contains the 2D
-    bounding box in the key "box_2d", the segmentation mask in key "mask", and
-    the text label in the key "label". Use descriptive labels.
-    """
 
     config = types.GenerateContentConfig(
         thinking_config=types.ThinkingConfig(thinking_budget=0)
     )
 
-    try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[prompt, process_im],
-            config=config
+    # Only the request takes a Gemini slot; decoding, warping and a local or
+    # room-aligned segmentation never do
+    with gemini_slots:
+        response = generate_content(
+            api_key, SEGMENTATION_MODEL, [SEGMENTATION_PROMPT, process_im], config=config, operation="segmentation"
         )
-        
-        parsed_json = parse_json(response.text)
-        items = json.loads(parsed_json)
-        
-        if not items:
-            raise ValueError("Gemini returned no items.")
-            
-        # Get the first item (assuming it's the door)
-        item = items[0]
-        
-        # --- Process Mask ---
+
+    parsed_json = parse_json(response.text)
+    items = json.loads(parsed_json)
+
+    if not items:
+        raise ValueError("Gemini returned no items.")
+
+    # Keep only what mask decoding needs; the PNG masks are already compact
+    return [
+        {"box_2d": item["box_2d"], "mask": item.get("mask"), "label": item.get("label")}
+        for item in items
+    ]
+
+def get_segmentation_items(image, api_key, im=None):
+    """
+    Returns Gemini's segmentation items for an image, from the disk cache when
+    possible. `im` is the oriented image to send; if not given, a reduced
+    JPEG decode is used since the model only sees a 1024px thumbnail anyway.
+    """
+    cache_key = segmentation_cache_key(image)
+    if segmentation_cache is not None:
+        cached = segmentation_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+    if im is None:
+        im = open_image(image)
+        im.draft("RGB", (1024, 1024))
+        im = ImageOps.exif_transpose(im)
+
+    items = request_segmentation(im, api_key)
+    if segmentation_cache is not None:
+        segmentation_cache.set(cache_key, json.dumps(items).encode("utf-8"))
+    return items
+
+def item_box(item, width, height):
+    """
+    Denormalizes an item's box_2d (0-1000, y/x order) to clamped pixel
+    coordinates (x1, y1, x2, y2) on a width x height image.
+    """
+    box = item["box_2d"] # Normalized 0-1000
+    y1 = int(box[0] / 1000 * height)
+    x1 = int(box[1] / 1000 * width)
+    y2 = int(box[2] / 1000 * height)
+    x2 = int(box[3] / 1000 * width)
+
+    # Safety clamp
+    x1, y1 = max(0, x1), max(0, y1)
+    x2, y2 = min(width, x2), min(height, y2)
+    return x1, y1, x2, y2
+
+PNG_MASK_PREFIX = "data:image/png;base64,"
+
+def is_png_mask(mask_data):
+    return bool(mask_data) and isinstance(mask_data, str) and mask_data.startswith(PNG_MASK_PREFIX)
+
+def open_png_mask(mask_data):
+    """
+    Decodes an item's base64 PNG mask to a grayscale PIL image.
+    """
+    mask_bytes = base64.b64decode(mask_data.removeprefix(PNG_MASK_PREFIX))
+    mask_pil = Image.open(io.BytesIO(mask_bytes))
+    return mask_pil if mask_pil.mode == "L" else mask_pil.convert("L")
+
+def decode_native_mask(item):
+    """
+    An item's PNG mask as a 0/255 array covering its box at the resolution
+    the model sent it, or None if it has no PNG mask.
+    """
+    if not is_png_mask(item.get("mask")):
+        return None
+    mask = np.array(open_png_mask(item["mask"]))
+    cv2.threshold(mask, 128, 255, cv2.THRESH_BINARY, dst=mask)
+    return mask
+
+def decode_item_mask(item, width, height, region=None):
+    """
+    Rasterizes an item's mask (or its polygon, from the local backend) for a
+    width x height image. With `region` (x1, y1, x2, y2) only that window of
+    the mask is allocated and returned.
+    """
+    x1, y1, x2, y2 = item_box(item, width, height)
+    box_w, box_h = x2 - x1, y2 - y1
+    rx1, ry1, rx2, ry2 = region or (0, 0, width, height)
+
+    mask_data = item.get("mask")
+    full_mask = np.zeros((ry2 - ry1, rx2 - rx1), dtype=np.uint8)
+
+    if item.get("polygon"):
+        # [y, x] pairs normalized 0-1000, like box_2d
+        polygon = np.array(item["polygon"], dtype=np.float64)
+        pts = np.stack([polygon[:, 1] / 1000 * width - rx1, polygon[:, 0] / 1000 * height - ry1], axis=1)
+        cv2.fillPoly(full_mask, [np.int32(np.round(pts))], 255)
+
+    elif is_png_mask(mask_data):
+        # Resize mask to fit the absolute bounding box on the image
+        mask_pil = open_png_mask(mask_data).resize((box_w, box_h), resample=Image.Resampling.NEAREST)
+
+        # Place on full mask, normalized to 0 or 255
+        mask_crop = np.asarray(mask_pil)
+        cv2.threshold(mask_crop, 128, 255, cv2.THRESH_BINARY, dst=full_mask[y1 - ry1:y2 - ry1, x1 - rx1:x2 - rx1])
+
+    else:
+        # Fallback: Create rectangular mask from box if no precise mask returned
+        full_mask[y1 - ry1:y2 - ry1, x1 - rx1:x2 - rx1] = 255
+
+    return full_mask
+
+def rank_candidates(items, width, height):
+    """
+    Every segmentation item with its door "score" (see score_mask) for a
+    width x height photo, best first. Ties keep the backend's order.
+    """
+    scale = min(1.0, SCORE_SIZE / max(width, height))
+    score_w, score_h = max(1, round(width * scale)), max(1, round(height * scale))
+    ranked = []
+    for item in items:
+        score, details = score_mask(decode_item_mask(item, score_w, score_h))
+        ranked.append({**item, "score": round(score, 3), "geometry": details})
+    return sorted(ranked, key=lambda item: -item["score"])
+
+def _box_overlap(a, b):
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return ix * iy / max(1, smaller)
+
+def select_doors(candidates, width, height, max_doors=1, min_score=0.0):
+    """
+    The best candidate, plus up to max_doors - 1 more scoring at least
+    `min_score` that don't overlap one already picked.
+    """
+    doors, boxes = [], []
+    for item in candidates:
+        if len(doors) == max_doors:
+            break
+        box = item_box(item, width, height)
+        if doors and (item["score"] < min_score or any(_box_overlap(box, b) > DOOR_OVERLAP for b in boxes)):
+            continue
+        doors.append(item)
+        boxes.append(box)
+    return doors
+
+class GeminiSegmentation(SegmentationBackend):
+    """
+    Door segmentation by Gemini, cached on disk by image hash, prompt and model.
+    """
+    name = "gemini"
+
+    def segment(self, image, api_key=None, im=None):
+        return get_segmentation_items(image, api_key, im=im)
+
+def build_segmentation_backend(name):
+    if name == "gemini":
+        return GeminiSegmentation()
+    if name == "local":
+        return LocalSegmentation()
+    if name == "auto":
+        return CascadeSegmentation(LocalSegmentation(), GeminiSegmentation())
+    raise ValueError(f"Unknown segmentation backend: {name}")
+
+segmentation_backend = build_segmentation_backend(SEGMENTATION_BACKEND)
+
+def get_gemini_segmentation(image, api_key):
+    """
+    Sends image to Gemini to get the door segmentation mask.
+    Returns the bounding box coordinates and the mask as a numpy array.
+    Results are cached on disk by image hash, prompt and model.
+    """
+    # Load image from bytes
+    im = open_image(image)
+    im = ImageOps.exif_transpose(im)
+
+    try:
+        items = get_segmentation_items(image, api_key, im=im)
+
         # We need to map the mask back to the ORIGINAL image size
         orig_w, orig_h = im.size
-        proc_w, proc_h = process_im.size
-        
-        box = item["box_2d"] # Normalized 0-1000
-        
-        # Denormalize to ORIGINAL dimensions
-        y1 = int(box[0] / 1000 * orig_h)
-        x1 = int(box[1] / 1000 * orig_w)
-        y2 = int(box[2] / 1000 * orig_h)
-        x2 = int(box[3] / 1000 * orig_w)
-        
-        # Safety clamp
-        x1, y1 = max(0, x1), max(0, y1)
-        x2, y2 = min(orig_w, x2), min(orig_h, y2)
-        box_w, box_h = x2 - x1, y2 - y1
-        
-        mask_data = item.get("mask")
-        full_mask = np.zeros((orig_h, orig_w), dtype=np.uint8)
-
-        if mask_data and isinstance(mask_data, str) and mask_data.startswith("data:image/png;base64,"):
-            # Decode base64 mask
-            png_str = mask_data.removeprefix("data:image/png;base64,")
-            mask_bytes = base64.b64decode(png_str)
-            mask_pil = Image.open(io.BytesIO(mask_bytes))
-            
-            # Resize mask to fit the absolute bounding box on the ORIGINAL image
-            mask_pil = mask_pil.resize((box_w, box_h), resample=Image.Resampling.NEAREST)
-            mask_crop = np.array(mask_pil)
-            
-            # Place on full mask
-            full_mask[y1:y2, x1:x2] = mask_crop
-            
-            # If mask is boolean/grayscale, ensure it's binary 0-255
-            if len(full_mask.shape) > 2:
-                full_mask = cv2.cvtColor(full_mask, cv2.COLOR_RGB2GRAY)
-            # Normalize to 0 or 255
-            full_mask = np.where(full_mask > 128, 255, 0).astype(np.uint8)
 
-        else:
-            # Fallback: Create rectangular mask from box if no precise mask returned
-            full_mask[y1:y2, x1:x2] = 255
-
-        return im, full_mask
+        # Take the most door-like item (not necessarily the first)
+        item = rank_candidates(items, orig_w, orig_h)[0]
+        return im, decode_item_mask(item, orig_w, orig_h)
 
     except Exception as e:
         print(f"Error in Gemini segmentation: {e}")
         raise e
 
-def process_image(image_bytes, gemini_api_key):
-    # 1. Get Image and Mask
-    pil_img, mask = get_gemini_segmentation(image_bytes, gemini_api_key)
-    
-    # Convert PIL to OpenCV (BGR)
-    img_cv = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-    
-    # 2. Find Contours & Corners (Automated)
+def oriented_size(im):
+    """
+    (width, height) of an opened, not yet decoded photo once EXIF-rotated.
+    """
+    # EXIF orientations 5-8 swap width and height
+    orientation = im.getexif().get(0x0112, 1)
+    width, height = im.size
+    return (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+
+def load_door_region(image, item, out_size=WARP_SIZE, margin=0.05):
+    """
+    Decodes only as much of the photo as the warp needs: a JPEG draft decode
+    at the smallest scale that still gives the door box at least `out_size`
+    pixels, then a crop to the (padded) door box before colour conversion.
+    Returns (BGR crop, crop region in decoded coordinates, decoded size, scale).
+    """
+    im = open_image(image)
+    stored_w, stored_h = im.size
+    oriented_w, oriented_h = oriented_size(im)
+
+    x1, y1, x2, y2 = item_box(item, oriented_w, oriented_h)
+    out_w, out_h = out_size
+    scale = min(1.0, max(out_w / max(1, x2 - x1), out_h / max(1, y2 - y1)))
+    if scale < 1.0:
+        im.draft("RGB", (int(np.ceil(stored_w * scale)), int(np.ceil(stored_h * scale))))
+
+    im = ImageOps.exif_transpose(im)
+    width, height = im.size
+    scale = width / oriented_w
+
+    # Pad the box so corners from minAreaRect that stick out still sample real pixels
+    x1, y1, x2, y2 = item_box(item, width, height)
+    pad_x = int((x2 - x1) * margin) + 2
+    pad_y = int((y2 - y1) * margin) + 2
+    region = (max(0, x1 - pad_x), max(0, y1 - pad_y), min(width, x2 + pad_x), min(height, y2 + pad_y))
+
+    crop = im.crop(region)
+    if crop.mode != "RGB":
+        crop = crop.convert("RGB")
+    img_cv = cv2.cvtColor(np.asarray(crop), cv2.COLOR_RGB2BGR)
+    return img_cv, region, (width, height), scale
+
+def find_door_corners(mask):
+    """
+    Finds the door quadrilateral in a binary mask.
+    Returns float32 corners ordered TL, TR, BR, BL.
+    """
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if not contours:
         raise ValueError("No contours found in segmentation mask.")
@@ -135,21 +349,47 @@ def process_image(image_bytes, gemini_api_key):
         box_pts = cv2.boxPoints(rect)
         approx = np.int32(box_pts)
         
-    pts = approx.reshape(4, 2)
-    
-    # 3. Sort Points (TL, TR, BR, BL)
-    # Sort by Y first
-    pts = pts[np.argsort(pts[:, 1])]
-    top = pts[:2]
-    bottom = pts[2:]
-    # Sort top by X, bottom by X
-    top = top[np.argsort(top[:, 0])]
-    bottom = bottom[np.argsort(bottom[:, 0])]
-    # Final order: TL, TR, BR, BL
-    src_pts = np.array([top[0], top[1], bottom[1], bottom[0]], dtype="float32")
-    
-    # 4. Perspective Warp
-    out_w, out_h = 1200, 2800
+    return order_corners(approx)
+
+def mask_corners(mask, box):
+    """
+    Door corners found on a box-local mask at its own resolution, mapped
+    into the image the box (x1, y1, x2, y2) is in: what find_door_corners
+    gives on the mask stretched to fill the box, without rasterizing it.
+    """
+    x1, y1, x2, y2 = box
+    mask_h, mask_w = mask.shape
+    corners = find_door_corners(mask)
+
+    # A mask pixel covers scale_x x scale_y image pixels; each corner sits on
+    # the outer edge of its pixel, as it would on the stretched mask
+    scale = np.array([(x2 - x1) / mask_w, (y2 - y1) / mask_h], dtype=np.float32)
+    outer = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)
+    return ((corners + outer) * scale - outer + np.float32([x1, y1])).astype(np.float32)
+
+def item_corners(item, width, height):
+    """
+    Door corners (TL, TR, BR, BL) of a segmentation item on a width x height
+    image, worked out in the item's own box: from its quad polygon, its PNG
+    mask at native resolution, or failing both its box.
+    """
+    x1, y1, x2, y2 = item_box(item, width, height)
+    if item.get("polygon"):
+        # [y, x] pairs normalized 0-1000, like box_2d
+        polygon = np.array(item["polygon"], dtype=np.float64)
+        if len(polygon) == 4:
+            return order_corners(np.stack([polygon[:, 1] / 1000 * width, polygon[:, 0] / 1000 * height], axis=1))
+        return find_door_corners(decode_item_mask(item, width, height))
+
+    mask = decode_native_mask(item)
+    if mask is not None:
+        return mask_corners(mask, (x1, y1, x2, y2))
+
+    # No precise mask: the box itself
+    return order_corners([[x1, y1], [x2 - 1, y1], [x2 - 1, y2 - 1], [x1, y2 - 1]])
+
+def warp_door(img_cv, src_pts, out_size=WARP_SIZE):
+    out_w, out_h = out_size
     dst_pts = np.array([
         [0, 0],
         [out_w - 1, 0],
@@ -157,49 +397,295 @@ def process_image(image_bytes, gemini_api_key):
         [0, out_h - 1]], dtype="float32")
         
     M = cv2.getPerspectiveTransform(src_pts, dst_pts)
-    warped_img = cv2.warpPerspective(img_cv, M, (out_w, out_h))
-    
-    # 5. Extract Chalk (Top-Hat)
-    gray = cv2.cvtColor(warped_img, cv2.COLOR_BGR2GRAY)
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
-    tophat_gray = cv2.morphologyEx(gray, cv2.MORPH_TOPHAT, kernel)
-    
-    # Otsu Binary Mask
-    _, binary_mask = cv2.threshold(tophat_gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    
-    # Cleanup noise
-    clean_kernel = np.ones((2, 2), np.uint8)
-    binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_OPEN, clean_kernel)
-    
-    # 6. Enhance Mask (Dilation + Closing)
-    # Dilation
-    dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2, 2))
-    enhanced_mask = cv2.dilate(binary_mask, dilate_kernel, iterations=2)
-    
-    # Closing
-    close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2, 2))
-    enhanced_mask = cv2.morphologyEx(enhanced_mask, cv2.MORPH_CLOSE, close_kernel)
-    
-    # 7. Extract Colored Chalk
-    enhanced_chalk = cv2.bitwise_and(warped_img, warped_img, mask=enhanced_mask)
-    
-    # 8. Saturation Boost
-    # Convert to HSV
-    hsv = cv2.cvtColor(enhanced_chalk, cv2.COLOR_BGR2HSV).astype(np.float32)
-    h, s, v = cv2.split(hsv)
-    
-    # Boost
-    s = s * 1.25
-    s = np.clip(s, 0, 255)
-    v = v * 1.2
-    v = np.clip(v, 0, 255)
-    
-    hsv_boosted = cv2.merge([h, s, v]).astype(np.uint8)
-    final_img = cv2.cvtColor(hsv_boosted, cv2.COLOR_HSV2BGR)
-    
-    # Encode to bytes for upload
-    is_success, buffer = cv2.imencode(".jpg", final_img)
-    if not is_success:
-        raise ValueError("Failed to encode processed image.")
-        
-    return io.BytesIO(buffer).read()
+    return cv2.warpPerspective(img_cv, M, (out_w, out_h))
+
+# Chalk mask morphology. The original chain was: open (2x2 ones), dilate
+# (2x2 ellipse) twice, close (2x2 ellipse). Every dilation there shifts
+# values towards higher x/y only, so the four dilations compose exactly into
+# one 5x5 kernel anchored at its bottom-right corner (x + y >= 3).
+TOPHAT_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
+CLEAN_KERNEL = np.ones((2, 2), np.uint8)
+CLOSE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2, 2))
+GROW_KERNEL = (np.add.outer(np.arange(5), np.arange(5)) >= 3).astype(np.uint8)
+GROW_ANCHOR = (4, 4)
+
+# Saturation x1.25 and value x1.2 as one table lookup, clipped and truncated
+# exactly like the float32 multiply + astype(uint8) it replaces; hue passes through
+_levels = np.arange(256, dtype=np.float32)
+BOOST_LUT = cv2.merge([
+    np.arange(256, dtype=np.uint8),
+    np.clip(_levels * 1.25, 0, 255).astype(np.uint8),
+    np.clip(_levels * 1.2, 0, 255).astype(np.uint8),
+]).reshape(1, 256, 3)
+
+_scratch_local = threading.local()
+_scratch_stats = {"allocations": 0, "releases": 0}
+
+def scratch(name, shape, dtype=np.uint8):
+    """
+    A per-thread working array of `shape`, carved out of storage that only
+    grows until scratch_scope() releases it, so the doors of one job (and
+    strips of any height) stop allocating frames.
+    """
+    pool = getattr(_scratch_local, "pool", None)
+    if pool is None:
+        pool = _scratch_local.pool = {}
+    size = int(np.prod(shape))
+    buf = pool.get(name)
+    if buf is None or buf.size < size or buf.dtype != dtype:
+        buf = pool[name] = np.empty(size, dtype)
+        _scratch_stats["allocations"] += 1
+    return buf[:size].reshape(shape)
+
+def scratch_stats():
+    return dict(_scratch_stats)
+
+@contextlib.contextmanager
+def scratch_scope():
+    """
+    Frees this thread's scratch buffers when the block ends, so an idle
+    pipeline or worker thread doesn't keep a frame's worth (about 9 bytes
+    per pixel) allocated between jobs. Strip workers only ever hold
+    strip-sized buffers and keep them.
+    """
+    try:
+        yield
+    finally:
+        if getattr(_scratch_local, "pool", None):
+            _scratch_local.pool = {}
+            _scratch_stats["releases"] += 1
+
+def chalk_mask(warped_img, out=None):
+    """
+    Binary mask of the chalk strokes: top-hat, Otsu threshold and cleanup.
+    Written into `out` if given.
+    """
+    shape = warped_img.shape[:2]
+    gray = scratch("gray", shape)
+    work = scratch("work", shape)
+    out = np.empty(shape, np.uint8) if out is None else out
+
+    # Extract Chalk (Top-Hat), then Otsu Binary Mask
+    cv2.cvtColor(warped_img, cv2.COLOR_BGR2GRAY, dst=gray)
+    cv2.morphologyEx(gray, cv2.MORPH_TOPHAT, TOPHAT_KERNEL, dst=work)
+    cv2.threshold(work, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=work)
+
+    # Cleanup noise and enhance: erode of the open, every dilation at once,
+    # erode of the close
+    cv2.erode(work, CLEAN_KERNEL, dst=gray)
+    cv2.dilate(gray, GROW_KERNEL, dst=work, anchor=GROW_ANCHOR)
+    cv2.erode(work, CLOSE_KERNEL, dst=out)
+    return out
+
+def boost_chalk(warped_img, enhanced_mask, out=None):
+    """
+    Keeps the masked chalk and boosts its saturation and brightness.
+    Written into `out` if given, which may be warped_img itself.
+    """
+    hsv = scratch("hsv", warped_img.shape)
+    boosted = scratch("boosted", warped_img.shape)
+
+    # Boost every pixel in place, then keep the chalk: a masked-out pixel is
+    # black either way, since black stays black through HSV and the boost
+    cv2.cvtColor(warped_img, cv2.COLOR_BGR2HSV, dst=hsv)
+    cv2.LUT(hsv, BOOST_LUT, dst=hsv)
+    cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=boosted)
+
+    result = np.zeros_like(warped_img) if out is None else out
+    if out is not None:
+        result.fill(0)
+    cv2.bitwise_and(boosted, boosted, dst=result, mask=enhanced_mask)
+    return result
+
+# Rows a strip needs beyond its own: the 15x15 top-hat reads 7 + 7 rows
+# either way; the mask cleanup only reads upwards, 1 + 4 + 1 rows
+TOPHAT_HALO = 14
+MASK_HALO = 6
+
+extract_executor = InstrumentedExecutor(max_workers=EXTRACT_THREADS, thread_name_prefix="extract", name="extract")
+
+def otsu_threshold(hist):
+    """
+    Otsu's threshold for a 256-bin histogram, the same search (and the same
+    float rounding) as cv2.threshold's THRESH_OTSU does over an image.
+    """
+    hist = np.asarray(hist, dtype=np.float64).ravel()
+    scale = 1.0 / hist.sum()
+    mu = float(np.dot(np.arange(256), hist)) * scale
+    mu1 = q1 = 0.0
+    max_sigma = max_val = 0.0
+    eps = float(np.finfo(np.float32).eps)
+    for i in range(256):
+        p_i = hist[i] * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1.0 - eps:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma, max_val = sigma, i
+    return max_val
+
+def _strip_tophat(warped_img, tophat, y0, y1):
+    """
+    Top-hat of rows y0:y1 into `tophat`, computed with a halo so the strip
+    edges match the whole-frame result. Returns the strip's histogram.
+    """
+    top, bottom = max(0, y0 - TOPHAT_HALO), min(warped_img.shape[0], y1 + TOPHAT_HALO)
+    shape = (bottom - top, warped_img.shape[1])
+    gray = scratch("strip_gray", shape)
+    work = scratch("strip_tophat", shape)
+    cv2.cvtColor(warped_img[top:bottom], cv2.COLOR_BGR2GRAY, dst=gray)
+    cv2.morphologyEx(gray, cv2.MORPH_TOPHAT, TOPHAT_KERNEL, dst=work)
+    tophat[y0:y1] = work[y0 - top:y1 - top]
+    return cv2.calcHist([tophat[y0:y1]], [0], None, [256], [0, 256])
+
+def _strip_extract(warped_img, tophat, threshold, out, y0, y1):
+    """
+    Mask and boost of rows y0:y1, written to out[y0:y1].
+    """
+    top = max(0, y0 - MASK_HALO)
+    shape = (y1 - top, warped_img.shape[1])
+    work = scratch("strip_work", shape)
+    clean = scratch("strip_clean", shape)
+    cv2.threshold(tophat[top:y1], threshold, 255, cv2.THRESH_BINARY, dst=work)
+    cv2.erode(work, CLEAN_KERNEL, dst=clean)
+    cv2.dilate(clean, GROW_KERNEL, dst=work, anchor=GROW_ANCHOR)
+    cv2.erode(work, CLOSE_KERNEL, dst=clean)
+    boost_chalk(warped_img[y0:y1], clean[y0 - top:], out=out[y0:y1])
+
+def extract_chalk_strips(warped_img, strip_rows, out=None, executor=None):
+    """
+    extract_chalk in horizontal strips spread over `executor`: a top-hat and
+    histogram pass, Otsu over the whole histogram, then mask and boost per
+    strip. Only the top-hat plane and `out` (which may be warped_img itself)
+    are full-frame. Identical to the whole-frame result.
+    """
+    executor = executor or extract_executor
+    height = warped_img.shape[0]
+    out = np.empty_like(warped_img) if out is None else out
+    strips = [(y0, min(height, y0 + strip_rows)) for y0 in range(0, height, strip_rows)]
+
+    tophat = np.empty(warped_img.shape[:2], np.uint8)
+    hists = executor.map(lambda strip: _strip_tophat(warped_img, tophat, *strip), strips)
+    threshold = otsu_threshold(np.sum(list(hists), axis=0, dtype=np.float64))
+
+    # Every strip's top-hat is done before any strip writes to `out`
+    list(executor.map(lambda strip: _strip_extract(warped_img, tophat, threshold, out, *strip), strips))
+    return out
+
+def extract_chalk(warped_img, out=None, strip_rows=None):
+    """
+    Isolates chalk strokes on the warped door and boosts their colour.
+    The result goes to `out` if given, which may be warped_img itself.
+    """
+    strip_rows = EXTRACT_STRIP_ROWS if strip_rows is None else strip_rows
+    if strip_rows and strip_rows < warped_img.shape[0]:
+        return extract_chalk_strips(warped_img, strip_rows, out=out)
+    mask = chalk_mask(warped_img, out=scratch("mask", warped_img.shape[:2]))
+    return boost_chalk(warped_img, mask, out=out)
+
+def align_room(image, room_id, im=None):
+    """
+    Looks for the last scan of `room_id` in the room store and, if the new
+    photo aligns with it, returns a door item from the carried-over corners
+    (source "room"). Returns (item or None, detection image to remember the
+    scan by, or None without a store).
+    """
+    if not room_id or room_store is None:
+        return None, None
+    gray = load_detection_image(image, im=im)
+    corners, score = room_store.align(room_id, gray)
+    if corners is None:
+        return None, gray
+    height, width = gray.shape
+    print(f"[{room_id}] Aligned with the room's last scan (inliers {score:.0%}), skipping segmentation")
+    return {**quad_item(corners, width, height, score), "source": "room"}, gray
+
+def process_doors(image, gemini_api_key, mode=None, stats=None, backend=None, max_doors=1, min_score=0.0, room_id=None):
+    """
+    Segments the photo once, ranks every candidate the backend returned
+    and extracts the chalk of the best door, plus (with max_doors > 1)
+    every other distinct door scoring at least `min_score`.
+    Returns the extracted JPEGs, best door first.
+    `image` is the raw upload as bytes or a path to it on disk.
+
+    With `room_id`, a photo that aligns with that room's last scan reuses
+    its door corners instead of being segmented, and the best door's
+    corners are stored for the next scan.
+
+    mode "reduced" (default) decodes the JPEG at the smallest scale the warp
+    needs and converts only each door's region; "full" decodes and converts
+    the whole frame. `backend` overrides the configured segmentation backend.
+    Pass a dict as `stats` to receive the decode scale, the segmentation
+    used, the candidates' scores and the job's peak memory.
+    """
+    mode = mode or EXTRACTION_MODE
+    backend = backend or segmentation_backend
+    extracted = []
+    with track_peak_memory() as mem, scratch_scope():
+        # 1. Get Image and candidate masks (or the room's last corners)
+        if mode == "full":
+            pil_img = ImageOps.exif_transpose(open_image(image))
+            room_item, room_gray = align_room(image, room_id, im=pil_img)
+            items = [room_item] if room_item else backend.segment(image, gemini_api_key, im=pil_img)
+            width, height = pil_img.size
+            img_cv = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+            del pil_img
+        else:
+            room_item, room_gray = align_room(image, room_id)
+            items = [room_item] if room_item else backend.segment(image, gemini_api_key)
+            width, height = oriented_size(open_image(image))
+        candidates = rank_candidates(items, width, height)
+        doors = select_doors(candidates, width, height, max_doors, min_score)
+
+        for n, item in enumerate(doors):
+            # 2. Find Corners in the item's own box (Automated), snapped to the edges
+            if mode == "full":
+                door_cv, scale, region, (w, h) = img_cv, 1.0, (0, 0, width, height), (width, height)
+            else:
+                door_cv, region, (w, h), scale = load_door_region(image, item)
+            src_pts = item_corners(item, w, h) - np.float32(region[:2])
+            if CORNER_REFINEMENT:
+                src_pts = refine_corners(door_cv, src_pts, CORNER_REFINE_RADIUS * max(w, h) / 1024)
+            if n == 0 and room_gray is not None:
+                room_store.remember(room_id, room_gray, src_pts + np.float32(region[:2]), (w, h))
+
+            # 3. Perspective Warp
+            warped_img = warp_door(door_cv, src_pts)
+            del door_cv
+
+            # 4. Extract Chalk (in place: the warp is not needed afterwards)
+            final_img = extract_chalk(warped_img, out=warped_img)
+
+            # Encode to bytes for upload
+            is_success, buffer = cv2.imencode(".jpg", final_img)
+            if not is_success:
+                raise ValueError("Failed to encode processed image.")
+            extracted.append(buffer.tobytes())
+
+    item = doors[0]
+    segmentation = item.get("source", "gemini")
+    print(
+        f"process_image ({mode}, {segmentation} segmentation, decode scale {scale:.2f}): "
+        f"{len(extracted)} of {len(candidates)} candidates (best score {item['score']:.2f}), "
+        f"peak memory +{mem.peak_bytes / 2**20:.1f} MB"
+    )
+    if stats is not None:
+        stats.update({
+            "mode": mode, "decode_scale": scale, "peak_memory_bytes": mem.peak_bytes,
+            "segmentation": segmentation, "segmentation_confidence": item.get("confidence"),
+            "candidates": len(candidates), "candidate_scores": [c["score"] for c in candidates],
+            "doors": len(extracted),
+        })
+    return extracted
+
+def process_image(image, gemini_api_key, mode=None, stats=None, backend=None, room_id=None):
+    """
+    Segments the door, warps it to WARP_SIZE and extracts the chalk of the
+    best-scoring candidate (see process_doors). Returns the JPEG bytes.
+    """
+    return process_doors(image, gemini_api_key, mode=mode, stats=stats, backend=backend, room_id=room_id)[0]
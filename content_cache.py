@@ -0,0 +1,82 @@
+import os
+import threading
+
+from cache import LRUCache
+from image_io import hash_source
+from supabase_client import get_scan_by_content_hash
+
+# Fields copied from a finished scan onto a new scan of the same image
+ARTIFACT_FIELDS = ("original_url", "processed_url", "ugly_url", "pretty_url", "slop_text", "derivatives")
+
+def hash_image(image):
+    """
+    Content address for an uploaded image (hex SHA-256 of the raw bytes).
+    Accepts the bytes or a path to them.
+    """
+    return hash_source(image)
+
+def shared_artifacts(record):
+    """
+    The ARTIFACT_FIELDS of a finished scan, ready to copy onto another scan.
+    Derivative objects are stored under the scan that made them, so the
+    copied spec keeps that scan's id.
+    """
+    artifacts = {field: record.get(field) for field in ARTIFACT_FIELDS}
+    if artifacts["derivatives"] and record.get("id"):
+        artifacts["derivatives"] = {"scan_id": record["id"], **artifacts["derivatives"]}
+    return artifacts
+
+class ContentCache:
+    """
+    Maps image content hashes to the artifacts of a completed scan.
+
+    Two tiers: an in-memory LRU in front of the chalk_scans table, which
+    is the persistent tier (completed rows carry their `content_hash`).
+    """
+    def __init__(self, maxsize=2048):
+        self.memory = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def lookup(self, content_hash):
+        """
+        Returns {field: value} for a completed scan of this image, or None.
+        """
+        artifacts = self.memory.get(content_hash)
+        if artifacts is not None:
+            return artifacts
+
+        record = get_scan_by_content_hash(content_hash)
+        if not record or not record.get("processed_url"):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        artifacts = shared_artifacts(record)
+        self.memory.set(content_hash, artifacts)
+        with self._lock:
+            self.persistent_hits += 1
+        return artifacts
+
+    def remember(self, content_hash, record):
+        """
+        Puts a just-completed scan's artifacts in the memory tier, so the next
+        upload of the same image skips the database too.
+        """
+        self.memory.set(content_hash, shared_artifacts(record))
+
+    def stats(self):
+        memory = self.memory.stats()
+        with self._lock:
+            persistent_hits, misses = self.persistent_hits, self.misses
+        lookups = memory["hits"] + persistent_hits + misses
+        return {
+            "memory_hits": memory["hits"],
+            "persistent_hits": persistent_hits,
+            "misses": misses,
+            "hit_ratio": (memory["hits"] + persistent_hits) / lookups if lookups else 0.0,
+            "memory_size": memory["size"],
+        }
+
+content_cache = ContentCache(maxsize=int(os.environ.get("CONTENT_CACHE_SIZE", "2048")))
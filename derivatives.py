@@ -0,0 +1,125 @@
+import io
+import os
+import cv2
+import numpy as np
+from PIL import Image
+
+from image_io import read_source
+from supabase_client import get_public_url
+
+def _parse_sizes(value):
+    sizes = {}
+    for item in value.split(","):
+        name, width = item.split(":")
+        sizes[name.strip()] = int(width)
+    return sizes
+
+# name:width pairs; heights keep the aspect ratio
+DERIVATIVE_SIZES = _parse_sizes(os.environ.get("DERIVATIVE_SIZES", "thumb:240,medium:600,full:1200"))
+# Any of jpeg, webp, avif. AVIF is much smaller but takes seconds per full-size image.
+DERIVATIVE_FORMATS = [f.strip() for f in os.environ.get("DERIVATIVE_FORMATS", "jpeg,webp").split(",") if f.strip()]
+
+EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp", "avif": ".avif"}
+QUALITY = {
+    "jpeg": int(os.environ.get("DERIVATIVE_JPEG_QUALITY", "80")),
+    "webp": int(os.environ.get("DERIVATIVE_WEBP_QUALITY", "78")),
+    "avif": int(os.environ.get("DERIVATIVE_AVIF_QUALITY", "55")),
+}
+
+# Frontend field -> artifact name used in derivative paths
+ARTIFACTS = {"chalkImage": "chalk", "uglifyImage": "ugly", "prettifyImage": "pretty"}
+ARTIFACT_URL_FIELDS = {"chalk": "processed_url", "ugly": "ugly_url", "pretty": "pretty_url"}
+
+def derivative_spec(widths=None):
+    """
+    What this server generates, stored on the scan so its URLs can be rebuilt
+    even after the configuration changes. `widths` ({artifact: {size: width}},
+    from derivative_widths) records the sizes each artifact really got.
+    """
+    spec = {"sizes": dict(DERIVATIVE_SIZES), "formats": list(DERIVATIVE_FORMATS)}
+    if widths is not None:
+        spec["widths"] = widths
+    return spec
+
+def derivative_widths(source_width, sizes=None):
+    """
+    {size: width} actually produced from an image `source_width` pixels
+    wide. Nothing is upscaled: sizes up to the source keep their width, the
+    smallest size above it gets the source width and larger ones are skipped.
+    """
+    widths = {}
+    for size, width in sorted((sizes or DERIVATIVE_SIZES).items(), key=lambda item: item[1]):
+        if width >= source_width:
+            widths[size] = source_width
+            break
+        widths[size] = width
+    return widths
+
+def derivative_name(scan_id, artifact, size, fmt):
+    return f"{scan_id}/{artifact}_{size}{EXTENSIONS[fmt]}"
+
+def encode(img, fmt):
+    if fmt == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, QUALITY["jpeg"], cv2.IMWRITE_JPEG_PROGRESSIVE, 1, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+        return cv2.imencode(".jpg", img, params)[1].tobytes()
+    if fmt == "webp":
+        return cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, QUALITY["webp"]])[1].tobytes()
+    if fmt == "avif":
+        buf = io.BytesIO()
+        Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).save(buf, "AVIF", quality=QUALITY["avif"], speed=8)
+        return buf.getvalue()
+    raise ValueError(f"Unknown derivative format: {fmt}")
+
+def encode_derivatives(image, spec=None):
+    """
+    Decodes `image` (bytes, path or BGR array) once and yields
+    (size, width, format, bytes) for every derivative in `spec` the image is
+    wide enough for (see derivative_widths). Sizes are resized largest
+    first, each from the one before it.
+    """
+    spec = spec or derivative_spec()
+    if isinstance(image, np.ndarray):
+        img = image
+    else:
+        img = cv2.imdecode(np.frombuffer(read_source(image), np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Could not decode image for derivatives")
+
+    h, w = img.shape[:2]
+    current = img
+    for size, width in sorted(derivative_widths(w, spec["sizes"]).items(), key=lambda item: -item[1]):
+        height = max(1, round(h * width / w))
+        if current.shape[1] != width:
+            current = cv2.resize(current, (width, height), interpolation=cv2.INTER_AREA)
+        for fmt in spec["formats"]:
+            yield size, width, fmt, encode(current, fmt)
+
+def srcset_map(record):
+    """
+    {"chalkImage": {"webp": "url 240w, url 600w, ...", "jpeg": ...}, ...} for
+    the artifacts of a scan that have derivatives, or None. A spec with a
+    "scan_id" (copied from another scan of the same photo) points at that
+    scan's objects.
+    """
+    spec = record.get("derivatives")
+    if not spec or not record.get("id"):
+        return None
+    owner = spec.get("scan_id", record["id"])
+    bucket_name = os.environ.get("SUPABASE_BUCKET", "chalk-images")
+    srcsets = {}
+    for field, artifact in ARTIFACTS.items():
+        if not record.get(ARTIFACT_URL_FIELDS[artifact]):
+            continue
+        # Specs written before "widths" existed: every configured size
+        widths = spec["widths"].get(artifact) if "widths" in spec else spec["sizes"]
+        if not widths:
+            continue
+        sizes = sorted(widths.items(), key=lambda item: item[1])
+        srcsets[field] = {
+            fmt: ", ".join(
+                f"{get_public_url(derivative_name(owner, artifact, size, fmt), folder='derivatives', bucket_name=bucket_name)} {width}w"
+                for size, width in sizes
+            )
+            for fmt in spec["formats"]
+        }
+    return srcsets or None
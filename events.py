@@ -0,0 +1,122 @@
+import os
+import queue
+import threading
+from collections import defaultdict
+
+from supabase_client import add_scan_write_listener
+
+# Events buffered per subscriber before the oldest are dropped
+SUBSCRIBER_BUFFER = int(os.environ.get("EVENTS_SUBSCRIBER_BUFFER", "32"))
+
+# Which write fields mark which pipeline stage, when `status` isn't changing
+STAGE_FIELDS = (("ugly_url", "ugly"), ("slop_text", "slop"), ("pretty_url", "pretty"), ("derivatives", "derivatives"))
+
+def stage_events(fields):
+    """
+    Splits a scan write into (stage, fields) events. Coalesced writes can
+    carry several branches' artifacts at once: each gets its own event,
+    followed by the new status (queued, extracted, completed, failed) with
+    the remaining fields. Anything else is one "updated" event.
+    """
+    rest = dict(fields)
+    events = []
+    for field, stage in STAGE_FIELDS:
+        if field in rest:
+            events.append((stage, {field: rest.pop(field)}))
+    if fields.get("status"):
+        events.append((fields["status"], rest))
+    elif not events:
+        events.append(("updated", rest))
+    else:
+        events[-1][1].update(rest)
+    return events
+
+class Subscription:
+    def __init__(self, bus, scan_id, maxsize):
+        self.bus = bus
+        self.scan_id = scan_id
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, event):
+        # Slow client: drop its oldest event rather than block the publisher
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Next event, or None if nothing arrived within `timeout` seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class EventBus:
+    """
+    In-process pub/sub for scan progress. Every subscriber to a scan gets its
+    own bounded buffer, so one slow stream can't hold up the pipeline or
+    the other listeners.
+    """
+    def __init__(self, buffer_size=SUBSCRIBER_BUFFER):
+        self.buffer_size = buffer_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, scan_id, maxsize=None):
+        subscription = Subscription(self, scan_id, maxsize or self.buffer_size)
+        with self._lock:
+            self._subscribers[scan_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.scan_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.scan_id]
+
+    def publish(self, scan_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(scan_id, ()))
+            self.published += 1
+        for subscription in subscribers:
+            subscription.put(event)
+        return len(subscribers)
+
+    def on_write(self, scan_id, fields, created=False):
+        """
+        Scan write listener: publishes every pipeline write as stage events.
+        """
+        for stage, stage_fields in stage_events(fields):
+            self.publish(scan_id, {"stage": stage, "fields": stage_fields})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "scans": len(self._subscribers),
+                "subscribers": sum(len(s) for s in self._subscribers.values()),
+                "published": self.published,
+            }
+
+event_bus = EventBus()
+add_scan_write_listener(event_bus.on_write)
@@ -3,6 +3,7 @@ from PIL import Image
 from scipy.io import wavfile
 import os
 import io
+import functools
 
 def divide_image_into_segments(image_path, num_segments=20):
     """
@@ -35,26 +36,44 @@ def divide_image_into_segments(image_path, num_segments=20):
     
     return brightness_values
 
-def create_bell_sound(frequency, duration, sample_rate=44100, decay=1.5):
+# E pentatonic scale (major) - multiple octaves for better range
+E_PENTATONIC_FREQUENCIES = [
+    164.81,  # E3
+    185.00,  # F#3
+    207.65,  # G#3
+    246.94,  # B3
+    277.18,  # C#4
+    329.63,  # E4
+    369.99,  # F#4
+    415.30,  # G#4
+    493.88,  # B4
+    554.37,  # C#5
+]
+
+# Softer harmonics for a calming sound: (ratio, amplitude)
+BELL_HARMONICS = np.array([
+    (1.0, 1.0),      # Fundamental (pure tone)
+    (2.0, 0.3),      # Octave (gentle)
+    (3.0, 0.15),     # Fifth (subtle)
+    (4.0, 0.08),     # Second octave (very subtle)
+])
+
+# Detuned takes per note in the bank, so repeated notes don't sound identical
+NOTE_VARIANTS = 4
+
+def create_bell_sound(frequency, duration, sample_rate=44100, decay=1.5, detunes=None):
     """
     Create a calming synth-bell sound with soft attack and gentle decay.
+    `detunes` fixes the per-harmonic detuning; random if not given.
     """
     t = np.linspace(0, duration, int(sample_rate * duration))
     
-    # Use softer harmonics for a calming sound
-    # Mostly sine waves with gentle overtones
-    harmonics = [
-        (1.0, 1.0),      # Fundamental (pure tone)
-        (2.0, 0.3),      # Octave (gentle)
-        (3.0, 0.15),     # Fifth (subtle)
-        (4.0, 0.08),     # Second octave (very subtle)
-    ]
-    
-    signal = np.zeros_like(t)
-    for ratio, amplitude in harmonics:
-        # Add slight detuning for warmth (chorus effect)
-        detune = 1.0 + np.random.uniform(-0.002, 0.002)
-        signal += amplitude * np.sin(2 * np.pi * frequency * ratio * detune * t)
+    # Add slight detuning for warmth (chorus effect)
+    if detunes is None:
+        detunes = 1.0 + np.random.uniform(-0.002, 0.002, len(BELL_HARMONICS))
+    ratios, amplitudes = BELL_HARMONICS[:, 0], BELL_HARMONICS[:, 1]
+    phases = np.outer(2 * np.pi * frequency * ratios * detunes, t)
+    signal = amplitudes @ np.sin(phases)
     
     # Soft attack envelope (fade in)
     attack_time = 0.15
@@ -65,15 +84,13 @@ def create_bell_sound(frequency, duration, sample_rate=44100, decay=1.5):
     # Gentle exponential decay
     decay_env = np.exp(-decay * t)
     
-    # Combine envelopes
-    envelope = attack_env * decay_env
-    signal = signal * envelope
-    
     # Add subtle vibrato for warmth
     vibrato_rate = 4.5  # Hz
     vibrato_depth = 0.003
     vibrato = 1 + vibrato_depth * np.sin(2 * np.pi * vibrato_rate * t)
-    signal = signal * vibrato
+    
+    # Combine envelopes
+    signal = signal * (attack_env * decay_env * vibrato)
     
     # Normalize
     if np.max(np.abs(signal)) > 0:
@@ -84,6 +101,38 @@ def create_bell_sound(frequency, duration, sample_rate=44100, decay=1.5):
     
     return signal
 
+@functools.lru_cache(maxsize=4)
+def get_note_bank(note_duration=0.7, sample_rate=44100, variants=NOTE_VARIANTS, seed=0):
+    """
+    Every scale note pre-rendered as int16 PCM, `variants` detuned takes each.
+    Shape (len(E_PENTATONIC_FREQUENCIES), variants, samples). Built once per process.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(sample_rate * note_duration)
+    bank = np.empty((len(E_PENTATONIC_FREQUENCIES), variants, samples), dtype=np.int16)
+    for i, frequency in enumerate(E_PENTATONIC_FREQUENCIES):
+        for v in range(variants):
+            detunes = 1.0 + rng.uniform(-0.002, 0.002, len(BELL_HARMONICS))
+            # Every note peaks at the same level, so normalizing the joined
+            # signal is the same as normalizing each note to full scale
+            note = create_bell_sound(frequency, note_duration, sample_rate, detunes=detunes)
+            bank[i, v] = np.int16(note / np.max(np.abs(note)) * 32767)
+    bank.setflags(write=False)
+    return bank
+
+def synthesize_notes(note_indices, note_duration=0.7, sample_rate=44100):
+    """
+    Joins bank notes (a random detuned take of each) into one int16 signal,
+    written straight into a preallocated buffer.
+    """
+    bank = get_note_bank(note_duration, sample_rate)
+    samples = bank.shape[2]
+    variants = np.random.randint(bank.shape[1], size=len(note_indices))
+    audio_data = np.empty(len(note_indices) * samples, dtype=np.int16)
+    for i, (note_index, variant) in enumerate(zip(note_indices, variants)):
+        audio_data[i * samples:(i + 1) * samples] = bank[note_index, variant]
+    return audio_data
+
 def brightness_to_note_frequency(normalized_index, scale_frequencies):
     """
     Map normalized index to a note frequency from the scale.
@@ -96,20 +145,7 @@ def generate_audio_from_brightness(brightness_values, output_file='output.wav'):
     """
     Generate audio file with bell sounds mapped to E pentatonic scale.
     """
-    # E pentatonic scale (major) - multiple octaves for better range
-    # E4, F#4, G#4, B4, C#5, E5, F#5, G#5
-    e_pentatonic_frequencies = [
-        164.81,  # E3
-        185.00,  # F#3
-        207.65,  # G#3
-        246.94,  # B3
-        277.18,  # C#4
-        329.63,  # E4
-        369.99,  # F#4
-        415.30,  # G#4
-        493.88,  # B4
-        554.37,  # C#5
-    ]
+    e_pentatonic_frequencies = E_PENTATONIC_FREQUENCIES
     
     sample_rate = 44100
     note_duration = 0.7  # Duration of each note in seconds (longer for calming effect)
@@ -145,27 +181,19 @@ def generate_audio_from_brightness(brightness_values, output_file='output.wav'):
     # Randomize the order of notes
     np.random.shuffle(note_indices)
     
-    # Create the full audio signal
-    full_signal = np.array([])
-    
     for i, note_index in enumerate(note_indices):
         # Occasionally randomly adjust by +/-1 note (30% chance)
         if np.random.rand() < 0.3:
             adjustment = np.random.choice([-1, 1])
             note_index = note_index + adjustment
             note_index = max(0, min(note_index, max_note_index))
+        note_indices[i] = note_index
         
         frequency = brightness_to_note_frequency(note_index, e_pentatonic_frequencies)
         print(f"Note {i+1}: Index={note_index}, Frequency={frequency:.2f} Hz")
-        
-        bell_sound = create_bell_sound(frequency, note_duration, sample_rate)
-        full_signal = np.concatenate([full_signal, bell_sound])
     
-    # Normalize the full signal
-    full_signal = full_signal / np.max(np.abs(full_signal))
-    
-    # Convert to 16-bit PCM
-    audio_data = np.int16(full_signal * 32767)
+    # Create the full audio signal as 16-bit PCM from the note bank
+    audio_data = synthesize_notes(note_indices, note_duration, sample_rate)
     
     # Write to WAV file
     wavfile.write(output_file, sample_rate, audio_data)
@@ -197,6 +225,9 @@ def generate_doorbell_wav_from_image(image_bytes):
     """
     # Load image from bytes
     img = Image.open(io.BytesIO(image_bytes))
+    # Band averages don't need full resolution: let JPEG decode at up to 1/4 scale
+    # (1/8 is DC-only and visibly shifts the averages)
+    img.draft('L', (max(1, img.width // 4), max(1, img.height // 4)))
     
     # Convert to grayscale to get brightness values
     img_gray = img.convert('L')
@@ -224,18 +255,7 @@ def generate_doorbell_wav_from_image(image_bytes):
     sample_rate = 44100
     note_duration = 0.7
     
-    e_pentatonic_frequencies = [
-        164.81,  # E3
-        185.00,  # F#3
-        207.65,  # G#3
-        246.94,  # B3
-        277.18,  # C#4
-        329.63,  # E4
-        369.99,  # F#4
-        415.30,  # G#4
-        493.88,  # B4
-        554.37,  # C#5
-    ]
+    e_pentatonic_frequencies = E_PENTATONIC_FREQUENCIES
     
     min_brightness = min(brightness_values)
     max_brightness = max(brightness_values)
@@ -258,20 +278,14 @@ def generate_doorbell_wav_from_image(image_bytes):
     
     np.random.shuffle(note_indices)
     
-    full_signal = np.array([])
-    
-    for note_index in note_indices:
+    for i, note_index in enumerate(note_indices):
         if np.random.rand() < 0.3:
             adjustment = np.random.choice([-1, 1])
             note_index = note_index + adjustment
             note_index = max(0, min(note_index, max_note_index))
-        
-        frequency = brightness_to_note_frequency(note_index, e_pentatonic_frequencies)
-        bell_sound = create_bell_sound(frequency, note_duration, sample_rate)
-        full_signal = np.concatenate([full_signal, bell_sound])
+        note_indices[i] = note_index
     
-    full_signal = full_signal / np.max(np.abs(full_signal))
-    audio_data = np.int16(full_signal * 32767)
+    audio_data = synthesize_notes(note_indices, note_duration, sample_rate)
     
     # Create WAV in memory
     wav_buffer = io.BytesIO()
@@ -0,0 +1,76 @@
+import io
+import os
+import hashlib
+import tempfile
+from PIL import Image
+
+# Uploads are streamed here instead of being held in memory
+SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "chalk-uploads")
+
+CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLarge(ValueError):
+    pass
+
+def is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+def open_image(source):
+    """
+    Lazily opens an image from raw bytes or a file path. Only the header is
+    read until pixels are needed, so callers can still draft/crop cheaply.
+    """
+    return Image.open(source if is_path(source) else io.BytesIO(source))
+
+def read_source(source):
+    if is_path(source):
+        with open(source, "rb") as f:
+            return f.read()
+    return source
+
+def hash_source(source):
+    """
+    Hex SHA-256 of raw bytes or a file's contents, streamed in chunks.
+    """
+    if not is_path(source):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def spool_upload(file_storage, max_bytes):
+    """
+    Streams an uploaded file into SPOOL_DIR while hashing it.
+    Returns (path, sha256 hex, size). Raises UploadTooLarge past `max_bytes`.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix=".upload")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b""):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise UploadTooLarge(f"Upload exceeds {max_bytes // (1024 * 1024)} MB")
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest(), size
+
+def discard_spooled(source):
+    """
+    Deletes `source` if it is a spooled upload. Anything else is left alone.
+    """
+    if not source or not is_path(source):
+        return
+    path = os.path.realpath(source)
+    if os.path.dirname(path) == os.path.realpath(SPOOL_DIR):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import random
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import closing
+
+DEFAULT_VISIBILITY_TIMEOUT = float(os.environ.get("JOB_VISIBILITY_TIMEOUT", "600"))
+DEFAULT_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF = float(os.environ.get("JOB_RETRY_BACKOFF", "10"))
+
+class PermanentJobError(Exception):
+    """
+    A job failure that no retry can fix; the job goes dead at once.
+    """
+
+class JobQueue(ABC):
+    """
+    Interface for durable job queues.
+
+    A claimed job stays invisible to other workers for `visibility_timeout`
+    seconds. If the worker neither acks nor fails it in time (crash, OOM kill),
+    the job becomes visible again and is retried until `max_attempts` is used up.
+
+    Jobs are plain dicts: id, kind, key, payload (dict), data (bytes or None),
+    attempts, max_attempts.
+    """
+    @abstractmethod
+    def enqueue(self, kind, payload, data=None, key=None, max_attempts=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim(self, visibility_timeout=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def extend(self, job_id, visibility_timeout=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def ack(self, job_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def fail(self, job_id, error, retry=True):
+        raise NotImplementedError
+
+    @abstractmethod
+    def depth(self):
+        raise NotImplementedError
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Job queue stored in a single SQLite file. Safe to share between processes
+    on one machine, which makes it suitable for local runs and tests.
+    """
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    key TEXT,
+                    payload TEXT NOT NULL,
+                    data BLOB,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    visible_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, visible_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+
+    def _connect(self):
+        # A fresh connection per call keeps this safe across threads and forks
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, kind, payload, data=None, key=None, max_attempts=None):
+        """
+        Adds a job and returns its id. If `key` is given and a job with that
+        key is still pending or running, the existing job id is returned.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if key is not None:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE key = ? AND status IN ('queued', 'running')",
+                    (key,)
+                ).fetchone()
+                if row:
+                    conn.execute("COMMIT")
+                    return row["id"]
+            cur = conn.execute(
+                """INSERT INTO jobs (kind, key, payload, data, status, max_attempts,
+                                     visible_at, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)""",
+                (kind, key, json.dumps(payload), data,
+                 max_attempts or DEFAULT_MAX_ATTEMPTS, now, now, now)
+            )
+            conn.execute("COMMIT")
+            return cur.lastrowid
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def claim(self, visibility_timeout=None):
+        """
+        Claims the oldest visible job, or returns None if there is none.
+        Running jobs whose visibility timeout expired are claimable again.
+        """
+        visibility_timeout = visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    """SELECT * FROM jobs
+                       WHERE status IN ('queued', 'running') AND visible_at <= ?
+                       ORDER BY id LIMIT 1""",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+
+                if row["attempts"] >= row["max_attempts"]:
+                    # Abandoned on its final attempt: give up rather than loop forever
+                    conn.execute(
+                        """UPDATE jobs SET status = 'dead', data = NULL, updated_at = ?,
+                                  last_error = COALESCE(last_error, 'visibility timeout expired')
+                           WHERE id = ?""",
+                        (now, row["id"])
+                    )
+                    conn.execute("COMMIT")
+                    continue
+
+                conn.execute(
+                    """UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                              visible_at = ?, updated_at = ?
+                       WHERE id = ?""",
+                    (now + visibility_timeout, now, row["id"])
+                )
+                conn.execute("COMMIT")
+                return {
+                    "id": row["id"],
+                    "kind": row["kind"],
+                    "key": row["key"],
+                    "payload": json.loads(row["payload"]),
+                    "data": row["data"],
+                    "attempts": row["attempts"] + 1,
+                    "max_attempts": row["max_attempts"],
+                    "created_at": row["created_at"],
+                }
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def extend(self, job_id, visibility_timeout=None):
+        """
+        Pushes back a running job's visibility timeout (worker heartbeat).
+        """
+        visibility_timeout = visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET visible_at = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                (now + visibility_timeout, now, job_id)
+            )
+
+    def ack(self, job_id):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', data = NULL, updated_at = ? WHERE id = ?",
+                (now, job_id)
+            )
+
+    def fail(self, job_id, error, retry=True):
+        """
+        Schedules a retry with jittered exponential backoff, or marks the job
+        dead once it has used all its attempts (or at once without `retry`).
+        Returns True if it will retry.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return False
+
+            retry = retry and row["attempts"] < row["max_attempts"]
+            if retry:
+                delay = RETRY_BACKOFF * (2 ** (row["attempts"] - 1)) * random.uniform(0.5, 1.5)
+                conn.execute(
+                    """UPDATE jobs SET status = 'queued', visible_at = ?, last_error = ?,
+                              updated_at = ? WHERE id = ?""",
+                    (now + delay, str(error), now, job_id)
+                )
+            else:
+                conn.execute(
+                    """UPDATE jobs SET status = 'dead', data = NULL, last_error = ?,
+                              updated_at = ? WHERE id = ?""",
+                    (str(error), now, job_id)
+                )
+            conn.execute("COMMIT")
+            return retry
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def depth(self):
+        """
+        Returns job counts by status.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {"queued": 0, "running": 0, "done": 0, "dead": 0}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+def get_job_queue():
+    """
+    Builds the queue configured by JOB_QUEUE_BACKEND, or returns None when
+    jobs should run on the in-process thread pool.
+    """
+    backend = os.environ.get("JOB_QUEUE_BACKEND", "").lower()
+    if not backend or backend == "thread":
+        return None
+    if backend == "sqlite":
+        return SQLiteJobQueue(os.environ.get("JOB_QUEUE_PATH", "jobs.db"))
+    raise ValueError(f"Unknown JOB_QUEUE_BACKEND: {backend}")
+
+def enqueue_scan(queue, scan_id, filename, bucket_name, image_bytes=None, image_path=None, upload_original=False, room_id=None):
+    """
+    Queues the processing pipeline for one scan. The image comes from
+    `image_bytes`, else a spooled `image_path` on this machine, else the
+    worker downloads the original from storage. With upload_original the
+    worker also stores the original. `room_id` is passed on to the pipeline.
+    Re-queuing a scan that is already pending is a no-op.
+    """
+    payload = {"scan_id": scan_id, "filename": filename, "bucket_name": bucket_name}
+    if image_path:
+        payload["image_path"] = image_path
+    if upload_original:
+        payload["upload_original"] = True
+    if room_id:
+        payload["room_id"] = room_id
+    return queue.enqueue("process_scan", payload, data=image_bytes, key=scan_id)
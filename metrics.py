@@ -0,0 +1,280 @@
+import os
+import time
+import bisect
+import weakref
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+# Upper bounds (seconds) of the latency histogram buckets: fast CV stages up
+# to multi-minute image generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yields (suffix, label values, extra labels, value) for rendering.
+        """
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", key, None, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With `collect`, values are read at
+    scrape time: collect() returns {label values tuple: value}.
+    """
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.collect is None:
+            yield from super().samples()
+            return
+        for key, value in self.collect().items():
+            yield "", key, None, value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            state["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state["counts"]), state["sum"]) for key, state in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", key, [("le", _format_value(float(bound)))], cumulative
+            yield "_sum", key, None, total
+            yield "_count", key, None, cumulative
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"Metric {metric.name} failed to render: {e}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "chalk_stage_duration_seconds", "Time spent in each pipeline stage.", ["stage"]))
+STAGE_ERRORS = registry.register(Counter(
+    "chalk_stage_errors_total", "Pipeline stages that raised.", ["stage"]))
+EXTERNAL_SECONDS = registry.register(Histogram(
+    "chalk_external_call_duration_seconds", "Latency of calls to Gemini, storage and the database.",
+    ["service", "operation"]))
+EXTERNAL_ERRORS = registry.register(Counter(
+    "chalk_external_call_errors_total", "Calls to Gemini, storage and the database that failed.",
+    ["service", "operation"]))
+SCANS = registry.register(Counter(
+    "chalk_scans_total", "Scans that finished the pipeline, by outcome.", ["status"]))
+
+@contextlib.contextmanager
+def stage(name, timings=None):
+    """
+    Times a pipeline stage into STAGE_SECONDS (and STAGE_ERRORS if it
+    raises). With `timings`, the seconds are also stored as timings[name].
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if timings is not None:
+            timings[name] = round(elapsed, 3)
+
+@contextlib.contextmanager
+def external_call(service, operation):
+    """
+    Times one call to an outside service. Callers that swallow errors and
+    return a fallback should record those with EXTERNAL_ERRORS themselves.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        EXTERNAL_ERRORS.inc(service=service, operation=operation)
+        raise
+    finally:
+        EXTERNAL_SECONDS.observe(time.perf_counter() - start, service=service, operation=operation)
+
+_executors = weakref.WeakSet()
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that counts its queued and running tasks, reported
+    per `name` as executor queue depth and utilization.
+    """
+    def __init__(self, max_workers=None, thread_name_prefix="", name=None, **kwargs):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix, **kwargs)
+        self.name = name or thread_name_prefix or "executor"
+        self.queued = 0
+        self.active = 0
+        self._count_lock = threading.Lock()
+        _executors.add(self)
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._count_lock:
+            self.queued += 1
+        future = super().submit(self._run, fn, args, kwargs)
+        future.add_done_callback(self._forget_cancelled)
+        return future
+
+    def _run(self, fn, args, kwargs):
+        with self._count_lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._count_lock:
+                self.active -= 1
+
+    def _forget_cancelled(self, future):
+        if future.cancelled():
+            with self._count_lock:
+                self.queued -= 1
+
+def _executor_values(attr):
+    return lambda: {(executor.name,): attr(executor) for executor in list(_executors)}
+
+registry.register(Gauge(
+    "chalk_executor_workers", "Worker threads an executor may run.", ["executor"],
+    collect=_executor_values(lambda e: e._max_workers)))
+registry.register(Gauge(
+    "chalk_executor_active", "Tasks currently running on an executor.", ["executor"],
+    collect=_executor_values(lambda e: e.active)))
+registry.register(Gauge(
+    "chalk_executor_queued", "Tasks waiting for a free executor thread.", ["executor"],
+    collect=_executor_values(lambda e: e.queued)))
+registry.register(Gauge(
+    "chalk_executor_utilization", "Share of an executor's threads that are busy.", ["executor"],
+    collect=_executor_values(lambda e: e.active / e._max_workers)))
+
+def register_stats(name, documentation, stats):
+    """
+    Exposes the numeric entries of a component's stats() dict as one gauge,
+    labelled by key (nested dicts are flattened with "_").
+    """
+    def collect():
+        values = {}
+        def flatten(prefix, d):
+            for key, value in d.items():
+                if isinstance(value, dict):
+                    flatten(f"{prefix}{key}_", value)
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[(f"{prefix}{key}",)] = value
+        flatten("", stats() or {})
+        return values
+    return registry.register(Gauge(name, documentation, ["stat"], collect=collect))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, host="0.0.0.0"):
+    """
+    Serves the registry on http://host:port/ from a daemon thread, for
+    processes without a Flask app (the queue workers).
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics for process {os.getpid()} on :{port}")
+    return server
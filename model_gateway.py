@@ -0,0 +1,337 @@
+import os
+import re
+import time
+import random
+import threading
+import contextlib
+
+import httpx
+from google import genai
+from google.genai import types, errors
+
+from metrics import registry, Counter, Histogram, Gauge, external_call
+
+# Seconds a single model request may take before it is abandoned (and retried)
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "90"))
+GEMINI_ATTEMPTS = int(os.environ.get("GEMINI_ATTEMPTS", "4"))
+GEMINI_BACKOFF = float(os.environ.get("GEMINI_BACKOFF", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.environ.get("GEMINI_BACKOFF_MAX", "30"))
+
+# Requests per minute each model may be sent from this process, with
+# per-model overrides as "model=rpm,model=rpm", and the burst allowed
+# after a quiet spell
+GEMINI_RPM = float(os.environ.get("GEMINI_RPM", "60"))
+GEMINI_MODEL_RPM = {
+    model.strip(): float(rpm)
+    for model, rpm in (
+        pair.split("=", 1) for pair in os.environ.get("GEMINI_MODEL_RPM", "").split(",") if "=" in pair
+    )
+}
+GEMINI_BURST = float(os.environ.get("GEMINI_BURST", "4"))
+# Gemini work (a segmentation request, a slop or pretty generation) in flight
+# at once in this process; taken by the callers around just that work
+gemini_slots = threading.BoundedSemaphore(int(os.environ.get("GEMINI_MAX_CONCURRENCY", "4")))
+# After a 429 a model's rate is halved, down to this share of its limit, and
+# each success wins back RATE_RECOVERY of the limit
+MIN_RATE_SHARE = 0.1
+RATE_RECOVERY = 0.05
+
+# Model answers worth retrying (timeouts, rate limits, server hiccups)
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+MODEL_SECONDS = registry.register(Histogram(
+    "chalk_model_request_seconds", "Latency of each model request attempt, by outcome.", ["model", "outcome"]))
+MODEL_THROTTLED = registry.register(Counter(
+    "chalk_model_throttled_total", "Model requests answered with 429.", ["model"]))
+MODEL_RETRIES = registry.register(Counter(
+    "chalk_model_retries_total", "Model requests retried after a transient failure.", ["model"]))
+MODEL_WAIT_SECONDS = registry.register(Histogram(
+    "chalk_model_limiter_wait_seconds", "Time model requests waited for the rate limiter.", ["model"]))
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+def get_gemini_client(api_key):
+    """
+    Returns one shared genai.Client per API key, so every model call in a
+    process reuses the same HTTP connections. Rebuilt after a fork.
+    """
+    global _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(api_key)
+        if client is None:
+            client = genai.Client(
+                api_key=api_key, http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT * 1000))
+            )
+            _clients[api_key] = client
+        return client
+
+class TokenBucket:
+    """
+    Adaptive token bucket: `rate` requests per second with bursts of up to
+    `burst`. throttle() halves the rate after a 429 (and can pause the
+    bucket for the server's retry delay); recover() wins it back gradually.
+    """
+    def __init__(self, rate, burst):
+        self.limit = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, deadline=None):
+        """
+        Blocks until a request may go out. Returns the seconds waited.
+        Raises TimeoutError if that would be after `deadline` (monotonic).
+        """
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now - start
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.updated = self.paused_until
+                    wait = self.paused_until - now
+            if deadline is not None and now + wait > deadline:
+                raise TimeoutError("Rate limiter wait runs past the deadline")
+            time.sleep(wait)
+
+    def throttle(self, pause=0.0):
+        with self._lock:
+            self.rate = max(self.limit * MIN_RATE_SHARE, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            if pause:
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.limit, self.rate + self.limit * RATE_RECOVERY)
+
+def status_of(error):
+    """
+    The HTTP status of a failed model request, 408 for timeouts, None otherwise.
+    """
+    if isinstance(error, errors.APIError):
+        return error.code
+    if isinstance(error, httpx.TimeoutException):
+        return 408
+    return None
+
+def is_transient(error):
+    return status_of(error) in TRANSIENT_STATUSES or isinstance(error, httpx.TransportError)
+
+def retry_delay(error):
+    """
+    Seconds the server asked us to wait (google.rpc.RetryInfo), or 0.
+    """
+    details = getattr(error, "details", None)
+    if not isinstance(details, dict):
+        return 0.0
+    for detail in details.get("error", {}).get("details", []) or []:
+        match = re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", "")))
+        if match:
+            return float(match.group(1))
+    return 0.0
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def request_deadline(deadline):
+    """
+    Model requests made by this thread inside the block stop at `deadline`
+    (time.monotonic()): attempts are cut short and no retry starts after it.
+    A deadline of None changes nothing.
+    """
+    previous = getattr(_local, "deadline", None)
+    if deadline is not None and previous is not None:
+        deadline = min(previous, deadline)
+    _local.deadline = deadline if deadline is not None else previous
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+class GeminiTransport:
+    """
+    Sends requests with the shared client of each API key.
+    """
+    def generate_content(self, api_key, model, contents, config=None, timeout=None):
+        if timeout is not None:
+            http_options = types.HttpOptions(timeout=int(timeout * 1000))
+            if config is None:
+                config = types.GenerateContentConfig(http_options=http_options)
+            else:
+                config = config.model_copy(update={"http_options": http_options})
+        return get_gemini_client(api_key).models.generate_content(model=model, contents=contents, config=config)
+
+class MockTransport:
+    """
+    Offline transport for tests and benchmarks. Each request takes the next
+    entry of `responses` (the last one repeats): a response is returned, an
+    exception raised, and a callable is called with (model, contents) for
+    either. Requests are recorded in `calls` as (model, contents, timeout).
+    """
+    def __init__(self, responses, latency=0.0):
+        self.responses = list(responses)
+        self.latency = latency
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, api_key, model, contents, config=None, timeout=None):
+        with self._lock:
+            self.calls.append((model, contents, timeout))
+            entry = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if self.latency:
+            time.sleep(self.latency)
+        if callable(entry) and not isinstance(entry, type):
+            entry = entry(model, contents)
+        if isinstance(entry, BaseException):
+            raise entry
+        return entry
+
+def mock_response(text=None, image=None, mime_type="image/png"):
+    """
+    A GenerateContentResponse with `text` and/or inline `image` bytes.
+    """
+    parts = []
+    if text is not None:
+        parts.append(types.Part(text=text))
+    if image is not None:
+        parts.append(types.Part(inline_data=types.Blob(data=image, mime_type=mime_type)))
+    return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(parts=parts))])
+
+def api_error(code, message="mock error", retry_after=None):
+    """
+    The errors.APIError the SDK raises for an HTTP `code` answer.
+    """
+    body = {"error": {"code": code, "message": message, "status": str(code)}}
+    if retry_after is not None:
+        body["error"]["details"] = [
+            {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{retry_after}s"}
+        ]
+    return (errors.ClientError if code < 500 else errors.ServerError)(code, body)
+
+class ModelGateway:
+    """
+    The one way model requests leave the process: a token bucket per model,
+    retries with jittered exponential backoff on 429, 5xx and timeouts, a
+    timeout per request, and latency and throttle metrics per model.
+    """
+    def __init__(self, transport=None):
+        self.transport = transport or GeminiTransport()
+        self._buckets = {}
+        self._buckets_pid = None
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def bucket(self, model):
+        with self._lock:
+            if self._buckets_pid != os.getpid():
+                self._buckets.clear()
+                self._buckets_pid = os.getpid()
+            bucket = self._buckets.get(model)
+            if bucket is None:
+                rpm = GEMINI_MODEL_RPM.get(model, GEMINI_RPM)
+                bucket = self._buckets[model] = TokenBucket(rpm / 60, GEMINI_BURST)
+            return bucket
+
+    def _count(self, model, name):
+        with self._lock:
+            counts = self._counts.setdefault(model, {"requests": 0, "retries": 0, "throttled": 0, "failed": 0})
+            counts[name] += 1
+
+    def generate_content(self, api_key, model, contents, config=None, operation="generate",
+                         timeout=None, attempts=None):
+        """
+        client.models.generate_content through the limiter, retried while
+        the failure is transient. Raises the last error once `attempts`
+        are used up, or TimeoutError once a request_deadline() has passed.
+        """
+        attempts = attempts or GEMINI_ATTEMPTS
+        timeout = timeout or GEMINI_TIMEOUT
+        deadline = getattr(_local, "deadline", None)
+        bucket = self.bucket(model)
+        with external_call("gemini", operation):
+            for attempt in range(1, attempts + 1):
+                MODEL_WAIT_SECONDS.observe(bucket.acquire(deadline), model=model)
+                attempt_timeout = timeout
+                if deadline is not None:
+                    attempt_timeout = min(timeout, deadline - time.monotonic())
+                    if attempt_timeout <= 0:
+                        raise TimeoutError(f"Gemini {operation} ({model}) ran out of time")
+                self._count(model, "requests")
+                start = time.perf_counter()
+                try:
+                    response = self.transport.generate_content(
+                        api_key, model, contents, config=config, timeout=attempt_timeout
+                    )
+                except Exception as e:
+                    status = status_of(e)
+                    outcome = "throttled" if status == 429 else "timeout" if status == 408 else "error"
+                    MODEL_SECONDS.observe(time.perf_counter() - start, model=model, outcome=outcome)
+                    server_delay = retry_delay(e)
+                    if status == 429:
+                        MODEL_THROTTLED.inc(model=model)
+                        self._count(model, "throttled")
+                        bucket.throttle(pause=server_delay)
+                    delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF * (2 ** (attempt - 1))) * random.uniform(0.5, 1.5)
+                    delay = max(delay, server_delay)
+                    out_of_time = deadline is not None and time.monotonic() + delay >= deadline
+                    if attempt == attempts or not is_transient(e) or out_of_time:
+                        self._count(model, "failed")
+                        raise
+                    MODEL_RETRIES.inc(model=model)
+                    self._count(model, "retries")
+                    print(f"Gemini {operation} ({model}) failed ({status or e}), retry {attempt}/{attempts - 1} in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                MODEL_SECONDS.observe(time.perf_counter() - start, model=model, outcome="ok")
+                bucket.recover()
+                return response
+
+    @contextlib.contextmanager
+    def using(self, transport):
+        """
+        Routes requests through `transport` (e.g. a MockTransport) for the
+        duration of the block.
+        """
+        previous, self.transport = self.transport, transport
+        try:
+            yield transport
+        finally:
+            self.transport = previous
+
+    def stats(self):
+        with self._lock:
+            stats = {model: dict(counts) for model, counts in self._counts.items()}
+            buckets = dict(self._buckets)
+        for model, bucket in buckets.items():
+            stats.setdefault(model, {})["rpm"] = round(bucket.rate * 60, 2)
+        return stats
+
+gateway = ModelGateway()
+
+registry.register(Gauge(
+    "chalk_model_rate_rpm", "Requests per minute the limiter currently lets through, per model.", ["model"],
+    collect=lambda: {(model,): stats["rpm"] for model, stats in gateway.stats().items() if "rpm" in stats}))
+
+def generate_content(api_key, model, contents, config=None, operation="generate", timeout=None):
+    """
+    Sends one model request through the shared gateway (see ModelGateway).
+    """
+    return gateway.generate_content(api_key, model, contents, config=config, operation=operation, timeout=timeout)
@@ -0,0 +1,326 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError, wait
+
+from chalk_processor import process_image, process_doors
+from style_processor import make_ugly, make_slop, make_pretty
+from scan_writer import scan_writer
+from supabase_client import insert_scan_record, get_scan_record, get_public_url
+from uploads import upload_service, upload_with_retry, sniff_image_type
+from derivatives import encode_derivatives, derivative_name, derivative_spec
+from image_io import discard_spooled
+from scan_cache import scan_cache
+from content_cache import content_cache
+from metrics import InstrumentedExecutor, stage, SCANS
+from model_gateway import request_deadline, gemini_slots
+
+# Per-provider concurrency limits, shared by every pipeline in this process.
+# Gemini calls are rate limited upstream, so cap how many are in flight at once
+# (the same slots guard the segmentation request in chalk_processor).
+PROVIDER_LIMITS = {
+    "gemini": gemini_slots,
+    "storage": threading.BoundedSemaphore(int(os.environ.get("STORAGE_MAX_CONCURRENCY", "8"))),
+    "cpu": threading.BoundedSemaphore(int(os.environ.get("CPU_MAX_CONCURRENCY", str(os.cpu_count() or 2)))),
+}
+
+# Seconds each fan-out branch may take (including time spent waiting on a limit)
+BRANCH_TIMEOUTS = {
+    "ugly": float(os.environ.get("UGLY_TIMEOUT", "60")),
+    "slop": float(os.environ.get("SLOP_TIMEOUT", "120")),
+    "pretty": float(os.environ.get("PRETTY_TIMEOUT", "180")),
+    "derivatives": float(os.environ.get("DERIVATIVES_TIMEOUT", "120")),
+}
+
+# Separate from the request-level executor so branches never wait on their own parent
+branch_executor = InstrumentedExecutor(
+    max_workers=int(os.environ.get("BRANCH_WORKERS", "12")),
+    thread_name_prefix="branch"
+)
+
+# Extract every door found in a photo (up to MULTI_DOOR_MAX) instead of only
+# the best one; extra doors scoring at least MULTI_DOOR_MIN_SCORE become
+# scans of their own, linked by parent_scan_id
+MULTI_DOOR_SCANS = os.environ.get("MULTI_DOOR_SCANS", "false").lower() in ("1", "true", "yes")
+MULTI_DOOR_MAX = int(os.environ.get("MULTI_DOOR_MAX", "4"))
+MULTI_DOOR_MIN_SCORE = float(os.environ.get("MULTI_DOOR_MIN_SCORE", "0.3"))
+
+# Write each scan's per-stage seconds to its `stage_timings` column (add the
+# JSONB column first; the write is separate from the status, see scan_writer)
+RECORD_STAGE_TIMINGS = os.environ.get("RECORD_STAGE_TIMINGS", "false").lower() in ("1", "true", "yes")
+
+def upload_artifact(image_bytes, filename, bucket_name, folder="processed"):
+    with PROVIDER_LIMITS["storage"]:
+        return upload_with_retry(
+            image_bytes,
+            filename,
+            folder=folder,
+            bucket_name=bucket_name,
+            upsert=True
+        )
+
+def upload_derivatives(scan_id, artifact, image, bucket_name):
+    """
+    Encodes the thumbnail/medium/full derivatives of one artifact from a
+    single decode and uploads them in parallel to their predictable paths.
+    Returns {size: width} for the sizes produced (none wider than `image`).
+    """
+    with PROVIDER_LIMITS["cpu"]:
+        encoded = list(encode_derivatives(image))
+    uploads = [
+        upload_service.submit(
+            data, derivative_name(scan_id, artifact, size, fmt),
+            folder="derivatives", bucket_name=bucket_name, upsert=True
+        )
+        for size, width, fmt, data in encoded
+    ]
+    for upload in uploads:
+        upload.result()
+    return {size: width for size, width, fmt, data in encoded}
+
+def upload_with_derivatives(scan_id, artifact, image_bytes, filename, bucket_name):
+    # The full-size artifact goes up while its derivatives are encoded
+    main = upload_service.submit(image_bytes, filename, folder="processed", bucket_name=bucket_name, upsert=True)
+    widths = upload_derivatives(scan_id, artifact, image_bytes, bucket_name)
+    return main.result(), widths
+
+def ugly_branch(scan_id, extracted_bytes, bucket_name, gemini_key):
+    with PROVIDER_LIMITS["cpu"]:
+        ugly_bytes = make_ugly(extracted_bytes)
+    ugly_url, widths = upload_with_derivatives(scan_id, "ugly", ugly_bytes, f"{scan_id}_ugly.jpg", bucket_name)
+    return {"ugly_url": ugly_url, "derivative_widths": {"ugly": widths}}
+
+def slop_branch(scan_id, extracted_bytes, bucket_name, gemini_key):
+    with PROVIDER_LIMITS["gemini"]:
+        slop_text = make_slop(extracted_bytes, gemini_key)
+    return {"slop_text": slop_text}
+
+def pretty_branch(scan_id, extracted_bytes, bucket_name, gemini_key):
+    with PROVIDER_LIMITS["gemini"]:
+        pretty_bytes = make_pretty(extracted_bytes, gemini_key)
+    # Imagen may hand back PNG or WebP; name the object after what it really is
+    extension = sniff_image_type(pretty_bytes)[1]
+    pretty_url, widths = upload_with_derivatives(
+        scan_id, "pretty", pretty_bytes, f"{scan_id}_pretty{extension}", bucket_name
+    )
+    return {"pretty_url": pretty_url, "derivative_widths": {"pretty": widths}}
+
+def derivatives_branch(scan_id, extracted_bytes, bucket_name, gemini_key):
+    return {"derivative_widths": {"chalk": upload_derivatives(scan_id, "chalk", extracted_bytes, bucket_name)}}
+
+BRANCHES = {
+    "ugly": ("Frying image (Ugly)", ugly_branch),
+    "slop": ("Generating Slop", slop_branch),
+    "pretty": ("Beautifying (Imagen)", pretty_branch),
+    "derivatives": ("Encoding derivatives", derivatives_branch),
+}
+
+def _run_branch(name, scan_id, extracted_bytes, bucket_name, gemini_key, cancelled, after=None, timings=None,
+                deadline=None):
+    """
+    Runs one branch and records its result on its own, so a slow or failed
+    sibling never holds back the fields that are already done.
+    If given, `after` (a Future) must finish before the result is written.
+    Model requests stop retrying at `deadline` (time.monotonic()), the end
+    of the branch's timeout, instead of running on after it.
+    """
+    label, fn = BRANCHES[name]
+    print(f"[{scan_id}] {label}...")
+    with stage(name, timings), request_deadline(deadline):
+        fields = fn(scan_id, extracted_bytes, bucket_name, gemini_key)
+    if after is not None:
+        after.result()
+    if cancelled.is_set():
+        print(f"[{scan_id}] {name} finished after its timeout, result dropped.")
+        return None
+    # Buffered: coalesced with the other branches or carried by "completed".
+    # Derivative widths are collected by run_fanout into one `derivatives`.
+    scan_writer.write(scan_id, **{k: v for k, v in fields.items() if k != "derivative_widths"})
+    print(f"[{scan_id}] {name} ready.")
+    return fields
+
+def run_fanout(scan_id, extracted_bytes, bucket_name, gemini_key, after=None, timings=None):
+    """
+    Runs the ugly, slop, pretty and derivatives branches concurrently, each bounded by its
+    own timeout. Branch results are written only once `after` (a Future,
+    e.g. the extraction upload) is done. Each branch's seconds go into
+    `timings`. The derivative sizes of the artifacts that made it are then
+    written as the scan's `derivatives`. Returns {branch: fields or None}.
+    """
+    start = time.monotonic()
+    futures = {}
+    for name in BRANCHES:
+        cancelled = threading.Event()
+        future = branch_executor.submit(
+            _run_branch, name, scan_id, extracted_bytes, bucket_name, gemini_key, cancelled, after, timings,
+            start + BRANCH_TIMEOUTS[name]
+        )
+        futures[name] = (future, cancelled)
+
+    results = {}
+    for name, (future, cancelled) in futures.items():
+        remaining = BRANCH_TIMEOUTS[name] - (time.monotonic() - start)
+        try:
+            results[name] = future.result(timeout=max(0, remaining))
+        except FutureTimeoutError:
+            cancelled.set()
+            print(f"[{scan_id}] {name} generation timed out after {BRANCH_TIMEOUTS[name]:.0f}s")
+            results[name] = None
+        except Exception as e:
+            print(f"[{scan_id}] {name} generation failed: {e}")
+            results[name] = None
+
+    widths = {}
+    for fields in results.values():
+        widths.update((fields or {}).get("derivative_widths", {}))
+    if widths:
+        scan_writer.write(scan_id, flush=False, derivatives=derivative_spec(widths))
+    return results
+
+def _save_extraction(scan_id, extracted_bytes, filename, bucket_name, timings=None):
+    with stage("save_extraction", timings):
+        processed_url = upload_artifact(extracted_bytes, filename, bucket_name)
+
+    # Update DB: Extraction Done
+    scan_writer.write(scan_id, processed_url=processed_url, status="extracted")
+    print(f"[{scan_id}] Extraction complete. URL: {processed_url}")
+    return processed_url
+
+def _upload_original(image, filename, bucket_name, timings):
+    with stage("original_upload", timings):
+        return upload_with_retry(image, filename, folder="originals", bucket_name=bucket_name, upsert=True)
+
+def door_scan_id(scan_id, door):
+    """
+    The id of the scan for the `door`-th door (2, 3, ...) of a photo, the
+    same on every retry of the parent.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"chalk-scan:{scan_id}/door/{door}"))
+
+def _run_door_scan(parent_id, parent, door, extracted_bytes, filename, bucket_name, gemini_key):
+    """
+    Saves and fans out an extra door found in the parent scan's photo as a
+    scan of its own. Failures are kept to that scan.
+    """
+    scan_id = door_scan_id(parent_id, door)
+    timings = {}
+    print(f"[{parent_id}] Door {door} of the photo becomes scan {scan_id}")
+    try:
+        # A retried parent finds the row already there; its writes below still apply
+        insert_scan_record(
+            scan_id,
+            parent.get("original_url") or get_public_url(filename, folder="originals", bucket_name=bucket_name),
+            status="queued",
+            semester=parent.get("semester"),
+            parent_scan_id=parent_id,
+        )
+        with stage("pipeline", timings):
+            extraction_saved = upload_service.executor.submit(
+                _save_extraction, scan_id, extracted_bytes, f"{scan_id}.jpg", bucket_name, timings
+            )
+            run_fanout(scan_id, extracted_bytes, bucket_name, gemini_key, after=extraction_saved, timings=timings)
+            extraction_saved.result()
+    except Exception as e:
+        print(f"[{scan_id}] Door pipeline FAILED: {e}")
+        scan_writer.write(scan_id, status="failed", error_message=str(e))
+        SCANS.inc(status="failed")
+        return
+    if RECORD_STAGE_TIMINGS:
+        scan_writer.write(scan_id, flush=False, stage_timings=dict(timings))
+    scan_writer.write(scan_id, status="completed")
+    SCANS.inc(status="completed")
+
+def _extract_and_fan_out(scan_id, image, filename, bucket_name, gemini_key, original, timings, room_id=None):
+    try:
+        # --- Step 1: Extraction ---
+        print(f"[{scan_id}] Extracting chalk...")
+        with stage("extract", timings):
+            if MULTI_DOOR_SCANS:
+                doors = process_doors(
+                    image, gemini_key, max_doors=MULTI_DOOR_MAX, min_score=MULTI_DOOR_MIN_SCORE, room_id=room_id
+                )
+            else:
+                doors = [process_image(image, gemini_key, room_id=room_id)]
+        extracted_bytes = doors[0]
+
+        # Upload Extracted while the branches start; they only need the bytes
+        extraction_saved = upload_service.executor.submit(
+            _save_extraction, scan_id, extracted_bytes, filename, bucket_name, timings
+        )
+
+        # --- Step 2: Fan-Out (Ugly, Slop, Pretty & Derivatives) ---
+        run_fanout(scan_id, extracted_bytes, bucket_name, gemini_key, after=extraction_saved, timings=timings)
+        extraction_saved.result()
+    finally:
+        # The original may be streaming from a spooled file our caller deletes
+        if original is not None:
+            wait([original])
+    if original is not None:
+        original.result()
+    return doors[1:]
+
+def run_pipeline(scan_id, image, filename, bucket_name, gemini_key, upload_original=False, timings=None, room_id=None):
+    """
+    Runs extraction and the fan-out for one scan. `image` is the original as
+    bytes or a path to it on disk. Raises if extraction fails, so callers can
+    decide whether to retry or mark the scan failed.
+    Artifacts are written with upsert, so a retried job overwrites cleanly.
+    With upload_original, the original is stored here (in parallel with
+    extraction) instead of by the request that accepted it.
+    Seconds per stage are collected in `timings` and saved on the scan
+    with its final status. With MULTI_DOOR_SCANS, other doors in the photo
+    then get scans of their own. `room_id` lets a re-scan of the room reuse
+    its last door corners (see chalk_processor.process_doors).
+    """
+    timings = {} if timings is None else timings
+    original = None
+    if upload_original:
+        original = upload_service.executor.submit(_upload_original, image, filename, bucket_name, timings)
+
+    try:
+        with stage("pipeline", timings):
+            other_doors = _extract_and_fan_out(
+                scan_id, image, filename, bucket_name, gemini_key, original, timings, room_id=room_id
+            )
+    finally:
+        # Buffered; sent in its own request after the final status,
+        # "completed" or the caller's "failed"
+        if RECORD_STAGE_TIMINGS:
+            scan_writer.write(scan_id, flush=False, stage_timings=dict(timings))
+
+    # --- Finalize ---
+    scan_writer.write(scan_id, status="completed")
+    SCANS.inc(status="completed")
+    print(f"[{scan_id}] Pipeline Finished in {timings['pipeline']:.1f}s.")
+    # Identical uploads to this process now skip both the pipeline and the DB lookup
+    record = scan_cache.get(scan_id)
+    if record and record.get("content_hash") and record.get("processed_url"):
+        content_cache.remember(record["content_hash"], record)
+
+    # --- Other doors in the same photo, one scan each ---
+    if other_doors:
+        parent = get_scan_record(scan_id) or {}
+        for door, door_bytes in enumerate(other_doors, start=2):
+            _run_door_scan(scan_id, parent, door, door_bytes, filename, bucket_name, gemini_key)
+
+def background_processing_pipeline(scan_id, image, filename, bucket_name, gemini_key, upload_original=False, room_id=None):
+    """
+    The main async pipeline:
+    1. Extract Chalk (Gemini Vision + OpenCV)
+    2. Parallel Fan-out, each branch saving its own result:
+       - Create Ugly (Deep Fry)
+       - Create Slop (Gemini Text)
+       - Create Pretty (Gemini Image)
+       - Encode chalk thumbnails/WebP (Derivatives)
+    """
+    print(f"[{scan_id}] Starting background pipeline...")
+
+    try:
+        run_pipeline(scan_id, image, filename, bucket_name, gemini_key, upload_original=upload_original, room_id=room_id)
+    except Exception as e:
+        print(f"[{scan_id}] Pipeline FAILED: {e}")
+        scan_writer.write(scan_id, status="failed", error_message=str(e))
+        SCANS.inc(status="failed")
+    finally:
+        discard_spooled(image)
@@ -0,0 +1,53 @@
+import os
+import time
+import resource
+import threading
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss():
+    """
+    Resident set size of this process in bytes.
+    Falls back to the peak RSS where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is KB on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+class track_peak_memory:
+    """
+    Context manager that samples RSS in a background thread and records how
+    far it rose above its starting point (`peak_bytes`). The figure is
+    process-wide, so concurrent jobs in the same process inflate each other.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self.peak_bytes = 0
+        self.seconds = 0.0
+        self._done = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss()
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        self.peak_bytes = self.peak - self.baseline
+        self.seconds = time.perf_counter() - self._start
+        return False
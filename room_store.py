@@ -0,0 +1,137 @@
+import io
+import os
+import threading
+import numpy as np
+import cv2
+
+from cache import DiskCache
+
+# ORB features kept per room
+ROOM_FEATURES = int(os.environ.get("ROOM_ALIGN_FEATURES", "1000"))
+# What a re-scan needs to reuse the last corners: RANSAC inliers among the
+# feature matches, and their share of the matches
+ROOM_MIN_INLIERS = int(os.environ.get("ROOM_ALIGN_MIN_INLIERS", "40"))
+ROOM_MIN_INLIER_RATIO = float(os.environ.get("ROOM_ALIGN_MIN_RATIO", "0.5"))
+# Lowe's ratio test: a match must be clearly better than the runner-up
+MATCH_RATIO = 0.75
+# Reprojection error (detection image pixels) for a RANSAC inlier
+RANSAC_THRESHOLD = 3.0
+
+def features(gray):
+    """
+    ORB keypoint positions (N x 2 float32) and descriptors (N x 32 uint8).
+    """
+    # ORB objects aren't safe to share between threads, and are cheap to make
+    orb = cv2.ORB_create(nfeatures=ROOM_FEATURES)
+    keypoints, descriptors = orb.detectAndCompute(gray, None)
+    if descriptors is None:
+        return np.zeros((0, 2), np.float32), np.zeros((0, 32), np.uint8)
+    return np.float32([kp.pt for kp in keypoints]), descriptors
+
+def _is_door_quad(corners, width, height):
+    margin = 0.02 * max(width, height)
+    inside = (corners.min(axis=0) > -margin).all() and (corners.max(axis=0) < [width + margin, height + margin]).all()
+    return inside and cv2.isContourConvex(corners.reshape(-1, 1, 2).astype(np.float32))
+
+class RoomStore:
+    """
+    The door corners of each room's last scan, with
+    ORB features of that photo's detection image. A re-scan from a similar
+    angle is aligned to them by feature matching and reuses the corners
+    instead of segmenting again.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self.saved = 0
+        self.aligned = 0
+        self.rejected = 0
+        self.missing = 0
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def remember(self, room_id, gray, corners, size):
+        """
+        Stores a scan of `room_id`: its detection image `gray`, and the door
+        `corners` (TL, TR, BR, BL) in pixels of the size (width, height) photo.
+        """
+        points, descriptors = features(gray)
+        if len(points) < ROOM_MIN_INLIERS:
+            return False
+        corners = np.asarray(corners, dtype=np.float32)
+        buf = io.BytesIO()
+        np.savez(
+            buf, points=points, descriptors=descriptors,
+            corners=corners / np.float32(size), detect_size=np.int32(gray.shape[::-1]),
+        )
+        self.cache.set(room_id, buf.getvalue())
+        self._count("saved")
+        return True
+
+    def load(self, room_id):
+        data = self.cache.get(room_id)
+        if data is None:
+            return None
+        with np.load(io.BytesIO(data), allow_pickle=False) as entry:
+            return {key: entry[key] for key in entry.files}
+
+    def align(self, room_id, gray):
+        """
+        The stored door corners of `room_id` carried over to a new detection
+        image `gray` by a RANSAC homography between the two photos' features.
+        Returns (corners in pixels of `gray`, inlier share), or (None, score)
+        when the room is unknown or the match isn't convincing.
+        """
+        entry = self.load(room_id)
+        if entry is None:
+            self._count("missing")
+            return None, 0.0
+        points, descriptors = features(gray)
+        if len(points) < 4:
+            self._count("rejected")
+            return None, 0.0
+
+        pairs = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(entry["descriptors"], descriptors, k=2)
+        good = [p[0] for p in pairs if len(p) == 2 and p[0].distance < MATCH_RATIO * p[1].distance]
+        if len(good) < ROOM_MIN_INLIERS:
+            self._count("rejected")
+            return None, 0.0
+        src = entry["points"][[m.queryIdx for m in good]]
+        dst = points[[m.trainIdx for m in good]]
+        homography, inliers = cv2.findHomography(src, dst, cv2.RANSAC, RANSAC_THRESHOLD)
+        if homography is None:
+            self._count("rejected")
+            return None, 0.0
+        count = int(inliers.sum())
+        score = count / len(good)
+        if count < ROOM_MIN_INLIERS or score < ROOM_MIN_INLIER_RATIO:
+            self._count("rejected")
+            return None, score
+
+        # Stored corners are normalized to the old photo: scale them to its
+        # detection image, where the homography starts
+        height, width = gray.shape
+        ref_corners = entry["corners"] * np.float32(entry["detect_size"])
+        corners = cv2.perspectiveTransform(ref_corners.reshape(1, 4, 2), homography)[0]
+        if not _is_door_quad(corners, width, height):
+            self._count("rejected")
+            return None, score
+        self._count("aligned")
+        return corners, score
+
+    def stats(self):
+        with self._lock:
+            stats = {"saved": self.saved, "aligned": self.aligned, "rejected": self.rejected, "missing": self.missing}
+        stats["cache"] = self.cache.stats()
+        return stats
+
+def _build_room_store():
+    path = os.environ.get("ROOM_STORE_PATH", ".cache/rooms.db")
+    if not path or path.lower() == "off":
+        return None
+    max_mb = float(os.environ.get("ROOM_STORE_MAX_MB", "64"))
+    return RoomStore(DiskCache(path, max_bytes=int(max_mb * 1024 * 1024)))
+
+room_store = _build_room_store()
@@ -0,0 +1,126 @@
+import os
+import threading
+
+from cache import LRUCache
+from supabase_client import get_scan_record, get_scan_by_room_id, add_scan_write_listener
+
+# Completed scans don't change; in-progress ones may be advanced by a worker in
+# another process, so only trust those for a couple of seconds.
+COMPLETED_TTL = float(os.environ.get("SCAN_CACHE_TTL_COMPLETED", "600"))
+PENDING_TTL = float(os.environ.get("SCAN_CACHE_TTL_PENDING", "2"))
+# Semester listings also change when other processes insert or finish scans
+SEMESTER_TTL = float(os.environ.get("SEMESTER_CACHE_TTL", "30"))
+
+class ScanCache:
+    """
+    Read-through cache of chalk_scans rows for the polling endpoints.
+
+    Writes made through supabase_client in this process (the pipeline's
+    scan writes) are merged straight into cached rows, so thread-backed
+    scans never go stale and completed scans stay in memory.
+    """
+    def __init__(self, maxsize=4096, completed_ttl=COMPLETED_TTL, pending_ttl=PENDING_TTL):
+        self.records = LRUCache(maxsize=maxsize)
+        self.rooms = LRUCache(maxsize=maxsize)
+        self.completed_ttl = completed_ttl
+        self.pending_ttl = pending_ttl
+        self._lock = threading.Lock()
+
+    def _ttl(self, record):
+        return self.completed_ttl if record.get("status") == "completed" else self.pending_ttl
+
+    def _store(self, record):
+        with self._lock:
+            self.records.set(record["id"], record, ttl=self._ttl(record))
+        if record.get("room_id"):
+            self.rooms.set(record["room_id"], record["id"], ttl=self.completed_ttl)
+
+    def get(self, scan_id):
+        """
+        Returns the scan row (a copy) or None.
+        """
+        record = self.records.get(scan_id)
+        if record is None:
+            record = get_scan_record(scan_id)
+            if not record:
+                return None
+            self._store(record)
+        return dict(record)
+
+    def get_by_room(self, room_id):
+        scan_id = self.rooms.get(room_id)
+        record = self.records.get(scan_id) if scan_id else None
+        if record is None:
+            record = get_scan_by_room_id(room_id)
+            if not record:
+                return None
+            self._store(record)
+        return dict(record)
+
+    def on_write(self, scan_id, fields, created=False):
+        """
+        Scan write listener: merges updates into the cached row. A new scan
+        for a room (e.g. a re-scan) becomes that room's mapping.
+        """
+        if created:
+            if fields.get("room_id"):
+                self._store({**fields, "id": scan_id})
+            return
+        with self._lock:
+            record = self.records.get(scan_id)
+            if record is not None:
+                record = {**record, **fields}
+                self.records.set(scan_id, record, ttl=self._ttl(record))
+
+    def stats(self):
+        return self.records.stats()
+
+scan_cache = ScanCache(maxsize=int(os.environ.get("SCAN_CACHE_SIZE", "4096")))
+add_scan_write_listener(scan_cache.on_write)
+
+class SemesterCache:
+    """
+    Caches semester listing pages. A new scan, or one that finishes, bumps
+    its semester's generation so every cached page of it is skipped;
+    progress in between is bounded by the TTL.
+    """
+    def __init__(self, maxsize=256, ttl=SEMESTER_TTL):
+        self.pages = LRUCache(maxsize=maxsize, ttl=ttl)
+        # scan_id -> semester, so completion writes (which don't carry it) can be routed
+        self.semesters = LRUCache(maxsize=maxsize * 64)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, semester, key):
+        """
+        Returns (cache_key, page or None). Pass the cache_key back to store(),
+        so a page read before an invalidation is filed under the old generation.
+        """
+        with self._lock:
+            cache_key = (semester, self._generations.get(semester, 0), key)
+        return cache_key, self.pages.get(cache_key)
+
+    def store(self, cache_key, page, scan_ids=()):
+        for scan_id in scan_ids:
+            self.semesters.set(scan_id, cache_key[0])
+        self.pages.set(cache_key, page)
+
+    def invalidate(self, semester):
+        with self._lock:
+            self._generations[semester] = self._generations.get(semester, 0) + 1
+
+    def on_write(self, scan_id, fields, created=False):
+        if not created and fields.get("status") not in ("completed", "failed"):
+            return
+        semester = fields.get("semester") or self.semesters.get(scan_id)
+        if semester:
+            self.invalidate(semester)
+        elif not created:
+            # Finished scan we never listed: we can't tell which semester it's in
+            self.pages.clear()
+
+    def stats(self):
+        return self.pages.stats()
+
+semester_cache = SemesterCache(maxsize=int(os.environ.get("SEMESTER_CACHE_SIZE", "256")))
+add_scan_write_listener(semester_cache.on_write)
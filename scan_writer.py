@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import atexit
+import threading
+
+from cache import LRUCache
+from supabase_client import update_scan_records, upsert_scan_records
+
+# Buffered (non-stage) fields are written at least this often (seconds)
+FLUSH_INTERVAL = float(os.environ.get("SCAN_WRITE_FLUSH_INTERVAL", "0.5"))
+# Give up on a scan's buffered fields after this many failed flushes
+MAX_ATTEMPTS = int(os.environ.get("SCAN_WRITE_MAX_ATTEMPTS", "3"))
+# Rows with different values but the same columns go out as one upsert.
+# Off by default: Postgres checks an upsert as an INSERT first, so it fails
+# on NOT NULL columns without defaults (e.g. original_url), and it creates a
+# partial row for an id that no longer exists. Only enable it when every
+# column other than id is nullable or has a default.
+USE_UPSERT = os.environ.get("SCAN_WRITE_UPSERT", "false").lower() in ("1", "true", "yes")
+
+# A scan's status only moves forward; a late lower-ranked status is ignored
+STATUS_RANK = {"queued": 0, "extracted": 1, "completed": 2, "failed": 2}
+# Final statuses: once a scan has one, later statuses (e.g. a branch that
+# reports after its timeout) are dropped
+TERMINAL_STATUSES = ("completed", "failed")
+
+# Columns added after the base chalk_scans schema. Each goes out in its own
+# request after the scan's other fields, so a missing column only loses
+# that column instead of failing (and after MAX_ATTEMPTS dropping) a status.
+SEPARATE_FIELDS = ("stage_timings", "derivatives")
+
+class ScanWriter:
+    """
+    Coalesces chalk_scans updates. Field writes for a scan are merged in a
+    buffer; a status change (a stage boundary) flushes that scan at once,
+    carrying every buffered field with it, so a client that sees `extracted`
+    or `completed` also sees the artifacts written before it (SEPARATE_FIELDS
+    follow right after, each in its own request). Everything else is
+    flushed by a background timer, batched across scans.
+    """
+    def __init__(self, interval=FLUSH_INTERVAL, use_upsert=USE_UPSERT):
+        self.interval = interval
+        self.use_upsert = use_upsert
+        self.pending = {}
+        self.attempts = {}
+        # Last status written per scan, so ordering holds across flushes too
+        self.statuses = LRUCache(maxsize=4096)
+        self._lock = threading.Lock()
+        # One flush at a time keeps each scan's writes in order
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self.writes = 0
+        self.requests = 0
+        self.dropped = 0
+
+    def write(self, scan_id, flush=None, **fields):
+        """
+        Buffers `fields` for `scan_id`. Flushes this scan now if `flush`, or
+        by default when the write changes the status.
+        """
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if not fields:
+            return
+        with self._lock:
+            current = self.pending.setdefault(scan_id, {})
+            if "status" in fields:
+                latest = current.get("status") or self.statuses.get(scan_id)
+                if latest in TERMINAL_STATUSES or STATUS_RANK.get(fields["status"], 0) < STATUS_RANK.get(latest, 0):
+                    if fields["status"] != latest:
+                        print(f"[{scan_id}] Ignoring status {fields['status']} after {latest}")
+                    if fields.pop("status") == "failed":
+                        fields.pop("error_message", None)
+                    if not fields:
+                        if not current:
+                            del self.pending[scan_id]
+                        return
+            current.update(fields)
+            self.writes += 1
+        if flush is None:
+            flush = "status" in fields
+        if flush:
+            self.flush([scan_id])
+        else:
+            self._ensure_timer()
+
+    def flush(self, scan_ids=None):
+        """
+        Writes the buffered fields of `scan_ids` (default: every scan).
+        """
+        with self._flush_lock:
+            with self._lock:
+                ids = list(self.pending) if scan_ids is None else [i for i in scan_ids if i in self.pending]
+                batch = {scan_id: self.pending.pop(scan_id) for scan_id in ids}
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch):
+        main = {}
+        separate = {column: {} for column in SEPARATE_FIELDS}
+        for scan_id, fields in batch.items():
+            for column, value in fields.items():
+                if column in separate:
+                    separate[column][scan_id] = {column: value}
+                else:
+                    main.setdefault(scan_id, {})[column] = value
+        self._send_groups(main)
+        for column_batch in separate.values():
+            self._send_groups(column_batch)
+
+    def _send_groups(self, batch):
+        # Scans getting identical values (e.g. status="completed") share one update
+        by_values = {}
+        for scan_id, fields in batch.items():
+            by_values.setdefault(json.dumps(fields, sort_keys=True), []).append(scan_id)
+
+        # The rest are upserted in groups with the same columns
+        by_columns = {}
+        for scan_ids in by_values.values():
+            fields = batch[scan_ids[0]]
+            if self.use_upsert and len(scan_ids) == 1:
+                by_columns.setdefault(tuple(sorted(fields)), []).append(scan_ids[0])
+            else:
+                self._apply(batch, scan_ids, lambda ids=scan_ids, f=fields: update_scan_records(ids, **f))
+
+        for scan_ids in by_columns.values():
+            if len(scan_ids) == 1:
+                fields = batch[scan_ids[0]]
+                self._apply(batch, scan_ids, lambda ids=scan_ids, f=fields: update_scan_records(ids, **f))
+            else:
+                rows = [{"id": scan_id, **batch[scan_id]} for scan_id in scan_ids]
+                self._apply(batch, scan_ids, lambda rows=rows: upsert_scan_records(rows))
+
+    def _apply(self, batch, scan_ids, send):
+        self.requests += 1
+        try:
+            send()
+        except Exception as e:
+            print(f"Scan write failed for {len(scan_ids)} scan(s): {e}")
+            self._requeue({scan_id: batch[scan_id] for scan_id in scan_ids})
+            return
+        with self._lock:
+            for scan_id in scan_ids:
+                # Unless another column of this flush failed and was requeued
+                if scan_id not in self.pending:
+                    self.attempts.pop(scan_id, None)
+                if "status" in batch[scan_id]:
+                    self.statuses.set(scan_id, batch[scan_id]["status"])
+
+    def _requeue(self, batch):
+        with self._lock:
+            for scan_id, fields in batch.items():
+                self.attempts[scan_id] = self.attempts.get(scan_id, 0) + 1
+                if self.attempts[scan_id] >= MAX_ATTEMPTS:
+                    print(f"[{scan_id}] Dropping buffered fields after {MAX_ATTEMPTS} failed writes: {sorted(fields)}")
+                    self.attempts.pop(scan_id)
+                    self.dropped += 1
+                    continue
+                # Anything written since takes precedence
+                self.pending[scan_id] = {**fields, **self.pending.get(scan_id, {})}
+        self._ensure_timer()
+
+    def _ensure_timer(self):
+        if self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread_pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="scan-writer", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Scan writer flush failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "writes": self.writes,
+                "requests": self.requests,
+                "pending": len(self.pending),
+                "dropped": self.dropped,
+            }
+
+scan_writer = ScanWriter()
+atexit.register(scan_writer.flush)
@@ -0,0 +1,434 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+import cv2
+from PIL import Image, ImageOps
+
+from image_io import open_image
+
+# Longest side of the image the local detector works on
+LOCAL_DETECT_SIZE = int(os.environ.get("LOCAL_SEGMENTATION_SIZE", "640"))
+# Below this confidence the "auto" backend asks Gemini instead
+LOCAL_MIN_CONFIDENCE = float(os.environ.get("LOCAL_SEGMENTATION_MIN_CONFIDENCE", "0.6"))
+
+# Height / width of a door seen roughly head-on, with room for perspective
+DOOR_ASPECT_RANGE = (1.6, 3.2)
+# Smallest door worth considering, and the size from which it scores fully
+MIN_AREA_FRACTION = 0.05
+FULL_AREA_FRACTION = 0.2
+# Hough segments kept per orientation; every pair of each forms a candidate
+MAX_LINES = 8
+# Samples per quad side, and how far either side of it brightness is compared
+SIDE_SAMPLES = 32
+CONTRAST_OFFSET = 4
+# Mean brightness step across every side that counts as a clear boundary
+CONTRAST_FULL = 20.0
+# A quad inside the best one keeping this share of its area and score is the
+# door within its frame
+NESTED_AREA = 0.7
+NESTED_SCORE = 0.9
+# Corner refinement: brightness profiles taken across each side, and the
+# smallest step along one that counts as the door's edge
+REFINE_SAMPLES = 48
+REFINE_MIN_STEP = 6.0
+
+def order_corners(pts):
+    """
+    Orders four (x, y) points TL, TR, BR, BL as float32.
+    """
+    pts = np.asarray(pts, dtype=np.float32).reshape(4, 2)
+    # Sort by Y first
+    pts = pts[np.argsort(pts[:, 1], kind="stable")]
+    top = pts[:2]
+    bottom = pts[2:]
+    # Sort top by X, bottom by X
+    top = top[np.argsort(top[:, 0], kind="stable")]
+    bottom = bottom[np.argsort(bottom[:, 0], kind="stable")]
+    return np.array([top[0], top[1], bottom[1], bottom[0]], dtype="float32")
+
+def load_detection_image(image, im=None, size=LOCAL_DETECT_SIZE):
+    """
+    Grayscale copy of the oriented photo, at most `size` pixels on its
+    longest side. JPEGs are draft-decoded straight to that scale.
+    """
+    if im is None:
+        im = open_image(image)
+        im.draft("L", (size, size))
+        im = ImageOps.exif_transpose(im)
+    else:
+        im = im.copy()
+    im.thumbnail((size, size), Image.Resampling.BILINEAR)
+    return np.asarray(im.convert("L"))
+
+def edge_map(blurred):
+    high, _ = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return cv2.Canny(blurred, max(10, high * 0.25), max(20, high * 0.5))
+
+def _line_position(seg, vertical, width, height):
+    # x at mid-height for verticals, y at mid-width for horizontals
+    x1, y1, x2, y2 = seg
+    if vertical:
+        return x1 + (x2 - x1) * (height / 2 - y1) / ((y2 - y1) or 1)
+    return y1 + (y2 - y1) * (width / 2 - x1) / ((x2 - x1) or 1)
+
+def _strongest_lines(segments, vertical, width, height):
+    """
+    The longest segments of one orientation, skipping near-duplicates.
+    """
+    span = width if vertical else height
+    kept = []
+    for seg in sorted(segments, key=lambda s: -np.hypot(s[2] - s[0], s[3] - s[1])):
+        position = _line_position(seg, vertical, width, height)
+        if all(abs(position - p) > span * 0.01 for p, _ in kept):
+            kept.append((position, seg))
+            if len(kept) == MAX_LINES:
+                break
+    return sorted(kept, key=lambda k: k[0])
+
+def _intersections(lines_a, lines_b):
+    """
+    Intersection points (len(a) x len(b) x 2) of two sets of (x1, y1, x2, y2)
+    segments extended to lines; NaN where they are parallel.
+    """
+    a = lines_a[:, None, :]
+    b = lines_b[None, :, :]
+    da = a[..., 2:] - a[..., :2]
+    db = b[..., 2:] - b[..., :2]
+    denom = da[..., 0] * db[..., 1] - da[..., 1] * db[..., 0]
+    diff = b[..., :2] - a[..., :2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (diff[..., 0] * db[..., 1] - diff[..., 1] * db[..., 0]) / denom
+    t = np.where(np.abs(denom) < 1e-9, np.nan, t)
+    return a[..., :2] + da * t[..., None]
+
+def _pairs(positions, min_gap):
+    # (i, j) index pairs of sorted positions at least min_gap apart
+    i, j = np.triu_indices(len(positions), k=1)
+    keep = positions[j] - positions[i] >= min_gap
+    return i[keep], j[keep]
+
+def line_quads(edges):
+    """
+    Candidate quads from pairs of near-vertical and near-horizontal Hough
+    segments, so a door edge broken by chalk or shadow still counts.
+    Corners come out ordered TL, TR, BR, BL.
+    """
+    height, width = edges.shape
+    segments = cv2.HoughLinesP(
+        edges, 1, np.pi / 90, threshold=60,
+        minLineLength=int(min(width, height) * 0.15), maxLineGap=int(max(width, height) * 0.02)
+    )
+    if segments is None:
+        return np.empty((0, 4, 2), dtype=np.float32)
+    verticals, horizontals = [], []
+    for seg in segments.reshape(-1, 4).astype(np.float64):
+        dx, dy = abs(seg[2] - seg[0]), abs(seg[3] - seg[1])
+        if dx < dy * 0.36:  # within 20 degrees of vertical
+            verticals.append(seg)
+        elif dy < dx * 0.58:  # within 30 degrees of horizontal
+            horizontals.append(seg)
+    verticals = _strongest_lines(verticals, True, width, height)
+    horizontals = _strongest_lines(horizontals, False, width, height)
+    if len(verticals) < 2 or len(horizontals) < 2:
+        return np.empty((0, 4, 2), dtype=np.float32)
+
+    v_pos = np.array([p for p, _ in verticals])
+    h_pos = np.array([p for p, _ in horizontals])
+    points = _intersections(np.array([s for _, s in horizontals]), np.array([s for _, s in verticals]))
+    left, right = _pairs(v_pos, width * 0.1)
+    top, bottom = _pairs(h_pos, height * 0.2)
+    left, top = np.repeat(left, len(top)), np.tile(top, len(left))
+    right, bottom = np.repeat(right, len(bottom)), np.tile(bottom, len(right))
+    quads = np.stack([points[top, left], points[top, right], points[bottom, right], points[bottom, left]], axis=1)
+    return quads[np.isfinite(quads).all(axis=(1, 2))].astype(np.float32)
+
+def contour_quads(edges):
+    """
+    Candidate quads from closed edge contours that simplify to four corners.
+    """
+    height, width = edges.shape
+    closed = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+    contours, _ = cv2.findContours(closed, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    quads = []
+    for cnt in contours:
+        hull = cv2.convexHull(cnt)
+        if cv2.contourArea(hull) < width * height * MIN_AREA_FRACTION:
+            continue
+        approx = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+        if len(approx) == 4:
+            quads.append(approx.reshape(4, 2).astype(np.float32))
+    return quads
+
+def _sample(img, pts):
+    height, width = img.shape
+    xs = np.clip(np.round(pts[..., 0]).astype(np.intp), 0, width - 1)
+    ys = np.clip(np.round(pts[..., 1]).astype(np.intp), 0, height - 1)
+    return img[ys, xs]
+
+def score_quads(quads, gray, support):
+    """
+    Confidence in [0, 1] for each of `quads` (N x 4 x 2, ordered TL, TR,
+    BR, BL) that it is a door: how much of its outline lies on edges, how
+    consistently each side separates a darker from a lighter region, how
+    door-shaped and how large it is. 0 for quads that can't be one.
+    """
+    height, width = gray.shape
+    starts = quads
+    ends = np.roll(quads, -1, axis=1)
+    sides = ends - starts
+    lengths = np.linalg.norm(sides, axis=2)
+
+    # Convex (all turns the same way), inside the frame and big enough
+    turns = sides[..., 0] * np.roll(sides, -1, axis=1)[..., 1] - sides[..., 1] * np.roll(sides, -1, axis=1)[..., 0]
+    convex = np.all(turns > 0, axis=1) | np.all(turns < 0, axis=1)
+    margin = 0.02 * max(width, height)
+    in_frame = (
+        (quads[..., 0].min(axis=1) > -margin) & (quads[..., 1].min(axis=1) > -margin)
+        & (quads[..., 0].max(axis=1) < width + margin) & (quads[..., 1].max(axis=1) < height + margin)
+    )
+    area = 0.5 * np.abs(np.sum(starts[..., 0] * ends[..., 1] - ends[..., 0] * starts[..., 1], axis=1))
+    valid = convex & in_frame & (area >= width * height * MIN_AREA_FRACTION)
+
+    # Points along each side (corners skipped), and just inside / outside it
+    t = np.linspace(0.05, 0.95, SIDE_SAMPLES)[None, None, :, None]
+    points = starts[:, :, None, :] + sides[:, :, None, :] * t
+    normals = np.stack([-sides[..., 1], sides[..., 0]], axis=-1) / np.maximum(lengths, 1e-6)[..., None]
+    towards_centre = quads.mean(axis=1, keepdims=True) - (starts + ends) / 2
+    normals *= np.where(np.sum(normals * towards_centre, axis=-1) < 0, -1, 1)[..., None]
+    offset = normals[:, :, None, :] * CONTRAST_OFFSET
+
+    on_edge = (_sample(support, points) > 0).mean(axis=2)
+    edge_score = 0.5 * on_edge.mean(axis=1) + 0.5 * on_edge.min(axis=1)
+
+    difference = _sample(gray, points + offset).astype(np.float32) - _sample(gray, points - offset)
+    contrast = np.abs(difference.mean(axis=2)).min(axis=1)
+    contrast_score = np.minimum(1.0, contrast / CONTRAST_FULL)
+
+    aspect = (lengths[:, 1] + lengths[:, 3]) / np.maximum(1e-6, lengths[:, 0] + lengths[:, 2])
+    low, high = DOOR_ASPECT_RANGE
+    aspect_score = np.minimum(1.0, np.minimum(aspect / low, high / np.maximum(aspect, 1e-6)))
+
+    area_score = np.minimum(1.0, area / (width * height * FULL_AREA_FRACTION))
+    return np.where(valid, edge_score * contrast_score * aspect_score ** 2 * area_score, 0.0), area
+
+def _inside(inner, outer):
+    return all(cv2.pointPolygonTest(outer.reshape(-1, 1, 2), (float(x), float(y)), False) >= 0 for x, y in inner)
+
+def detect_door(gray):
+    """
+    Finds the most door-like quadrilateral in a grayscale image.
+    Returns (corners ordered TL, TR, BR, BL, confidence), or (None, 0.0).
+    """
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    edges = edge_map(blurred)
+    quads = [order_corners(quad) for quad in contour_quads(edges)]
+    quads = np.concatenate([np.array(quads, dtype=np.float32).reshape(-1, 4, 2), line_quads(edges)])
+    if not len(quads):
+        return None, 0.0
+    # Allow a pixel or two between a candidate's side and the edge it follows
+    support = cv2.dilate(edges, np.ones((5, 5), np.uint8))
+    scores, areas = score_quads(quads, blurred, support)
+
+    best = int(np.argmax(scores))
+    if scores[best] <= 0:
+        return None, 0.0
+    # Gemini is asked for the door without its frame: a near-as-good quad
+    # nested just inside the winner is the door within that frame
+    while True:
+        nested = [
+            i for i in np.argsort(-scores)
+            if scores[i] >= scores[best] * NESTED_SCORE and NESTED_AREA * areas[best] <= areas[i] < areas[best]
+            and _inside(quads[i], quads[best])
+        ]
+        if not nested:
+            return quads[best], float(scores[best])
+        best = int(nested[0])
+
+def quad_item(corners, width, height, confidence):
+    """
+    A segmentation item for a quad found on a width x height image: box_2d
+    and "polygon" ([y, x] corner pairs) normalized to 0-1000 like Gemini's.
+    """
+    xs = np.clip(corners[:, 0], 0, width) / width * 1000
+    ys = np.clip(corners[:, 1], 0, height) / height * 1000
+    return {
+        "box_2d": [int(np.floor(ys.min())), int(np.floor(xs.min())), int(np.ceil(ys.max())), int(np.ceil(xs.max()))],
+        "polygon": [[round(float(y), 2), round(float(x), 2)] for x, y in zip(xs, ys)],
+        "mask": None,
+        "label": "door",
+        "source": "local",
+        "confidence": round(confidence, 3),
+    }
+
+def score_mask(mask):
+    """
+    How door-like a candidate's binary mask is, in [0, 1]: filled and
+    rectangular (a hollow doorframe is not), door-shaped and large enough,
+    on the same aspect and area terms as score_quads.
+    Returns (score, details).
+    """
+    height, width = mask.shape
+    filled = cv2.countNonZero(mask)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not filled or not contours:
+        return 0.0, {"area": 0.0, "rectangularity": 0.0, "aspect": 0.0}
+
+    rect = cv2.minAreaRect(max(contours, key=cv2.contourArea))
+    corners = order_corners(cv2.boxPoints(rect))
+    sides = np.linalg.norm(np.roll(corners, -1, axis=0) - corners, axis=1)
+    rect_area = max(1.0, sides[0] * sides[1])
+    rectangularity = min(1.0, float(filled / rect_area))
+
+    # Height (left and right sides) over width, like score_quads
+    aspect = (sides[1] + sides[3]) / max(1e-6, sides[0] + sides[2])
+    low, high = DOOR_ASPECT_RANGE
+    aspect_score = min(1.0, aspect / low, high / max(aspect, 1e-6))
+
+    area = filled / (width * height)
+    area_score = min(1.0, area / FULL_AREA_FRACTION) if area >= MIN_AREA_FRACTION else 0.0
+    details = {"area": round(area, 3), "rectangularity": round(rectangularity, 3), "aspect": round(float(aspect), 2)}
+    return float(rectangularity ** 2 * aspect_score ** 2 * area_score), details
+
+def _fit_side(image, start, end, radius):
+    """
+    (point, direction) of the line through the strongest brightness step
+    within `radius` pixels of the side start-end, or None if too little of
+    the side has one.
+    """
+    side = end - start
+    length = float(np.linalg.norm(side))
+    if length < 1:
+        return None
+    normal = np.array([-side[1], side[0]], dtype=np.float32) / length
+    t = np.linspace(0.1, 0.9, REFINE_SAMPLES, dtype=np.float32)[:, None]
+    offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+    points = start + side * t
+    grid = points[:, None, :] + offsets[None, :, None] * normal
+    profiles = cv2.remap(
+        image, np.ascontiguousarray(grid[..., 0]), np.ascontiguousarray(grid[..., 1]),
+        cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE,
+    ).astype(np.float32)
+    if profiles.ndim == 3:
+        profiles = profiles @ np.float32([0.114, 0.587, 0.299])
+
+    # Step k lies between offsets k and k + 1; a parabola through its
+    # neighbours places the peak to a fraction of a pixel
+    steps = np.abs(np.diff(profiles, axis=1))
+    rows = np.arange(len(steps))
+    best = np.argmax(steps, axis=1)
+    strength = steps[rows, best]
+    left = steps[rows, np.maximum(best - 1, 0)]
+    right = steps[rows, np.minimum(best + 1, steps.shape[1] - 1)]
+    curvature = np.minimum(left - 2 * strength + right, -1e-6)
+    shift = np.clip(0.5 * (left - right) / curvature, -0.5, 0.5)
+    keep = (strength >= REFINE_MIN_STEP) & (best > 0) & (best < steps.shape[1] - 1)
+    if keep.sum() < REFINE_SAMPLES // 3:
+        return None
+
+    edge = points + (offsets[best] + 0.5 + shift)[:, None] * normal
+    vx, vy, x0, y0 = cv2.fitLine(edge[keep], cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+    return np.array([x0, y0]), np.array([vx, vy])
+
+def _intersect(line_a, line_b):
+    (p, d), (q, e) = line_a, line_b
+    cross = d[0] * e[1] - d[1] * e[0]
+    if abs(cross) < 1e-3:
+        return None
+    a = ((q[0] - p[0]) * e[1] - (q[1] - p[1]) * e[0]) / cross
+    return p + a * d
+
+def refine_corners(image, corners, radius):
+    """
+    Snaps a coarse quad (TL, TR, BR, BL) to the door's edges in `image`
+    (gray or BGR): each side is refit to the strongest edge within
+    `radius` pixels and the corners become the sides' intersections, to a
+    fraction of a pixel. Corners whose sides can't be refit stay put.
+    """
+    corners = np.asarray(corners, dtype=np.float32)
+    radius = max(2, int(np.ceil(radius)))
+    lines = [_fit_side(image, corners[i], corners[(i + 1) % 4], radius) for i in range(4)]
+    refined = corners.copy()
+    for i in range(4):
+        # Corner i is where side i - 1 meets side i
+        if lines[i - 1] is None or lines[i] is None:
+            continue
+        point = _intersect(lines[i - 1], lines[i])
+        if point is not None and np.linalg.norm(point - corners[i]) <= 2 * radius:
+            refined[i] = point
+    return refined
+
+class SegmentationBackend(ABC):
+    """
+    Finds the door in a photo. segment() returns Gemini-style items
+    (box_2d, mask, label), best first; `im` is the oriented PIL image if
+    the caller already decoded one.
+    """
+    name = None
+
+    @abstractmethod
+    def segment(self, image, api_key=None, im=None):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"backend": self.name}
+
+class LocalSegmentation(SegmentationBackend):
+    """
+    Classical CV door detection: Canny edges, contour and Hough line
+    quadrilaterals, scored by edge support, door shape and size. Runs in a
+    few milliseconds on the CPU; items carry the door "polygon" and a
+    "confidence".
+    """
+    name = "local"
+
+    def __init__(self, size=LOCAL_DETECT_SIZE):
+        self.size = size
+
+    def segment(self, image, api_key=None, im=None):
+        gray = load_detection_image(image, im=im, size=self.size)
+        corners, confidence = detect_door(gray)
+        if corners is None:
+            raise ValueError("Local segmentation found no door.")
+        height, width = gray.shape
+        return [quad_item(corners, width, height, confidence)]
+
+class CascadeSegmentation(SegmentationBackend):
+    """
+    Tries the local detector first and only calls `fallback` (Gemini) when
+    it finds nothing or its confidence is below `min_confidence`.
+    """
+    name = "auto"
+
+    def __init__(self, local, fallback, min_confidence=LOCAL_MIN_CONFIDENCE):
+        self.local = local
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.escalations = 0
+
+    def segment(self, image, api_key=None, im=None):
+        try:
+            items = self.local.segment(image, api_key, im=im)
+        except ValueError:
+            items = []
+        confidence = items[0].get("confidence", 0.0) if items else 0.0
+        if confidence >= self.min_confidence:
+            with self._lock:
+                self.local_hits += 1
+            return items
+
+        print(f"Local segmentation unsure (confidence {confidence:.2f}), asking {self.fallback.name}")
+        with self._lock:
+            self.escalations += 1
+        return self.fallback.segment(image, api_key, im=im)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "min_confidence": self.min_confidence,
+                "local": self.local_hits,
+                "escalated": self.escalations,
+            }
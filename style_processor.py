@@ -2,10 +2,11 @@ import cv2
 import numpy as np
 import io
 import os
-from google import genai
 from google.genai import types
 from PIL import Image, ImageEnhance
 
+from model_gateway import generate_content
+
 def bytes_to_cv2(image_bytes):
     nparr = np.frombuffer(image_bytes, np.uint8)
     return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
@@ -16,10 +17,49 @@ def cv2_to_bytes(img_cv):
         raise ValueError("Failed to encode image")
     return io.BytesIO(buffer).read()
 
-def make_ugly(image_bytes):
+def drip_columns(small, small_gray, rng, threshold=80):
+    """
+    Vectorized pixel drip: every run of bright pixels in a column drips its
+    last pixel's colour downwards. Inner runs drip 10-99px, the last run of a
+    column 20-149px. Where drips overlap, the lower drip wins.
+    """
+    h = small_gray.shape[0]
+    bright = small_gray > threshold
+
+    # A run ends on a bright pixel followed by a dark one (or the bottom edge)
+    ends = bright.copy()
+    ends[:-1] &= ~bright[1:]
+
+    # Column-major so lengths are drawn in the same order as a per-column scan
+    xs, ys = np.nonzero(ends.T)
+    output = small.copy()
+    if xs.size == 0:
+        return output
+
+    last_in_column = np.ones(xs.size, dtype=bool)
+    last_in_column[:-1] = xs[1:] != xs[:-1]
+    lengths = rng.integers(np.where(last_in_column, 20, 10), np.where(last_in_column, 150, 100))
+    lengths = np.minimum(lengths, h - ys)
+    colors = small[ys, xs]
+
+    # Longest drips first, so drips still active at offset d are a prefix
+    order = np.argsort(-lengths, kind="stable")
+    ys, xs, lengths, colors = ys[order], xs[order], lengths[order], colors[order]
+    neg_lengths = -lengths
+
+    # Paint from the furthest offset inwards so the nearest (lowest) start wins
+    for d in range(int(lengths[0]) - 1, -1, -1):
+        k = np.searchsorted(neg_lengths, -d, side="left")
+        output[ys[:k] + d, xs[:k]] = colors[:k]
+
+    return output
+
+def make_ugly(image_bytes, rng=None):
     """
     Ugly: Hyper-Drip (Pixel Sorting + Deep Fry).
+    Pass a seed or np.random.Generator as `rng` for reproducible output.
     """
+    rng = np.random.default_rng(rng)
     img = bytes_to_cv2(image_bytes)
     h, w = img.shape[:2]
     
@@ -32,23 +72,7 @@ def make_ugly(image_bytes):
     small_w = w // 2 
     small = cv2.resize(img, (small_w, h))
     small_gray = cv2.resize(gray, (small_w, h))
-    output = small.copy()
-    
-    for x in range(small_w):
-        bright_indices = np.where(small_gray[:, x] > 80)[0]
-        if len(bright_indices) > 0:
-            last_y = bright_indices[0]
-            for y in bright_indices:
-                if y > last_y + 1: 
-                    length = np.random.randint(10, 100)
-                    end = min(h, last_y + length)
-                    color = small[last_y, x]
-                    output[last_y:end, x] = color
-                last_y = y
-            length = np.random.randint(20, 150)
-            end = min(h, last_y + length)
-            color = small[last_y, x]
-            output[last_y:end, x] = color
+    output = drip_columns(small, small_gray, rng)
 
     final = cv2.resize(output, (w, h))
     return cv2_to_bytes(final)
@@ -57,47 +81,38 @@ def make_pretty(image_bytes, gemini_api_key):
     """
     Pretty: Image-to-Image Generation.
     Uses [prompt, image] pattern to generate a photorealistic version.
+    Raises once the model gateway's retries are used up.
     """
-    client = genai.Client(api_key=gemini_api_key)
     pil_img = Image.open(io.BytesIO(image_bytes))
     
     prompt = "Create a high-quality, photorealistic studio photograph based on this chalk drawing. Replace the chalk lines with real objects and cinematic lighting. Make it really beautiful. Make the background light. Feel free to make it abstract!"
 
-    try:
-        # Using the specific Image-to-Image preview model from your list
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=[prompt, pil_img],
-        )
-        
-        # Extract Image from parts (Inline Data)
-        if response.candidates and response.candidates[0].content.parts:
-            for part in response.candidates[0].content.parts:
-                if part.inline_data:
-                    return part.inline_data.data # Bytes
-                    
-        raise ValueError("No image part found in response")
-
-    except Exception as e:
-        print(f"Prettify failed: {e}")
-        return image_bytes
+    # Using the specific Image-to-Image preview model from your list
+    response = generate_content(
+        gemini_api_key, "gemini-2.5-flash-image", [prompt, pil_img], operation="pretty"
+    )
+
+    # Extract Image from parts (Inline Data)
+    if response.candidates and response.candidates[0].content.parts:
+        for part in response.candidates[0].content.parts:
+            if part.inline_data:
+                return part.inline_data.data # Bytes
+
+    raise ValueError("No image part found in response")
 
 def make_slop(image_bytes, gemini_api_key):
     """
     Slop: Vision-to-Text.
-    Generates 5 paragraphs of text slop.
+    Generates 5 paragraphs of text slop. Raises once the model gateway's
+    retries are used up.
     """
-    client = genai.Client(api_key=gemini_api_key)
     pil_img = Image.open(io.BytesIO(image_bytes))
     prompt = "Identify the key items in this chalk drawing. Then, write 5 paragraphs of pure AI slop about it. Tone: Corporate/LinkedIn rambling."
 
-    try:
-        response = client.models.generate_content(
-            model="gemini-3-flash-preview", 
-            contents=[prompt, pil_img]
-        )
-        # We only want the text response here
-        return response.text
-    except Exception as e:
-        print(f"Error generating slop: {e}")
-        return "Error generating slop."
+    response = generate_content(
+        gemini_api_key, "gemini-3-flash-preview", [prompt, pil_img], operation="slop"
+    )
+    # We only want the text response here
+    if not response.text:
+        raise ValueError("No text in slop response")
+    return response.text
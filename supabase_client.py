@@ -1,38 +1,189 @@
 import os
+import threading
+import httpx
 from supabase import create_client, Client
+from supabase.lib.client_options import SyncClientOptions
+
+from metrics import external_call
+
+# Connection pool settings for the shared HTTP client (override via env)
+POOL_MAX_CONNECTIONS = int(os.environ.get("SUPABASE_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.environ.get("SUPABASE_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get("SUPABASE_POOL_KEEPALIVE_EXPIRY", "30"))
+HTTP_TIMEOUT = float(os.environ.get("SUPABASE_HTTP_TIMEOUT", "60"))
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "clients_created": 0,
+    "client_reuses": 0,
+    "requests": 0,
+    "connections_opened": 0,
+}
+
+# Called as fn(scan_id, fields, created) after every successful scan insert/update
+_scan_write_listeners = []
+
+def add_scan_write_listener(fn):
+    """
+    Registers `fn` to hear about scan writes made by this process, so
+    caches and event streams can follow a scan without polling the DB.
+    """
+    _scan_write_listeners.append(fn)
+
+def _notify_scan_write(scan_id, fields, created=False):
+    for fn in _scan_write_listeners:
+        try:
+            fn(scan_id, fields, created)
+        except Exception as e:
+            print(f"[{scan_id}] Scan write listener failed: {e}")
+
+def _bump(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+class CountingTransport(httpx.HTTPTransport):
+    """
+    HTTP transport that counts requests and freshly opened TCP connections,
+    so we can tell how often keep-alive connections are being reused.
+    """
+    def handle_request(self, request):
+        _bump("requests")
+        inner_trace = request.extensions.get("trace")
+
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                _bump("connections_opened")
+            if inner_trace is not None:
+                inner_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        return super().handle_request(request)
+
+def _build_http_client():
+    limits = httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+    )
+    return httpx.Client(
+        transport=CountingTransport(limits=limits, http2=True),
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+    )
 
 def get_supabase_client():
-    url = os.environ.get("SUPABASE_URL")
-    key = os.environ.get("SUPABASE_KEY") # Recommended: Service Role Key
-    
-    if not url or not key:
-        raise ValueError("Supabase URL or Key not found in environment variables.")
-        
-    return create_client(url, key)
+    """
+    Returns the process-wide Supabase client, creating it on first use.
+    All table and storage calls share one pooled, keep-alive HTTP client.
+    The client is rebuilt after a fork so worker processes never share sockets.
+    """
+    global _client, _client_pid
+
+    client = _client
+    if client is not None and _client_pid == os.getpid():
+        _bump("client_reuses")
+        return client
+
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            url = os.environ.get("SUPABASE_URL")
+            key = os.environ.get("SUPABASE_KEY") # Recommended: Service Role Key
+
+            if not url or not key:
+                raise ValueError("Supabase URL or Key not found in environment variables.")
+
+            options = SyncClientOptions(httpx_client=_build_http_client())
+            _client = create_client(url, key, options=options)
+            _client_pid = os.getpid()
+            _bump("clients_created")
+        else:
+            _bump("client_reuses")
+        return _client
+
+def reset_supabase_client():
+    """
+    Closes the shared client's connections. The next call builds a fresh one.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        client, _client, _client_pid = _client, None, None
+    if client is not None:
+        try:
+            client.options.httpx_client.close()
+        except Exception as e:
+            print(f"Supabase client close error: {e}")
 
-def upload_image_to_supabase(image_bytes, file_name, folder="processed", bucket_name="chalk-images"):
+def get_pool_stats():
     """
-    Uploads bytes to Supabase Storage in a specific folder and returns the public URL.
+    Returns connection pool settings and reuse counters for the shared client.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["connections_reused"] = max(0, stats["requests"] - stats["connections_opened"])
+    stats["pool"] = {
+        "max_connections": POOL_MAX_CONNECTIONS,
+        "max_keepalive_connections": POOL_MAX_KEEPALIVE,
+        "keepalive_expiry": POOL_KEEPALIVE_EXPIRY,
+    }
+    return stats
+
+def get_public_url(file_name, folder="processed", bucket_name="chalk-images"):
+    """
+    Public URL an object will have once uploaded (no request is made).
+    """
+    project_url = os.environ.get("SUPABASE_URL").rstrip("/")
+    return f"{project_url}/storage/v1/object/public/{bucket_name}/{folder}/{file_name}"
+
+def upload_image_to_supabase(image_bytes, file_name, folder="processed", bucket_name="chalk-images", upsert=False, content_type="image/jpeg"):
+    """
+    Uploads bytes (or a file path, streamed from disk) to Supabase Storage in a
+    specific folder and returns the public URL.
+    Pass upsert=True to overwrite an existing object (e.g. when a job is retried).
     """
     supabase = get_supabase_client()
     file_path = f"{folder}/{file_name}"
-    file_options = {"content-type": "image/jpeg"}
+    file_options = {"content-type": content_type}
+    if upsert:
+        file_options["upsert"] = "true"
     
     try:
-        supabase.storage.from_(bucket_name).upload(
-            path=file_path,
-            file=image_bytes,
-            file_options=file_options
-        )
+        with external_call("storage", "upload"):
+            if isinstance(image_bytes, (str, os.PathLike)):
+                with open(image_bytes, "rb") as f:
+                    supabase.storage.from_(bucket_name).upload(
+                        path=file_path,
+                        file=f,
+                        file_options=file_options
+                    )
+            else:
+                supabase.storage.from_(bucket_name).upload(
+                    path=file_path,
+                    file=image_bytes,
+                    file_options=file_options
+                )
         
-        project_url = os.environ.get("SUPABASE_URL").rstrip("/")
-        public_url = f"{project_url}/storage/v1/object/public/{bucket_name}/{file_path}"
-        return public_url
+        return get_public_url(file_name, folder, bucket_name)
         
     except Exception as e:
         print(f"Supabase Upload Error ({folder}): {e}")
         raise e
 
+def download_image_from_supabase(file_name, folder="originals", bucket_name="chalk-images"):
+    """
+    Downloads an object from Supabase Storage and returns its bytes.
+    """
+    supabase = get_supabase_client()
+    try:
+        with external_call("storage", "download"):
+            return supabase.storage.from_(bucket_name).download(f"{folder}/{file_name}")
+    except Exception as e:
+        print(f"Supabase Download Error ({folder}): {e}")
+        raise e
+
 def insert_scan_record(scan_id, original_url, processed_url=None, status="completed", error=None, **kwargs):
     """
     Inserts a tracking record into the chalk_scans table.
@@ -51,7 +202,9 @@ def insert_scan_record(scan_id, original_url, processed_url=None, status="comple
         # Filter out None values to let DB defaults handle them
         data = {k: v for k, v in data.items() if v is not None}
         
-        response = supabase.table("chalk_scans").insert(data).execute()
+        with external_call("db", "insert"):
+            response = supabase.table("chalk_scans").insert(data).execute()
+        _notify_scan_write(scan_id, data, created=True)
         return response
     except Exception as e:
         print(f"Database Insert Error: {e}")
@@ -74,18 +227,53 @@ def update_scan_record(scan_id, **kwargs):
             return None
             
         # Direct update - simpler and avoids "partial insert" errors
-        return supabase.table("chalk_scans").update(data).eq("id", scan_id).execute()
+        with external_call("db", "update"):
+            response = supabase.table("chalk_scans").update(data).eq("id", scan_id).execute()
+        _notify_scan_write(scan_id, data)
+        return response
     except Exception as e:
         print(f"Database Update Error: {e}")
         return None
 
+def update_scan_records(scan_ids, **kwargs):
+    """
+    Applies the same field values to several scans in one request.
+    Raises on errors so the caller can retry.
+    """
+    data = {k: v for k, v in kwargs.items() if v is not None}
+    if not data or not scan_ids:
+        return None
+    supabase = get_supabase_client()
+    with external_call("db", "update"):
+        response = supabase.table("chalk_scans").update(data).in_("id", list(scan_ids)).execute()
+    for scan_id in scan_ids:
+        _notify_scan_write(scan_id, data)
+    return response
+
+def upsert_scan_records(rows):
+    """
+    Writes partial rows (dicts with "id" plus the same other columns) for
+    existing scans in one request. Raises on errors so the caller can retry.
+    Needs every other chalk_scans column to be nullable or defaulted, and
+    inserts a partial row for an unknown id; see SCAN_WRITE_UPSERT.
+    """
+    if not rows:
+        return None
+    supabase = get_supabase_client()
+    with external_call("db", "upsert"):
+        response = supabase.table("chalk_scans").upsert(rows, on_conflict="id").execute()
+    for row in rows:
+        _notify_scan_write(row["id"], {k: v for k, v in row.items() if k != "id"})
+    return response
+
 def get_scan_record(scan_id):
     """
     Fetches a single scan record by ID.
     """
     try:
         supabase = get_supabase_client()
-        response = supabase.table("chalk_scans").select("*").eq("id", scan_id).execute()
+        with external_call("db", "select"):
+            response = supabase.table("chalk_scans").select("*").eq("id", scan_id).execute()
         if response.data:
             return response.data[0]
         return None
@@ -99,10 +287,61 @@ def get_scan_by_room_id(room_id):
     """
     try:
         supabase = get_supabase_client()
-        response = supabase.table("chalk_scans").select("*").eq("room_id", room_id).execute()
+        with external_call("db", "select"):
+            response = supabase.table("chalk_scans").select("*").eq("room_id", room_id).execute()
         if response.data:
             return response.data[0]
         return None
     except Exception as e:
         print(f"Database Fetch Error (room_id): {e}")
-        return None
\ No newline at end of file
+        return None
+
+def get_semester_scans(semester, columns="*", after=None, limit=None):
+    """
+    Fetches a semester's scans ordered by id, selecting only `columns`.
+    `after` is a keyset cursor (the last id already returned).
+    Raises on errors so a failed read is never mistaken for an empty semester.
+    """
+    supabase = get_supabase_client()
+    query = supabase.table("chalk_scans").select(columns).eq("semester", semester).order("id")
+    if after:
+        query = query.gt("id", after)
+    if limit:
+        query = query.limit(limit)
+    with external_call("db", "select"):
+        return query.execute().data or []
+
+def get_scans_by_status(statuses):
+    """
+    Fetches every scan record whose status is one of `statuses`.
+    """
+    try:
+        supabase = get_supabase_client()
+        with external_call("db", "select"):
+            response = supabase.table("chalk_scans").select("*").in_("status", list(statuses)).execute()
+        return response.data or []
+    except Exception as e:
+        print(f"Database Fetch Error (status): {e}")
+        return []
+
+def get_scan_by_content_hash(content_hash):
+    """
+    Fetches a completed scan whose original image has the given content hash.
+    """
+    try:
+        supabase = get_supabase_client()
+        with external_call("db", "select"):
+            response = (
+                supabase.table("chalk_scans")
+                .select("*")
+                .eq("content_hash", content_hash)
+                .eq("status", "completed")
+                .limit(1)
+                .execute()
+            )
+        if response.data:
+            return response.data[0]
+        return None
+    except Exception as e:
+        print(f"Database Fetch Error (content_hash): {e}")
+        return None
@@ -53,6 +53,43 @@ def poll_status(url, scan_id):
             print(f"\n   Polling Error: {e}")
             return False
 
+def stream_status(url, scan_id):
+    """
+    Follows /scans/<scan_id>/events instead of polling.
+    Returns True/False when the scan finishes, None if the stream is unavailable.
+    """
+    print(f"📡 Streaming status for {scan_id}...")
+    start_time = time.time()
+    
+    try:
+        with requests.get(f"{url}/scans/{scan_id}/events", stream=True, timeout=(5, 60)) as r:
+            if r.status_code != 200:
+                print(f"   Event stream unavailable: {r.status_code}")
+                return None
+            
+            event = None
+            for line in r.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    elapsed = int(time.time() - start_time)
+                    print(f"   [{elapsed}s] {event}: status={data.get('status')}")
+                    
+                    if data.get("status") == "completed":
+                        print("\n✅ Pipeline Finished!")
+                        print(json.dumps(data, indent=2))
+                        return True
+                    if data.get("status") == "failed":
+                        print(f"\n❌ Pipeline Failed: {data.get('error_message')}")
+                        return False
+    except KeyboardInterrupt:
+        print("\n   Streaming cancelled by user.")
+        return False
+    except Exception as e:
+        print(f"   Streaming Error: {e}")
+    return None
+
 def test_process(url, image_path, semester="Spring 2026"):
     print(f"🚀 Testing Upload on {url}/process...")
     
@@ -71,8 +108,11 @@ def test_process(url, image_path, semester="Spring 2026"):
             scan_id = resp_data.get('scan_id')
             print(f"   ✅ Upload Accepted! Scan ID: {scan_id}")
             
-            # Start Polling
-            poll_status(url, scan_id)
+            # Follow the event stream, falling back to polling
+            finished = stream_status(url, scan_id)
+            if finished is None:
+                finished = poll_status(url, scan_id)
+            return finished
             
         elif response.status_code == 200:
             print("   ✅ Sync Response (Old API behavior):")
@@ -84,6 +124,24 @@ def test_process(url, image_path, semester="Spring 2026"):
     except Exception as e:
         print(f"   ❌ Request Failed: {e}")
 
+def test_dedup(url, image_path, semester="Spring 2026"):
+    """
+    Uploads the same image again: it should be answered at once (200) from
+    the content cache's memory tier, which the finished pipeline filled.
+    Only holds when the first scan ran in the web process (thread queue).
+    """
+    print(f"♻️  Testing duplicate upload on {url}/process...")
+    before = requests.get(url).json()["content_cache"]["memory_hits"]
+    with open(image_path, 'rb') as f:
+        response = requests.post(f"{url}/process", files={'image': f}, data={'semester': semester})
+    after = requests.get(url).json()["content_cache"]["memory_hits"]
+
+    if response.status_code == 200 and after == before + 1:
+        print(f"   ✅ Served from the memory tier: {response.json().get('chalkImage')}\n")
+        return True
+    print(f"   ❌ Expected 200 from memory, got {response.status_code} (memory hits {before} -> {after})\n")
+    return False
+
 if __name__ == "__main__":
     # CONFIGURATION
     BASE_URL = "http://127.0.0.1:5001" 
@@ -97,6 +155,7 @@ if __name__ == "__main__":
 
     if test_health(BASE_URL):
         if os.path.exists(TEST_IMAGE):
-            test_process(BASE_URL, TEST_IMAGE)
+            if test_process(BASE_URL, TEST_IMAGE):
+                test_dedup(BASE_URL, TEST_IMAGE)
         else:
             print(f"Skipping upload: {TEST_IMAGE} not found.")
\ No newline at end of file
@@ -0,0 +1,90 @@
+import os
+import time
+import random
+
+import httpx
+from storage3.exceptions import StorageApiError
+
+from image_io import is_path
+from supabase_client import upload_image_to_supabase
+from metrics import InstrumentedExecutor
+
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "8"))
+UPLOAD_ATTEMPTS = int(os.environ.get("UPLOAD_ATTEMPTS", "4"))
+UPLOAD_BACKOFF = float(os.environ.get("UPLOAD_BACKOFF", "0.5"))
+
+# Storage answers worth retrying (timeouts, rate limits, gateway hiccups)
+TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# (magic bytes at offset, offset, content type, extension)
+SIGNATURES = (
+    (b"\xff\xd8\xff", 0, "image/jpeg", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", 0, "image/png", ".png"),
+    (b"WEBP", 8, "image/webp", ".webp"),
+    (b"GIF8", 0, "image/gif", ".gif"),
+    (b"ftypavif", 4, "image/avif", ".avif"),
+    (b"ftypheic", 4, "image/heic", ".heic"),
+)
+
+def sniff_image_type(image, default=("image/jpeg", ".jpg")):
+    """
+    Returns (content_type, extension) from the leading bytes of `image`
+    (bytes or a path), falling back to `default` for unknown data.
+    """
+    if is_path(image):
+        with open(image, "rb") as f:
+            head = f.read(16)
+    else:
+        head = bytes(image[:16])
+    for magic, offset, content_type, extension in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return content_type, extension
+    return default
+
+def is_transient(error):
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, StorageApiError):
+        try:
+            return int(error.status) in TRANSIENT_STATUSES
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def upload_with_retry(image, file_name, folder="processed", bucket_name="chalk-images", upsert=False,
+                      content_type=None, attempts=None):
+    """
+    upload_image_to_supabase with the content type sniffed from the data and
+    transient failures retried with jittered exponential backoff.
+    """
+    attempts = attempts or UPLOAD_ATTEMPTS
+    content_type = content_type or sniff_image_type(image)[0]
+    for attempt in range(1, attempts + 1):
+        try:
+            return upload_image_to_supabase(
+                image, file_name, folder=folder, bucket_name=bucket_name,
+                upsert=upsert, content_type=content_type
+            )
+        except Exception as e:
+            if attempt == attempts or not is_transient(e):
+                raise
+            delay = UPLOAD_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            print(f"Upload of {folder}/{file_name} failed ({e}), retry {attempt}/{attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+class UploadService:
+    """
+    Pooled storage uploads. submit() returns a Future for the public URL,
+    so several artifacts can be written in parallel.
+    """
+    def __init__(self, workers=UPLOAD_WORKERS):
+        self.executor = InstrumentedExecutor(max_workers=workers, thread_name_prefix="upload")
+
+    def submit(self, image, file_name, folder="processed", bucket_name="chalk-images", upsert=False,
+               content_type=None):
+        return self.executor.submit(
+            upload_with_retry, image, file_name, folder=folder, bucket_name=bucket_name,
+            upsert=upsert, content_type=content_type
+        )
+
+upload_service = UploadService()
@@ -0,0 +1,169 @@
+"""
+Standalone worker that drains the durable job queue in separate processes,
+so OpenCV work never competes with request threads for the GIL.
+
+Usage: python worker.py [--processes N] [--queue-path jobs.db] [--resume] [--metrics-port PORT]
+"""
+import os
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+from dotenv import load_dotenv
+
+# Load local .env if present
+load_dotenv()
+
+from job_queue import SQLiteJobQueue, DEFAULT_VISIBILITY_TIMEOUT, PermanentJobError, enqueue_scan
+from pipeline import run_pipeline
+from image_io import discard_spooled
+from supabase_client import download_image_from_supabase, get_scans_by_status
+from scan_writer import scan_writer
+from metrics import STAGE_SECONDS, SCANS, serve as serve_metrics
+
+POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1.0"))
+
+def handle_job(job):
+    if job["kind"] != "process_scan":
+        raise ValueError(f"Unknown job kind: {job['kind']}")
+
+    payload = job["payload"]
+    scan_id = payload["scan_id"]
+    gemini_key = os.environ.get("GEMINI_API_KEY")
+    if not gemini_key:
+        raise ValueError("GEMINI_API_KEY missing")
+
+    image = job["data"]
+    if image is None and payload.get("image_path") and os.path.exists(payload["image_path"]):
+        image = payload["image_path"]
+    if image is None and payload.get("upload_original"):
+        # The API deferred the original's upload to this job: without the
+        # spooled file it was never stored, so no retry can find it
+        raise PermanentJobError(
+            f"Spooled upload {payload.get('image_path')} is gone and the original was never uploaded"
+        )
+    if image is None:
+        image = download_image_from_supabase(
+            payload["filename"],
+            folder="originals",
+            bucket_name=payload["bucket_name"]
+        )
+
+    timings = {}
+    if job.get("created_at"):
+        # Since enqueue, so retries include their backoff
+        timings["queue_wait"] = round(time.time() - job["created_at"], 3)
+        STAGE_SECONDS.observe(timings["queue_wait"], stage="queue_wait")
+
+    print(f"[{scan_id}] Worker {os.getpid()} starting attempt {job['attempts']}/{job['max_attempts']}...")
+    run_pipeline(
+        scan_id, image, payload["filename"], payload["bucket_name"], gemini_key,
+        upload_original=payload.get("upload_original", False), timings=timings,
+        room_id=payload.get("room_id")
+    )
+
+def _heartbeat(queue, job_id, done):
+    # Keep the job invisible to other workers for as long as we are alive
+    while not done.wait(DEFAULT_VISIBILITY_TIMEOUT / 3):
+        try:
+            queue.extend(job_id)
+        except Exception as e:
+            print(f"Heartbeat failed for job {job_id}: {e}")
+
+def run_job(queue, job):
+    scan_id = job["payload"].get("scan_id")
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(queue, job["id"], done), daemon=True).start()
+    try:
+        handle_job(job)
+        queue.ack(job["id"])
+        discard_spooled(job["payload"].get("image_path"))
+    except Exception as e:
+        if queue.fail(job["id"], e, retry=not isinstance(e, PermanentJobError)):
+            print(f"[{scan_id}] Attempt {job['attempts']} failed, will retry: {e}")
+        else:
+            print(f"[{scan_id}] Pipeline FAILED after {job['attempts']} attempts: {e}")
+            scan_writer.write(scan_id, status="failed", error_message=str(e))
+            SCANS.inc(status="failed")
+            discard_spooled(job["payload"].get("image_path"))
+    finally:
+        done.set()
+
+def work_loop(queue_path, metrics_port=None):
+    """
+    Claims and runs jobs until SIGTERM/SIGINT. The job in progress is finished first.
+    With `metrics_port`, this process serves its Prometheus metrics there.
+    """
+    if metrics_port:
+        serve_metrics(metrics_port)
+    queue = SQLiteJobQueue(queue_path)
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        print(f"Worker {os.getpid()} stopping after current job...")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"Worker {os.getpid()} polling {queue_path}")
+    while not stopping.is_set():
+        job = queue.claim()
+        if job is None:
+            stopping.wait(POLL_INTERVAL)
+            continue
+        run_job(queue, job)
+
+def resume_stalled_scans(queue, bucket_name):
+    """
+    Re-queues scans left in `queued` or `extracted` after a crash. Only run
+    this when no other process is still working on those scans.
+    """
+    records = get_scans_by_status(["queued", "extracted"])
+    for record in records:
+        scan_id = record["id"]
+        enqueue_scan(queue, scan_id, f"{scan_id}.jpg", bucket_name, room_id=record.get("room_id"))
+        print(f"[{scan_id}] Re-queued from status '{record.get('status')}'")
+    return len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description="Chalk pipeline worker")
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("WORKER_PROCESSES", "1")))
+    parser.add_argument("--queue-path", default=os.environ.get("JOB_QUEUE_PATH", "jobs.db"))
+    parser.add_argument("--resume", action="store_true",
+                        help="re-queue scans stuck in queued/extracted before starting")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("WORKER_METRICS_PORT", "0")),
+                        help="serve Prometheus metrics; process i uses port + i")
+    args = parser.parse_args()
+
+    if args.resume:
+        bucket_name = os.environ.get("SUPABASE_BUCKET", "chalk-images")
+        count = resume_stalled_scans(SQLiteJobQueue(args.queue_path), bucket_name)
+        print(f"Re-queued {count} stalled scans.")
+
+    if args.processes <= 1:
+        work_loop(args.queue_path, args.metrics_port)
+        return
+
+    procs = [
+        multiprocessing.Process(
+            target=work_loop, args=(args.queue_path, args.metrics_port and args.metrics_port + i), name=f"worker-{i}"
+        )
+        for i in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+
+    def forward(signum, frame):
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for p in procs:
+        p.join()
+
+if __name__ == "__main__":
+    main()